@@ -0,0 +1,389 @@
+""" Micro-benchmarks of the model kernels, the model evaluations, the positivity check and the likelihood of the fitter.
+
+Every benchmark is run on synthetic data for every combination of the swept parameters it depends on : the number of
+points, the number of discs and the mix of disc axes (``xz`` means the discs alternate between the x and z axes). The
+time per call (minimum and median over the repeats) and the peak memory allocated during a call are recorded, and the
+results are written as a JSON file, which can be compared with the results of another commit.
+
+Example:
+    Running the whole sweep (10^3 to 10^7 points, 1 to 32 discs) takes a while, a subset can be selected ::
+
+        $ python benchmarks/run_benchmarks.py --output before.json
+        $ python benchmarks/run_benchmarks.py --quick --filter evaluate_density --output after.json
+        $ python benchmarks/run_benchmarks.py --compare before.json after.json
+
+Note:
+    The peak memory is measured with ``tracemalloc`` (Python 3 only) in a separate call : it counts the memory allocated
+    by Python and numpy, not the memory held by the interpreter before the call. The fitter benchmarks are skipped if the
+    fitter cannot be imported (``emcee``, ``corner`` and ``matplotlib`` are needed).
+
+Note:
+    The ``tabulated_*_vec`` benchmarks time the interpolated model of :mod:`mnn.tabulated` on the same sweep as the
+    ``evaluate_*_vec`` ones, to find the number of discs from which the tables are cheaper than the analytic evaluation.
+    Building the tables is not timed. They are skipped on revisions without the module.
+
+Note:
+    The suite only relies on methods the package has always had, so it can be copied into the checkout of an older
+    revision to measure it. A case raising an error in a revision is reported as failed and left out of its results.
+"""
+from __future__ import print_function, division
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from collections import OrderedDict
+
+import numpy as np
+
+# Benchmarking the checkout the script belongs to
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, root)
+
+from mnn.model import MNnModel
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+default_points = (10**3, 10**4, 10**5, 10**6, 10**7)
+default_discs = (1, 2, 4, 8, 16, 32)
+default_axes = ('z', 'xz', 'xyz')
+
+quick_points = (10**3, 10**4, 10**5)
+quick_discs = (1, 4)
+quick_axes = ('z', 'xyz')
+
+# Half-width of the box the synthetic points are drawn in
+box_size = 10.0
+
+# Defined here rather than imported, so that the suite can measure older revisions of the package
+axis_names = ('x', 'y', 'z')
+
+# name -> (swept parameters, setup function). The setup function takes the values of the swept parameters and returns the
+# function timed, which takes no argument.
+benchmarks = OrderedDict()
+
+def benchmark(name, sweep):
+    """ Registers a benchmark, sweeping over the parameters in ``sweep`` (among 'points', 'discs' and 'axes') """
+    def register(setup):
+        benchmarks[name] = (sweep, setup)
+        return setup
+    return register
+
+
+# The last set of points drawn, as a (n_points, points) tuple : the large arrays are only held once
+_points_cache = [None]
+
+def synthetic_points(n_points, seed=0):
+    """ Returns ``n_points`` points drawn uniformly in the box, as a (n_points, 3) array """
+    if _points_cache[0] is None or _points_cache[0][0] != n_points:
+        _points_cache[0] = None
+        _points_cache[0] = (n_points, np.random.RandomState(seed).uniform(-box_size, box_size, (n_points, 3)))
+    return _points_cache[0][1]
+
+def synthetic_discs(n_discs, axes):
+    """ Returns ``n_discs`` discs cycling over the axes of ``axes``, sorted by axis as in the fitter, as a list of
+    (axis, a, b, M) tuples. The scales and heights vary from disc to disc, every mass is positive. """
+    discs = []
+    for i in range(n_discs):
+        discs.append((axes[i % len(axes)], 1.0 + 4.0*i/max(n_discs-1, 1), 0.2 + 0.1*(i % 5), 1.0 + i % 3))
+    return sorted(discs, key=lambda disc: axis_names.index(disc[0]))
+
+def synthetic_model(n_discs, axes):
+    model = MNnModel()
+    model.add_discs(synthetic_discs(n_discs, axes))
+    return model
+
+
+@benchmark('mn_density', ('points',))
+def setup_mn_density(points):
+    x = synthetic_points(points)
+    r = np.sqrt(x[:, 0]**2 + x[:, 1]**2)
+    z = x[:, 2].copy()
+    return lambda: MNnModel.mn_density(r, z, 1.0, 0.5, 1.0)
+
+@benchmark('mn_potential', ('points',))
+def setup_mn_potential(points):
+    x = synthetic_points(points)
+    r = np.sqrt(x[:, 0]**2 + x[:, 1]**2)
+    z = x[:, 2].copy()
+    return lambda: MNnModel.mn_potential(r, z, 1.0, 0.5, 1.0)
+
+@benchmark('mn_force', ('points',))
+def setup_mn_force(points):
+    x = synthetic_points(points)
+    t1, t2, n = x[:, 0].copy(), x[:, 1].copy(), x[:, 2].copy()
+    return lambda: MNnModel.mn_force(t1, t2, n, 1.0, 0.5, 1.0, 'z')
+
+def setup_evaluate(quantity, vectorized):
+    def setup(points, discs, axes):
+        model = synthetic_model(discs, axes)
+        x = synthetic_points(points)
+        if vectorized:
+            function = getattr(model, 'evaluate_{0}_vec'.format(quantity))
+            return lambda: function(x)
+        function = getattr(model, 'evaluate_{0}'.format(quantity))
+        vx, vy, vz = x[:, 0].copy(), x[:, 1].copy(), x[:, 2].copy()
+        return lambda: function(vx, vy, vz)
+    return setup
+
+for quantity in ('density', 'potential', 'force'):
+    benchmark('evaluate_{0}'.format(quantity), ('points', 'discs', 'axes'))(setup_evaluate(quantity, False))
+    benchmark('evaluate_{0}_vec'.format(quantity), ('points', 'discs', 'axes'))(setup_evaluate(quantity, True))
+
+# The last tabulated model built, as a (n_discs, axes, model) tuple : the tables are only built once for every number of points
+_tabulated_cache = [None]
+
+def setup_tabulated(quantity):
+    # Same sweep as evaluate_*_vec : the number of discs from which the tabulated model is faster can be read side by side
+    def setup(points, discs, axes):
+        from mnn.tabulated import TabulatedMNnModel
+
+        if _tabulated_cache[0] is None or _tabulated_cache[0][:2] != (discs, axes):
+            _tabulated_cache[0] = None
+            _tabulated_cache[0] = (discs, axes, TabulatedMNnModel(synthetic_model(discs, axes)))
+        function = getattr(_tabulated_cache[0][2], 'evaluate_{0}_vec'.format(quantity))
+        x = synthetic_points(points)
+        return lambda: function(x)
+    return setup
+
+for quantity in ('potential', 'force'):
+    benchmark('tabulated_{0}_vec'.format(quantity), ('points', 'discs', 'axes'))(setup_tabulated(quantity))
+
+@benchmark('generate_dataset_meshgrid', ('points', 'discs', 'axes'))
+def setup_generate_dataset_meshgrid(points, discs, axes):
+    model = synthetic_model(discs, axes)
+    n = int(round(points**(1.0/3.0)))
+    return lambda: model.generate_dataset_meshgrid((-box_size,)*3, (box_size,)*3, (n, n, n))
+
+@benchmark('is_positive_definite', ('discs', 'axes'))
+def setup_is_positive_definite(discs, axes):
+    model = synthetic_model(discs, axes)
+    return lambda: model.is_positive_definite()
+
+@benchmark('loglikelihood', ('points', 'discs', 'axes'))
+def setup_loglikelihood(points, discs, axes, directory=None):
+    import mnn.fitter
+    from mnn.fitter import MNnFitter
+
+    disc_list = synthetic_discs(discs, axes)
+    model = MNnModel()
+    model.add_discs(disc_list)
+    x = synthetic_points(points)
+    data = np.empty((points, 4))
+    data[:, :3] = x
+    data[:, 3] = model.evaluate_density_vec(x) * (1.0 + 0.05*np.random.RandomState(1).randn(points))
+    # Older revisions of the fitter only read ascii files
+    if hasattr(mnn.fitter, 'raw_extensions'):
+        filename = os.path.join(directory, 'data.npy')
+        np.save(filename, data)
+    else:
+        filename = os.path.join(directory, 'data.txt')
+        np.savetxt(filename, data)
+    del data
+
+    fitter = MNnFitter()
+    fitter.set_model_type(*[sum(1 for disc in disc_list if disc[0] == name) for name in axis_names])
+    fitter.load_data(filename)
+    params = np.array([disc[1:] for disc in disc_list]).reshape(-1)
+    return lambda: fitter.loglikelihood(params)
+
+
+def time_function(function, repeat, min_time):
+    """ Times ``function``.
+
+    The function is called once to warm up and calibrate the number of calls per repeat, so that a repeat lasts at least
+    ``min_time`` seconds.
+
+    Returns:
+        A dictionary holding the minimum, median and maximum time per call over the repeats, the number of repeats and
+        the number of calls per repeat
+    """
+    start = timeit.default_timer()
+    function()
+    elapsed = timeit.default_timer() - start
+    number = max(1, int(np.ceil(min_time / max(elapsed, 1e-9))))
+
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        for j in range(number):
+            function()
+        times.append((timeit.default_timer() - start) / number)
+    return {'min': min(times), 'median': float(np.median(times)), 'max': max(times), 'repeat': repeat, 'number': number}
+
+def peak_memory(function):
+    """ Returns the peak memory in bytes allocated during a call of ``function``, or None without ``tracemalloc`` """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        function()
+        return tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+
+def sweep_parameters(sweep, points, discs, axes):
+    """ Yields every combination of the swept parameters, as dictionaries """
+    values = {'points': points, 'discs': discs, 'axes': axes}
+    combinations = [OrderedDict()]
+    for name in ('points', 'discs', 'axes'):
+        if name in sweep:
+            combinations = [OrderedDict(list(c.items()) + [(name, v)]) for c in combinations for v in values[name]]
+    return combinations
+
+def result_key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def metadata():
+    """ Returns the description of the environment the benchmarks are run in """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root,
+                                         stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': datetime.datetime.now().isoformat(), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None}
+
+def run(names, points, discs, axes, repeat, min_time, memory=True):
+    """ Runs the benchmarks ``names`` and returns the list of their results """
+    results = []
+    directory = tempfile.mkdtemp(prefix='mnn_benchmarks')
+    try:
+        for name in names:
+            sweep, setup = benchmarks[name]
+            for params in sweep_parameters(sweep, points, discs, axes):
+                description = '{0}({1})'.format(name, ', '.join('{0}={1}'.format(*item) for item in params.items()))
+                try:
+                    if name == 'loglikelihood':
+                        function = setup(directory=directory, **params)
+                    else:
+                        function = setup(**params)
+                except ImportError as e:
+                    print('{0:<70} skipped : {1}'.format(description, e))
+                    break
+
+                # A revision failing on a case (e.g. an older revision with a bug fixed since) must not stop the sweep
+                try:
+                    result = {'name': name, 'params': params, 'time': time_function(function, repeat, min_time),
+                              'peak_memory': peak_memory(function) if memory else None}
+                except Exception as e:
+                    print('{0:<70} failed : {1}: {2}'.format(description, type(e).__name__, e))
+                    continue
+                results.append(result)
+                print('{0:<70} {1:>12.6f} s {2:>12}'.format(description, result['time']['min'], format_bytes(result['peak_memory'])))
+                sys.stdout.flush()
+                del function
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        _points_cache[0] = None
+        _tabulated_cache[0] = None
+    return results
+
+def format_bytes(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'kB', 'MB'):
+        if abs(size) < 1024:
+            return '{0:.0f} {1}'.format(size, unit)
+        size /= 1024.0
+    return '{0:.1f} GB'.format(size)
+
+def compare(base_name, new_name, threshold):
+    """ Prints the ratio of the times and peak memories of the results in ``new_name`` to those in ``base_name``.
+
+    Returns:
+        The number of benchmarks slower (or using more memory) by more than ``threshold`` in ``new_name``
+    """
+    with open(base_name) as f:
+        base = json.load(f)
+    with open(new_name) as f:
+        new = json.load(f)
+    print('Base : {0} ({1})'.format(base['metadata']['commit'], base['metadata']['date']))
+    print('New  : {0} ({1})'.format(new['metadata']['commit'], new['metadata']['date']))
+
+    base_results = dict((result_key(result), result) for result in base['results'])
+    regressions = 0
+    print('{0:<70} {1:>10} {2:>10}'.format('benchmark', 'time', 'memory'))
+    for result in new['results']:
+        key = result_key(result)
+        if key not in base_results:
+            continue
+        reference = base_results[key]
+        time_ratio = result['time']['min'] / reference['time']['min']
+        memory_ratio = None
+        if result['peak_memory'] and reference['peak_memory']:
+            memory_ratio = result['peak_memory'] / float(reference['peak_memory'])
+
+        flag = ''
+        if time_ratio > 1.0 + threshold or (memory_ratio is not None and memory_ratio > 1.0 + threshold):
+            flag = 'worse'
+            regressions += 1
+        elif time_ratio < 1.0 / (1.0 + threshold):
+            flag = 'faster'
+        description = '{0}({1})'.format(result['name'], ', '.join('{0}={1}'.format(*item) for item in result['params'].items()))
+        print('{0:<70} {1:>9.2f}x {2:>10} {3}'.format(description, time_ratio,
+                                                       '-' if memory_ratio is None else '{0:.2f}x'.format(memory_ratio), flag))
+
+    missing = set(base_results) - set(result_key(result) for result in new['results'])
+    if missing:
+        print('{0} benchmarks of the base results are not in the new results'.format(len(missing)))
+    return regressions
+
+def parse_list(values, cast):
+    return tuple(cast(float(value)) if cast is int else cast(value) for value in values.split(','))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of MNn')
+    parser.add_argument('--output', '-o', help='JSON file the results are written to')
+    parser.add_argument('--filter', '-f', action='append', default=[],
+                        help='Only run the benchmarks whose name contains this string (can be repeated)')
+    parser.add_argument('--points', help='Comma-separated numbers of points (default : 1e3 to 1e7)')
+    parser.add_argument('--discs', help='Comma-separated numbers of discs (default : 1 to 32)')
+    parser.add_argument('--axes', help='Comma-separated mixes of disc axes (default : z,xz,xyz)')
+    parser.add_argument('--quick', action='store_true', help='Small sweep, to check that the benchmarks run')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of repeats of every timing (default : 3)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimum duration of a repeat in seconds (default : 0.2)')
+    parser.add_argument('--no-memory', action='store_true', help='Do not measure the peak memory')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks and exit')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='Compare two result files instead of running the benchmarks')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative change reported as a regression by --compare (default : 0.1)')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, (sweep, setup) in benchmarks.items():
+            print('{0:<30} {1}'.format(name, ', '.join(sweep)))
+        return 0
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+
+    points = parse_list(args.points, int) if args.points else (quick_points if args.quick else default_points)
+    discs = parse_list(args.discs, int) if args.discs else (quick_discs if args.quick else default_discs)
+    axes = parse_list(args.axes, str) if args.axes else (quick_axes if args.quick else default_axes)
+    for mix in axes:
+        if not mix or any(axis not in axis_names for axis in mix):
+            parser.error('Invalid mix of axes : {0}'.format(mix))
+
+    names = [name for name in benchmarks if not args.filter or any(f in name for f in args.filter)]
+    results = run(names, points, discs, axes, args.repeat, args.min_time, not args.no_memory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'metadata': metadata(), 'results': results}, f, indent=1)
+        print('Results written to {0}'.format(args.output))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
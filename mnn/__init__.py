@@ -1 +1 @@
-__all__ = ["model", "fitter"]
\ No newline at end of file
+__all__ = ["model", "fitter", "tabulated", "orbits"]
\ No newline at end of file
@@ -1,39 +1,280 @@
+import copy
+import numbers
+import os
 import sys
+import threading
+import warnings
 import corner
 import emcee
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.optimize as op
+from collections import OrderedDict
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from matplotlib.ticker import MaxNLocator
 
-from .model import MNnModel, MNnError
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-# Thanks to Steven Bethard for this nice trick, found on :
-# https://bytes.com/topic/python/answers/552476-why-cant-you-pickle-instancemethods
-# Allows the methods of MNnFitter to be pickled for multiprocessing
-import copy_reg
-import types
+from .model import MNnModel, MNnError, tangent_components
 
-def _pickle_method(method):
-    func_name = method.im_func.__name__
-    obj = method.im_self
-    cls = method.im_class
-    return _unpickle_method, (func_name, obj, cls)
+sampler = None
+
+# The fitter of a worker process. It is sent once, with the data and the compiled likelihood plan, by the initializer of
+# the pool : the tasks only carry parameter vectors and the results only loglikelihoods.
+_worker_fitter = None
+
+def _initialize_worker(fitter):
+    global _worker_fitter
+    _worker_fitter = fitter
+
+def _worker_loglikelihood(discs):
+    return _worker_fitter.loglikelihood(discs)
+
+def _worker_loglikelihood_masses(scales):
+    return _worker_fitter.loglikelihood_masses(scales)
+
+def _worker_loglikelihood_vec(walkers):
+    return _worker_fitter.loglikelihood_vec(walkers)
+
+# Maximum number of model values (walkers x data points) held at once by the vectorized likelihood
+likelihood_block_size = 2**22
 
-def _unpickle_method(func_name, obj, cls):
-    for cls in cls.__mro__:
+# Extensions of the raw binary data files, and suffix of the binary cache written next to the text data files
+raw_extensions = ('.bin', '.raw')
+cache_suffix = '.cache.npz'
+
+# Suffix of the state file written next to a streamed chain file, to resume the sampling
+checkpoint_suffix = '.state.npz'
+
+
+def _save_npz(filename, **arrays):
+    """ Writes ``arrays`` in the archive ``filename`` through a temporary file replacing it atomically, so that an interrupted
+    run always leaves either the previous archive or the new one """
+    temporary_name = '{0}.{1}.tmp.npz'.format(filename, os.getpid())
+    np.savez(temporary_name, **arrays)
+    os.replace(temporary_name, filename)
+
+class ParameterCache(object):
+    """
+    Bounded least-recently-used cache of results keyed on parameter vectors.
+
+    The parameters can be rounded to a multiple of ``quantization`` before being used as a key, so that nearly identical
+    vectors share their result. The cache is thread-safe. It is emptied when it is pickled : every process working on a
+    copy of the fitter fills its own cache, and its statistics only count the calls made in the current process.
+    """
+    def __init__(self, max_size=1024, quantization=0.0):
+        """ Constructor for the cache.
+
+        Args:
+            max_size (int): Maximum number of results kept (default=1024)
+            quantization (float or numpy array): Step the parameters are rounded to, for all of them or for each one. If 0, the parameters must match exactly (default=0.0).
+        """
+        self.max_size = max_size
+        self.quantization = np.asarray(quantization, dtype=np.float64)
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_data'] = OrderedDict()
+        state['hits'] = 0
+        state['misses'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def key(self, params):
+        """ Returns the key of a parameter vector """
+        params = np.ascontiguousarray(params, dtype=np.float64).reshape(-1)
+        q = self.quantization
+        if np.any(q > 0.0) and np.all(np.isfinite(params)):
+            step = np.where(q > 0.0, q, 1.0)
+            params = np.where(q > 0.0, np.round(params/step)*step, params)
+        return params.tobytes()
+
+    def get(self, key):
+        """ Returns the result stored for ``key`` and marks it as the most recently used, or None if there is none """
+        with self._lock:
+            if key in self._data:
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """ Stores the result of ``key``, dropping the least recently used result if the cache is full """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """ Removes every result from the cache """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """ Returns the statistics of the cache as a dictionary with the keys ``hits``, ``misses``, ``hit_rate``, ``size`` and ``max_size`` """
+        with self._lock:
+            calls = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / float(calls) if calls else 0.0,
+                    'size': len(self._data), 'max_size': self.max_size}
+
+
+class ChainSummary(object):
+    """
+    Downsampled summary of a chain, updated step by step : the 16th, 50th and 84th percentiles of every parameter over the
+    walkers, and the values of a few tracked walkers.
+
+    One step out of ``stride`` is kept. Once ``max_points`` steps are kept, every other one is dropped and the stride doubles :
+    the memory used by the summary, and the cost of plotting it, do not grow with the length of the chain.
+    """
+    def __init__(self, n_walkers, n_params, n_tracked=4, max_points=1000):
+        """ Constructor for the summary.
+
+        Args:
+            n_walkers (int): The number of walkers of the chain
+            n_params (int): The number of parameters of every walker
+            n_tracked (int): The number of walkers whose values are kept (default = 4)
+            max_points (int): The maximum number of steps kept (default = 1000)
+        """
+        self.tracked = np.unique(np.linspace(0, n_walkers-1, min(n_tracked, n_walkers)).astype(int))
+        self.max_points = max_points
+        self.stride = 1
+        self.size = 0
+        self.steps = np.empty(max_points, dtype=np.int64)
+        self.percentiles = np.empty((max_points, 3, n_params))
+        self.walkers = np.empty((max_points, len(self.tracked), n_params))
+
+    def update(self, step, models):
+        """ Adds a step to the summary, if it is a multiple of the stride.
+
+        Args:
+            step (int): The number of the step, counted from 1
+            models (numpy array): The parameters of every walker at this step, as a (n_walkers, n_params) array
+        """
+        if step % self.stride != 0:
+            return
+
+        if self.size == self.max_points:
+            keep = np.flatnonzero(self.steps % (2*self.stride) == 0)
+            for array in (self.steps, self.percentiles, self.walkers):
+                array[:len(keep)] = array[keep]
+            self.size = len(keep)
+            self.stride *= 2
+            if step % self.stride != 0:
+                return
+
+        self.steps[self.size] = step
+        self.percentiles[self.size] = np.percentile(models, (16, 50, 84), axis=0)
+        self.walkers[self.size] = models[self.tracked]
+        self.size += 1
+
+    def snapshot(self):
+        """ Returns a copy of the summary as a tuple holding the steps kept, the percentiles (n_kept, 3, n_params) and
+        the values of the tracked walkers (n_kept, n_tracked, n_params) """
+        return self.steps[:self.size].copy(), self.percentiles[:self.size].copy(), self.walkers[:self.size].copy()
+
+
+class ControlPlotter(object):
+    """
+    Renders the control plots of a running fit in a background thread.
+
+    The sampler updates a :class:`~mnn.fitter.ChainSummary` at every step and, every ``plot_freq`` steps, hands a copy of it
+    to the thread, which draws it with the Agg backend and replaces ``filename``. The sampler never waits for the
+    rendering : if the previous plot is still being drawn, the pending summary is replaced by the newest one.
+    """
+    def __init__(self, summary, labels, plot_freq, filename='current_state.png'):
+        """ Constructor for the plotter. Starts the rendering thread.
+
+        Args:
+            summary (:class:`~mnn.fitter.ChainSummary`): The summary of the chain
+            labels (list): One list of (parameter index, label) tuples for every row of the plot
+            plot_freq (int): The number of steps between two plots
+            filename (string): The name of the image written (default = 'current_state.png')
+        """
+        self.summary = summary
+        self.labels = labels
+        self.plot_freq = plot_freq
+        self.filename = filename
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def update(self, step, models):
+        """ Adds the models of the walkers at ``step`` to the summary, and submits a plot every ``plot_freq`` steps """
+        self.summary.update(step, models)
+        if step % self.plot_freq == 0:
+            self.submit()
+
+    def submit(self):
+        """ Hands a copy of the summary to the rendering thread, replacing the one waiting to be drawn if there is one """
+        snapshot = self.summary.snapshot()
         try:
-            func = cls.__dict__[func_name]
-            return func.__get__(obj, cls)
-        except KeyError:
+            self._queue.get_nowait()
+        except queue.Empty:
             pass
-    return None
-
-copy_reg.pickle(types.MethodType, _pickle_method, _unpickle_method)
+        self._queue.put_nowait(snapshot)
+
+    def close(self):
+        """ Draws the final state of the summary and waits for the rendering thread to finish """
+        if self.summary.size > 0:
+            self.submit()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            snapshot = self._queue.get()
+            if snapshot is None:
+                break
+            try:
+                self.render(snapshot, self.labels, self.filename)
+            except Exception as e:
+                warnings.warn('The control plot could not be drawn : {0}'.format(e))
+
+    @staticmethod
+    def render(snapshot, labels, filename):
+        """ Draws a snapshot of a :class:`~mnn.fitter.ChainSummary` in ``filename``, through a temporary file
+
+        Every panel shows the median of a parameter over the walkers, the band between its 16th and 84th percentiles and
+        the values of the tracked walkers.
+        """
+        steps, percentiles, walkers = snapshot
+        n_rows = len(labels)
+        n_columns = max(len(row) for row in labels)
+        fig = Figure(figsize=(20, n_rows*5))
+        canvas = FigureCanvasAgg(fig)
+        for i_row, row in enumerate(labels):
+            for i_column, (pid, label) in enumerate(row):
+                axis = fig.add_subplot(n_rows, n_columns, i_row*n_columns + i_column + 1)
+                axis.ticklabel_format(style='sci', axis='y', scilimits=(0,0))
+                axis.fill_between(steps, percentiles[:, 0, pid], percentiles[:, 2, pid], color='k', alpha=0.2, linewidth=0)
+                axis.plot(steps, walkers[:, :, pid], linewidth=0.5, alpha=0.6)
+                axis.plot(steps, percentiles[:, 1, pid], color='k')
+                axis.set_ylabel(label)
+                axis.set_xlabel('Iteration')
 
+        root, extension = os.path.splitext(filename)
+        temporary_name = '{0}.{1}.tmp{2}'.format(root, os.getpid(), extension)
+        canvas.print_png(temporary_name)
+        os.replace(temporary_name, filename)
 
-sampler = None
 
 class MNnFitter(object):
     """ 
@@ -44,19 +285,26 @@ class MNnFitter(object):
     """
     def __init__(self, n_walkers=100, n_steps=1000, n_threads=1, random_seed=123,
                  fit_type='density', check_positive_definite=False, cdp_range=None, 
-                 allow_negative_mass=False, verbose=False):
+                 allow_negative_mass=False, verbose=False, vectorize=True, solve_masses=False,
+                 cache_size=0, cache_quantization=0.0, n_processes=1, symmetry_reduction=False):
         """ Constructor for the Miyamoto-Nagai negative fitter. The fitting is based on ``emcee``.
 
         Args:
             n_walkers (int): How many parallel walkers ``emcee`` will use to fit the data (default=100).
             n_step (int): The number of steps every walker should perform before stopping (default=1000).
             n_threads (int): Number of threads used to fit the data (default=1).
+            symmetry_reduction (bool): Should the data points sharing the same coordinates, up to the symmetries of the discs, be merged before fitting (default=False). The chi2 is unchanged.
+            n_processes (int): Number of processes used to fit the data. If more than one, the walkers are evaluated by a process pool, each process receiving the data once (default=1).
             random_seed (int): The random seed used for the fitting (default=123).
             fit_type ({'density', 'potential'}): What type of data is fitted (default='density').
             check_positive_definite (bool): Should the algorithm check if every walker is positive definite at every step ?
             cdp_range({float, None}): Maximum range to which check positive definiteness. If none, the criterion will be tested, for each axis on 10*max_scale_radius
             allow_negative_mass (bool): Allow the fitter to use models with negative masses (default=False)
             verbose (bool): Should the program output additional information (default=False).
+            vectorize (bool): Should all the walkers of a step be evaluated at once by :func:`~mnn.fitter.MNnFitter.loglikelihood_vec` (default=True). The threads are then used by the model evaluation instead of ``emcee``. If a subclass overrides :func:`~mnn.fitter.MNnFitter.loglikelihood`, the walkers are always evaluated one by one with the overridden method.
+            solve_masses (bool): Should only the scales and heights of the discs be sampled, the masses being solved for at every step by linear least squares (default=False). See :func:`~mnn.fitter.MNnFitter.loglikelihood_masses`.
+            cache_size (int): Number of loglikelihoods, and of positive-definiteness results, kept in a :class:`~mnn.fitter.ParameterCache`. If 0, nothing is cached (default=0).
+            cache_quantization (float or numpy array): Step the parameters are rounded to before looking them up in the caches. If 0, only identical parameters share a result (default=0.0).
 
         Note:
             Using ``check_positive_definite=True`` might guarantee that the density will be always positive. But
@@ -66,10 +314,25 @@ class MNnFitter(object):
         self.n_walkers = n_walkers
         self.n_steps = n_steps
         self.n_threads = n_threads
+        self.n_processes = n_processes
 
         # The fitted models
         self.samples = None
         self.lnprob  = None
+        self.positive_mask = None
+        self.positive_fraction = None
+
+        # Convergence of the last fit : integrated autocorrelation time and effective sample size of every parameter,
+        # burn-in used, and whether the adaptive run converged before n_steps
+        self.autocorrelation_time = None
+        self.effective_sample_size = None
+        self.burnin = None
+        self.converged = None
+        self._previous_tau = None
+
+        # The chain streamed to disk by fit_data, as a (n_steps, n_walkers, n_columns) array, and its number of steps written
+        self._chain_rows = None
+        self._chain_steps = 0
         self.discs = None
         self.axes = None
         self.ndim = 0
@@ -80,6 +343,16 @@ class MNnFitter(object):
         self.n_values = 0
         self.yerr = None
 
+        # The compiled likelihood plan, see _compile_plan
+        self._plan = None
+
+        # The caches of the loglikelihoods and of the positive-definiteness results
+        self._likelihood_cache = None
+        self._positivity_cache = None
+        if cache_size > 0:
+            self._likelihood_cache = ParameterCache(cache_size, cache_quantization)
+            self._positivity_cache = ParameterCache(cache_size, cache_quantization)
+
         # Flags
         self.verbose = verbose
         self.check_DP = check_positive_definite
@@ -89,6 +362,9 @@ class MNnFitter(object):
                   'might take a very long time to compute !')
         self.cdp_range = cdp_range
         self.allow_NM = allow_negative_mass
+        self.vectorize = vectorize
+        self.solve_masses = solve_masses
+        self.symmetry_reduction = symmetry_reduction
 
         np.random.seed(random_seed)
 
@@ -104,18 +380,234 @@ class MNnFitter(object):
         """
         self.ndim = (nx+ny+nz)*3
         self.axes = ['x']*nx + ['y']*ny + ['z']*nz
+        self._compile_plan()
 
-    def load_data(self, filename):
+    def load_data(self, filename, errors=None, mmap=False, cache=True, n_columns=4, dtype=np.float64):
         """ Loads the data that will be fitted to the model. 
 
-        The data should be in an ascii file with four columns tab or space separated : X Y Z quantity
+        The data is a table with one point per row and at least four columns : X Y Z quantity. The format is given by the
+        extension of the file :
+
+        - ``.npy`` : a numpy array
+        - ``.npz`` : a numpy archive holding the table as ``data``, or as its only array
+        - ``.bin`` or ``.raw`` : a raw binary file of ``n_columns`` values of type ``dtype`` per point
+        - anything else : an ascii file with columns tab or space separated. The parsed table is cached in a binary file next
+          to it (``filename`` + ``.cache.npz``), used as long as the ascii file keeps the same size and modification time.
 
         Args:
             filename (string): The filename to open.
+            errors (int, numpy array or None): The errors on the quantity : the index of the column holding them, or an array with one value per point. If None, the errors are 1% of the quantity (default=None).
+            mmap (bool): Should ``.npy`` and raw binary files be mapped in memory instead of being read (default=False)
+            cache (bool): Should the binary cache of ascii files be used and written (default=True)
+            n_columns (int): Number of columns of raw binary files (default=4)
+            dtype (numpy dtype): Type of the values of raw binary files (default=np.float64)
+
+        Raises:
+            MNnError: If the table does not have four columns, if the error column is not an integer index of one of the extra columns, or if the errors do not match the table
         """
-        self.data = np.loadtxt(filename)
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == '.npy':
+            data = np.load(filename, mmap_mode='r' if mmap else None)
+        elif extension == '.npz':
+            with np.load(filename) as archive:
+                if 'data' in archive.files:
+                    data = archive['data']
+                elif len(archive.files) == 1:
+                    data = archive[archive.files[0]]
+                else:
+                    raise MNnError('The archive {0} should hold the data as "data" or as its only array'.format(filename))
+        elif extension in raw_extensions:
+            if mmap:
+                data = np.memmap(filename, dtype=dtype, mode='r')
+            else:
+                data = np.fromfile(filename, dtype=dtype)
+            if data.size % n_columns != 0:
+                raise MNnError('The size of {0} is not a multiple of {1} columns'.format(filename, n_columns))
+            data = data.reshape(-1, n_columns)
+        else:
+            data = self._load_text(filename, cache)
+
+        data = np.atleast_2d(data)
+        if data.ndim != 2 or data.shape[1] < 4:
+            raise MNnError('The data should have at least four columns (X Y Z quantity), got an array of shape {0}'.format(data.shape))
+
+        if errors is None:
+            yerr = 0.01*data[:,3] #np.random.rand(self.n_values)
+        elif np.ndim(errors) == 0:
+            if not isinstance(errors, numbers.Integral) or isinstance(errors, bool) or not 4 <= errors < data.shape[1]:
+                raise MNnError('The error column {0!r} is not one of the extra columns of the data ({1} columns)'.format(errors, data.shape[1]))
+            yerr = np.asarray(data[:, errors], dtype=np.float64)
+        else:
+            yerr = np.asarray(errors, dtype=np.float64).reshape(-1)
+            if yerr.size != data.shape[0]:
+                raise MNnError('{0} errors given for {1} data points'.format(yerr.size, data.shape[0]))
+
+        self.data = data
         self.n_values = self.data.shape[0]
-        self.yerr = 0.01*self.data[:,3] #np.random.rand(self.n_values)
+        self.yerr = yerr
+        self._compile_plan()
+
+    @staticmethod
+    def _load_text(filename, cache=True):
+        """ Parses an ascii data file, through its binary cache if ``cache`` is True
+
+        The cache is identified by the size and the modification time of the ascii file.
+        """
+        cache_name = filename + cache_suffix
+        status = os.stat(filename)
+        source = np.array([status.st_size, status.st_mtime], dtype=np.float64)
+
+        if cache and os.path.exists(cache_name):
+            try:
+                with np.load(cache_name) as archive:
+                    if np.array_equal(archive['source'], source):
+                        return archive['data']
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+        data = np.loadtxt(filename)
+        if cache:
+            try:
+                _save_npz(cache_name, data=data, source=source)
+            except (IOError, OSError):
+                print('Warning : Could not write the binary cache of {0}'.format(filename))
+        return data
+
+    def _compile_plan(self):
+        """ Precomputes everything the likelihood needs that does not depend on the parameters of the discs.
+
+        The plan holds a model with the disc layout of the fit, the coordinates of the data as contiguous arrays, the squared
+        distances of the data points to the axes of the discs, the observed values and their inverse variances. It is built
+        once both the data and the model type are known, so the likelihood only evaluates the discs and reduces the chi2.
+        With ``symmetry_reduction``, the points are merged first (see :func:`~mnn.fitter.MNnFitter._reduce_data`).
+        """
+        for cache in (self._likelihood_cache, self._positivity_cache):
+            if cache is not None:
+                cache.clear()
+
+        if self.data is None or self.axes is None:
+            self._plan = None
+            return
+
+        layout = self.make_model(np.ones(self.ndim))
+        coords = [np.ascontiguousarray(self.data[:, i], dtype=np.float64) for i in range(3)]
+        observed = np.ascontiguousarray(self.data[:, 3], dtype=np.float64)
+        inv_sigma2 = np.ascontiguousarray(1.0/(self.yerr**2.0), dtype=np.float64)
+        offset = 0.0
+        if self.symmetry_reduction:
+            coords, observed, inv_sigma2, offset = self._reduce_data(layout, coords, observed, inv_sigma2)
+
+        self._plan = {'model': layout,
+                      'coords': coords,
+                      'geometry': layout._batch_geometry(coords),
+                      'observed': observed,
+                      'inv_sigma2': inv_sigma2,
+                      'inv_sigma': np.sqrt(inv_sigma2),
+                      'offset': offset,
+                      'n_points': observed.size}
+
+    def _reduce_data(self, layout, coords, observed, inv_sigma2):
+        """ Merges the data points the model cannot tell apart.
+
+        Every disc is symmetric with respect to the coordinate planes and, if all the discs share the same axis, the model
+        only depends on the distance R to the axis and on the height |z|. The points with the same reduced coordinates have
+        the same model value m, and their terms of the chi2 merge exactly :
+        ``sum(w_i*(m-p_i)**2) = W*(m-p)**2 + sum(w_i*(p_i-p)**2)``, where W is the sum of the weights and p the weighted
+        mean of the values. The last sum does not depend on the model and is kept as a constant offset of the chi2.
+
+        Returns:
+            A tuple holding the coordinates, the values and the weights of the merged points, and the offset of the chi2
+        """
+        codes = np.unique(layout._axis_codes)
+        if codes.size == 1:
+            i1, i2, i_n = tangent_components[codes[0]]
+            keys = np.column_stack((coords[i1]*coords[i1] + coords[i2]*coords[i2], np.abs(coords[i_n])))
+        else:
+            keys = np.abs(np.column_stack(coords))
+        keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        weights = np.bincount(inverse, weights=inv_sigma2)
+        mean = np.bincount(inverse, weights=inv_sigma2*observed) / weights
+        offset = np.dot(inv_sigma2, (observed - mean[inverse])**2)
+
+        if codes.size == 1:
+            reduced = [None]*3
+            reduced[i1] = np.sqrt(keys[:, 0])
+            reduced[i2] = np.zeros(keys.shape[0])
+            reduced[i_n] = np.ascontiguousarray(keys[:, 1])
+        else:
+            reduced = [np.ascontiguousarray(keys[:, i]) for i in range(3)]
+
+        if self.verbose:
+            print('Symmetry reduction : {0} data points merged in {1}'.format(observed.size, keys.shape[0]))
+        return reduced, mean, weights, offset
+
+    def _get_plan(self):
+        """ Returns the compiled likelihood plan
+
+        Raises:
+            MNnError: If the data or the model type have not been set
+        """
+        if self._plan is None:
+            raise MNnError('The likelihood cannot be computed before calling "load_data" and "set_model_type"')
+        return self._plan
+
+    def _residuals(self, params, values, n_workers=1):
+        """ Evaluates the parameter sets ``params`` on the data and stores the residuals ``model - data`` in ``values``
+
+        Args:
+            params (numpy array): The (K, n_discs, 3) parameters
+            values (numpy array): A (K, n_values) buffer receiving the residuals
+            n_workers (int): Number of threads evaluating the models (default=1)
+        """
+        plan = self._get_plan()
+        values[...] = 0.0
+        plan['model']._evaluate_batch(params, plan['coords'], plan['geometry'], self.fit_type, values, n_workers=n_workers)
+        values -= plan['observed']
+
+    def _chi2(self, params, values, n_workers=1):
+        """ Evaluates the parameter sets ``params`` on the data and returns their chi2
+
+        Args:
+            params (numpy array): The (K, n_discs, 3) parameters
+            values (numpy array): A (K, n_values) buffer receiving the squared residuals
+            n_workers (int): Number of threads evaluating the models (default=1)
+
+        Returns:
+            A numpy array of size K holding the chi2 of every parameter set
+        """
+        self._residuals(params, values, n_workers)
+        values *= values
+        return np.dot(values, self._plan['inv_sigma2']) + self._plan['offset']
+
+    def _cached(self, cache, params, function):
+        """ Returns ``function(params)``, looking it up in ``cache`` first if there is one """
+        if cache is None:
+            return function(params)
+
+        key = cache.key(params)
+        result = cache.get(key)
+        if result is None:
+            result = function(params)
+            cache.put(key, result)
+        return result
+
+    def cache_stats(self):
+        """ Returns the statistics of the caches of the fitter
+
+        Returns:
+            A dictionary holding the statistics (see :func:`~mnn.fitter.ParameterCache.stats`) of the ``loglikelihood`` and
+            ``positive_definite`` caches, or None if caching is disabled
+        """
+        if self._likelihood_cache is None:
+            return None
+        return {'loglikelihood': self._likelihood_cache.stats(), 'positive_definite': self._positivity_cache.stats()}
+
+    def _is_positive_definite(self, discs):
+        """ Checks the positive-definiteness of a flattened model, through the cache """
+        return self._cached(self._positivity_cache, discs,
+                            lambda discs: self.make_model(discs).is_positive_definite(self.cdp_range))
 
     def loglikelihood(self, discs):
         """ Computes the log likelihood of a given model
@@ -126,53 +618,213 @@ class MNnFitter(object):
         Returns:
             The loglikelihood of the model given in parameter
         """
-        tmp_model = MNnModel()
-        
-        # Checking that a+b > 0 for every model :
-        total_mass = 0.0
-        for id_disc, axis in enumerate(self.axes):
-            a, b, M = discs[id_disc*3:(id_disc+1)*3]
-
-            # Blocking the walkers to go in "forbidden zones" : negative disc height, negative Mass, and a+b < 0
-            if b <= 0:
-                return -np.inf
+        return self._cached(self._likelihood_cache, discs, self._loglikelihood)
 
-            if M < 0 and not self.allow_NM:
-                return -np.inf
-            
-            if a+b < 0:
-                return -np.inf
+    def _loglikelihood(self, discs):
+        """ Computes the log likelihood of a given model, see :func:`~mnn.fitter.MNnFitter.loglikelihood` """
+        params = np.asarray(discs, dtype=np.float64).reshape(1, -1, 3)
+        a, b, M = params[0, :, 0], params[0, :, 1], params[0, :, 2]
 
-            tmp_model.add_disc(axis, a, b, M)
-            total_mass += M
+        # Blocking the walkers to go in "forbidden zones" : negative disc height, negative Mass, and a+b < 0
+        if np.any(b <= 0) or np.any(a+b < 0) or np.sum(M) < 0.0:
+            return -np.inf
 
-        if total_mass < 0.0:
+        if not self.allow_NM and np.any(M < 0):
             return -np.inf
 
         # Now checking for positive-definiteness:
         if self.check_DP:
-            if not tmp_model.is_positive_definite(self.cdp_range):
+            if not self._is_positive_definite(discs):
                 return -np.inf
 
         # Everything ok, we proceed with the likelihood :
-        p = self.data[:, 3]
-        quantity_callback = MNnModel.callback_from_string(self.fit_type)
-        model = tmp_model._evaluate_scalar_quantity(self.data[:, 0], self.data[:, 1], self.data[:, 2], quantity_callback)
-        inv_sigma2 = 1.0/(self.yerr**2.0)
-        return -0.5*(np.sum((p-model)**2.0*inv_sigma2))
+        return -0.5*self._chi2(params, np.empty((1, self._get_plan()['n_points'])))[0]
+
+    def loglikelihood_gradient(self, discs):
+        """ Computes the log likelihood of a given model and its gradient with respect to the parameters
+
+        The derivatives of the discs are analytic (see :func:`~mnn.model.MNnModel.evaluate_jacobian`). The priors are not
+        applied : the model must satisfy ``b>0``.
+
+        Args:
+            discs (tuple): the list of parameters for the model stored in a flat-tuple (a1, b1, M1, a2, b2, ...)
+
+        Returns:
+            A tuple containing
+
+            - **loglikelihood** (float): The loglikelihood of the model
+            - **gradient** (numpy array): The derivatives of the loglikelihood with respect to (a1, b1, M1, a2, b2, ...)
+        """
+        plan = self._get_plan()
+        params = np.asarray(discs, dtype=np.float64).reshape(1, -1, 3)
+
+        residuals = np.empty((1, plan['n_points']))
+        self._residuals(params, residuals)
+        weights = residuals[0]*plan['inv_sigma2']
+        loglikelihood = -0.5*(np.dot(residuals[0], weights) + plan['offset'])
+
+        # d(log L)/dp = -sum((model-data)/sigma^2 * dmodel/dp)
+        weights *= -1.0
+        model = self.make_model(params.reshape(-1))
+        gradient = model._evaluate_jacobian(plan['coords'], plan['geometry'], self.fit_type, weights)
+        return loglikelihood, gradient
+
+    def _solve_masses(self, scales):
+        """ Finds the masses minimizing the chi2 for fixed scales and heights of the discs
+
+        Args:
+            scales (numpy array): The (n_discs, 2) scales and heights
+
+        Returns:
+            A tuple containing the optimal masses and the corresponding chi2
+        """
+        plan = self._get_plan()
+        params = np.ones((scales.shape[0], 3))
+        params[:, :2] = scales
+
+        # Weighted least squares : every row of the system is divided by the error on the data point
+        design = plan['model']._evaluate_discs(plan['coords'], plan['geometry'], self.fit_type, params)
+        design *= plan['inv_sigma']
+        target = plan['observed']*plan['inv_sigma']
+
+        if self.allow_NM:
+            masses = np.linalg.lstsq(design.T, target, rcond=-1)[0]
+        else:
+            masses = op.nnls(design.T, target)[0]
+        residuals = np.dot(masses, design) - target
+        return masses, np.dot(residuals, residuals) + plan['offset']
+
+    def loglikelihood_masses(self, scales):
+        """ Computes the log likelihood of the scales and heights of the discs, their masses being solved for
+
+        The density and the potential are linear in the masses of the discs : for fixed scales and heights, the masses
+        maximizing the likelihood are given by a weighted linear least squares problem. If negative masses are not allowed,
+        the problem is solved under the constraint ``M>=0`` (non-negative least squares). The sampler then only explores
+        the 2*n_discs nonlinear parameters.
+
+        Args:
+            scales (tuple): the scales and heights of the discs stored in a flat-tuple (a1, b1, a2, b2, ...)
+
+        Returns:
+            A tuple containing
+
+            - **loglikelihood** (float): The loglikelihood of the best model with these scales and heights, -inf out of the priors
+            - **masses** (numpy array): The masses of this model, NaN out of the priors
+        """
+        return self._cached(self._likelihood_cache, scales, self._loglikelihood_masses)
+
+    def _loglikelihood_masses(self, scales):
+        """ Solves the masses for given scales and heights, see :func:`~mnn.fitter.MNnFitter.loglikelihood_masses` """
+        scales = np.asarray(scales, dtype=np.float64).reshape(-1, 2)
+        a, b = scales[:, 0], scales[:, 1]
+
+        # Blocking the walkers to go in "forbidden zones" : negative disc height and a+b < 0
+        if np.any(b <= 0) or np.any(a+b < 0):
+            return -np.inf, np.full(scales.shape[0], np.nan)
+
+        masses, chi2 = self._solve_masses(scales)
+        if np.sum(masses) < 0.0:
+            return -np.inf, masses
+
+        # Now checking for positive-definiteness:
+        if self.check_DP:
+            if not self._is_positive_definite(np.column_stack((scales, masses)).reshape(-1)):
+                return -np.inf, masses
+
+        return -0.5*chi2, masses
+
+    def loglikelihood_vec(self, walkers):
+        """ Computes the log likelihood of a set of models at once
+
+        The priors of :func:`~mnn.fitter.MNnFitter.loglikelihood` are applied as masks on the whole set, and the valid models
+        are evaluated on the data in a single call to :func:`~mnn.model.MNnModel.evaluate_batch`. This is the function given
+        to ``emcee`` with ``vectorize=True``.
+
+        Args:
+            walkers (numpy array): A (K, 3*n_discs) array holding one flat model (a1, b1, M1, a2, b2, ...) per row
+
+        Returns:
+            A numpy array of size K holding the loglikelihood of every model, -inf for the models out of the priors
+        """
+        walkers = np.atleast_2d(walkers)
+        params = walkers.reshape(walkers.shape[0], len(self.axes), 3)
+        a, b, M = params[:, :, 0], params[:, :, 1], params[:, :, 2]
+
+        # Blocking the walkers to go in "forbidden zones" : negative disc height, negative Mass, and a+b < 0
+        valid = np.all(b > 0, axis=1) & np.all(a+b >= 0, axis=1) & (np.sum(M, axis=1) >= 0.0)
+        if not self.allow_NM:
+            valid &= np.all(M >= 0, axis=1)
+
+        # The walkers already evaluated are taken from the cache
+        result = np.full(walkers.shape[0], -np.inf)
+        cache = self._likelihood_cache
+        if cache is not None:
+            keys = [cache.key(walker) for walker in walkers]
+            for id_walker in np.flatnonzero(valid):
+                cached = cache.get(keys[id_walker])
+                if cached is not None:
+                    result[id_walker] = cached
+                    valid[id_walker] = False
+
+        # Now checking for positive-definiteness:
+        if self.check_DP:
+            for id_walker in np.flatnonzero(valid):
+                valid[id_walker] = self._is_positive_definite(walkers[id_walker])
+
+        ids = np.flatnonzero(valid)
+        if ids.size == 0:
+            return result
+
+        # Everything ok, we proceed with the likelihood, by blocks of walkers to bound the memory used by the model values
+        n_points = self._get_plan()['n_points']
+        block_size = max(1, likelihood_block_size // max(n_points, 1))
+        values = None
+        for start in range(0, ids.size, block_size):
+            block = ids[start:start+block_size]
+            if values is None or values.shape[0] != block.size:
+                values = np.empty((block.size, n_points))
+            result[block] = -0.5*self._chi2(params[block], values, n_workers=self.n_threads)
+
+        if cache is not None:
+            for id_walker in ids:
+                cache.put(keys[id_walker], result[id_walker])
+        return result
 
     
-    def maximum_likelihood(self):
-        """ Computation of the maximum likelihood for a given model and stores them in ``MNnFitter.model``
+    def maximum_likelihood(self, method='samples', x0=None, max_iterations=1000):
+        """ Computation of the maximum likelihood for a given model
+
+        With ``method='samples'``, the best model among the samples of :func:`~mnn.fitter.MNnFitter.fit_data` is returned.
+        With ``method='L-BFGS-B'``, the likelihood is maximized from ``x0`` by ``scipy.optimize.minimize`` using its analytic
+        gradient (see :func:`~mnn.fitter.MNnFitter.loglikelihood_gradient`), without any sampling. The result can be used
+        on its own or as the initial guess of :func:`~mnn.fitter.MNnFitter.fit_data`.
 
         Args:
-            samples : The nd-array given by the fit_data routine
+            method ({'samples', 'L-BFGS-B'}): How the maximum is found (default='samples')
+            x0 (numpy array): The starting point of the optimizer. If None, the best sample is used (default=None).
+            max_iterations (int): Maximum number of iterations of the optimizer (default=1000)
+
         Returns:
-            The parameters corresponding to the maximized log likelihood
+            A tuple containing
+
+            - **values** (numpy array): The parameters corresponding to the maximized log likelihood
+            - **best_score** (float): The maximized log likelihood
+
+        Raises:
+            MNnError: If the method is unknown, or if there is no starting point for the optimizer
+
+        Note:
+            The optimizer works on the parameters (a+b, b, M) of every disc so that the priors ``a+b>=0``, ``b>0`` and, unless
+            negative masses are allowed, ``M>=0`` are simple bounds. The positive-definiteness of the result is not enforced.
         """
         if self.verbose:
             print("Computing maximum of likelihood")
 
+        if method == 'L-BFGS-B':
+            return self._optimize_likelihood(x0, max_iterations)
+        elif method != 'samples':
+            raise MNnError('Unknown maximum likelihood method {0}, possible values are (\'samples\', \'L-BFGS-B\')'.format(method))
+
         # Optimizing the parameters of the model to minimize the loglikelihood
         #best_model = -1
         #best_score = -np.inf
@@ -221,7 +873,61 @@ class MNnFitter(object):
 
         return values, best_score
 
-    def fit_data(self, burnin=100, x0=None, x0_range=1e-2, plot_freq=0, plot_ids=[]):
+    def _optimize_likelihood(self, x0, max_iterations):
+        """ Maximizes the likelihood with L-BFGS-B, see :func:`~mnn.fitter.MNnFitter.maximum_likelihood` """
+        if x0 is None:
+            if self.samples is None:
+                raise MNnError('The optimizer needs a starting point : give x0 or call fit_data first')
+            x0 = self.samples[self.lnprob.argmax()]
+        x0 = np.asarray(x0, dtype=np.float64)
+        if x0.shape != (self.ndim,):
+            raise MNnError('The shape given for the initial guess ({0}) is not compatible with the model ({1})'.format(x0.shape, (self.ndim,)))
+
+        # Change of variables (a, b, M) -> (c=a+b, b, M). If the masses are solved for, only (c, b) are optimized.
+        n_vars = 2 if self.solve_masses else 3
+
+        def to_params(u):
+            params = np.zeros((len(self.axes), 3))
+            params[:, :n_vars] = u.reshape(-1, n_vars)
+            params[:, 0] -= params[:, 1]
+            if self.solve_masses:
+                params[:, 2] = self._solve_masses(params[:, :2])[0]
+            return params.reshape(-1)
+
+        def objective(u):
+            # With the masses solved for, the gradient of the chi2 with respect to them vanishes (or they are bound) :
+            # the gradient of the reduced problem is given by the derivatives with respect to (a, b)
+            loglikelihood, gradient = self.loglikelihood_gradient(to_params(u))
+            gradient = gradient.reshape(-1, 3)[:, :n_vars]
+            gradient[:, 1] -= gradient[:, 0]
+            return -loglikelihood, -gradient.reshape(-1)
+
+        u0 = x0.reshape(-1, 3)[:, :n_vars].copy()
+        u0[:, 0] += u0[:, 1]
+        b_min = 1e-8*max(np.abs(u0).max(), 1.0)
+        m_min = None if self.allow_NM else 0.0
+        bounds = ([(0.0, None), (b_min, None), (m_min, None)][:n_vars])*len(self.axes)
+
+        # The starting point is moved inside the bounds
+        u0[:, 0] = np.maximum(u0[:, 0], 0.0)
+        u0[:, 1] = np.maximum(u0[:, 1], b_min)
+        if m_min is not None and not self.solve_masses:
+            u0[:, 2] = np.maximum(u0[:, 2], m_min)
+
+        result = op.minimize(objective, u0.reshape(-1), jac=True, method='L-BFGS-B', bounds=bounds, options={'maxiter': max_iterations})
+        values = to_params(result.x)
+
+        if self.verbose:
+            print("L-BFGS-B : {0} after {1} iterations".format(result.message, result.nit))
+        if np.sum(values[2::3]) < 0.0:
+            print('Warning : The total mass of the optimized model is negative')
+        if self.check_DP and not self._is_positive_definite(values):
+            print('Warning : The optimized model is not positive definite')
+
+        return values, -result.fun
+
+    def fit_data(self, burnin=100, x0=None, x0_range=1e-2, plot_freq=0, plot_ids=[], chain_file=None, checkpoint_every=100, resume=False,
+                 adaptive=False, check_every=100, n_tau=50, tau_tolerance=0.01):
         """ Runs ``emcee`` to fit the model to the data. 
 
         Fills the :data:`mnn.fitter.sampler` object with the putative models and returns the burned-in data. The walkers are initialized
@@ -229,11 +935,18 @@ class MNnFitter(object):
         centered on the initial guess of what the parameters are. 
 
         Args:
-            burnin (int): The number of timesteps to remove from every walker after the end (default=100).
+            burnin (int): The number of timesteps to remove from every walker after the end (default=100). Ignored if ``adaptive`` is True.
             x0 (numpy array): The initial guess for the solution (default=None). If None, then x0 is determined randomly.
             x0_range (float): The radius of the inital guess walker ball. Can be either a single scalar or a tuple of size 3*n_discs (default=1e-2)
             plot_freq (int): The frequency at which the system outputs control plot (default=0). If 0, then the system does not plot anything until the end.
             plot_ids (array): The id of the discs to plot during the control plots (default=[]). If empty array, then every disc is plotted.
+            chain_file (string or None): The name of the ``.npy`` file the chain is streamed to. If None, the chain is kept in memory by ``emcee`` (default=None).
+            checkpoint_every (int): Number of steps between two checkpoints of the streamed chain (default=100)
+            resume (bool): Should the sampling continue from the last checkpoint of ``chain_file`` (default=False). A new chain is started if ``chain_file`` does not exist. If False, an existing ``chain_file`` is overwritten.
+            adaptive (bool): Should the sampling stop as soon as the chain has converged, and the burn-in be chosen from the autocorrelation time (default=False). ``n_steps`` is then the maximum number of steps.
+            check_every (int): Number of steps between two estimations of the autocorrelation time in adaptive mode (default=100)
+            n_tau (float): Minimum length of the chain, in autocorrelation times, for the adaptive run to stop (default=50)
+            tau_tolerance (float): Maximum relative change of the autocorrelation times between two estimations for the adaptive run to stop (default=0.01)
 
         Returns: 
             A tuple containing
@@ -243,13 +956,34 @@ class MNnFitter(object):
 
         Raises:
             MNnError: If the user tries to fit the data without having called :func:`~mnn.fitter.MNnFitter.load_data` before.
+            MNnError: If ``resume`` is True and ``chain_file`` exists without a checkpoint, or does not match the fit.
+
+        Note:
+            The plots are outputted in the folder where the script is executed, in the file ``current_state.png``. They are
+            drawn in a background thread from a :class:`~mnn.fitter.ChainSummary` updated at every step, so the sampling never
+            waits for them : every panel shows the median of a parameter over the walkers, the band between its 16th and 84th
+            percentiles and the paths of a few walkers, on at most 1000 steps of the chain.
+
+        Note:
+            With a ``chain_file``, the chain is written step by step in a ``.npy`` file mapped in memory, holding for every step
+            and every walker its parameters, its loglikelihood and, if the masses are solved for, its masses. At every checkpoint,
+            the file is flushed and the state of the sampler (positions, loglikelihoods and random generators) is saved next to
+            it, in ``chain_file`` + ``.state.npz``. A run interrupted at any time can then be resumed with ``resume=True`` : the
+            sampling continues from the last checkpoint, without evaluating the walkers again, and gives the same chain as an
+            uninterrupted run.
 
         Note:
-            The plots are outputted in the folder where the script is executed, in the file ``current_state.png``.
+            After the run, the integrated autocorrelation time of every parameter is estimated on the chain and stored in
+            :attr:`autocorrelation_time`, along with the effective number of independent samples after burn-in in
+            :attr:`effective_sample_size`. In adaptive mode, the autocorrelation times are estimated every ``check_every``
+            steps during the run (and printed if ``verbose``) : the sampling stops once the chain is longer than ``n_tau``
+            times the largest of them and they changed by less than ``tau_tolerance`` since the previous estimation. The burn-in
+            is then twice the largest autocorrelation time, stored in :attr:`burnin`, and :attr:`converged` tells if the run
+            stopped before ``n_steps``.
         """
 
         # We initialize the positions of the walkers by adding a small random component to each parameter
-        if x0 == None:
+        if x0 is None:
             self.model = np.random.rand(self.ndim)
         else:
             if x0.shape != (self.ndim,):
@@ -260,61 +994,83 @@ class MNnFitter(object):
         # We make sure we can treat a bulk init if necessary
         if type(x0_range) in (tuple, np.ndarray):
             x0_range = np.array(x0_range)
+
+        # If the masses are solved for, the walkers only move the scales and heights
+        x_init = self.model
+        ndim = self.ndim
+        if self.solve_masses:
+            x_init = np.asarray(x_init).reshape(-1, 3)[:, :2].reshape(-1)
+            if np.ndim(x0_range) > 0:
+                x0_range = x0_range.reshape(-1, 3)[:, :2].reshape(-1)
+            ndim = x_init.size
             
-        init_pos = [self.model + self.model*x0_range*np.random.randn(self.ndim) for i in range(self.n_walkers)]
+        init_pos = [x_init + x_init*x0_range*np.random.randn(ndim) for i in range(self.n_walkers)]
 
         # Running the MCMC to get the parameters
         if self.verbose:
             print("Running emcee ...")
 
         global sampler
-        sampler = emcee.EnsembleSampler(self.n_walkers, self.ndim, self.loglikelihood, threads=self.n_threads)
-
-        # Plot the chains regularly to see if the system has converged
-        if plot_freq > 0:
-            # Making sure we can plot what's asked (no more than three discs)
-            if plot_ids == []:
-                plot_ids = list(range(len(self.axes)))
-            
-            cur_step = 0
-            pos = init_pos
-            while cur_step < self.n_steps:
+        self._chain_rows = None
+        pool = self._create_pool()
+        control = None
+        try:
+            sampler = self._create_sampler(ndim, pool)
+
+            if plot_freq > 0:
+                control = self._create_control_plotter(plot_ids, plot_freq)
+
+            self.converged = False if adaptive else None
+            self._previous_tau = None
+            monitor = None
+            if adaptive:
+                monitor = lambda step: self._check_convergence(step, check_every, n_tau, tau_tolerance)
+
+            if chain_file is not None:
+                self._stream_chain(init_pos, ndim, chain_file, checkpoint_every, resume, control, monitor)
+            else:
+                initial = emcee.State(np.array(init_pos), random_state=np.random.get_state())
+                for state in sampler.sample(initial, iterations=self.n_steps):
+                    if self._after_step(sampler.iteration, state, control, monitor):
+                        break
                 if self.verbose:
-                    sys.stdout.write('\r  . Step : {0}/{1}'.format(cur_step+1, self.n_steps))
-                    sys.stdout.flush()
-                pos, prob, state = sampler.run_mcmc(pos, plot_freq, rstate0=np.random.get_state())
-                cur_step += plot_freq
-
-                # Plotting the intermediate result
-                fig = self.plot_disc_walkers(plot_ids)
-                fig.savefig('current_state.png')
-                plt.close()
-            if self.verbose:           
-                print('\r  . Step : {0}/{1}'.format(self.n_steps, self.n_steps))
-        else:
-            sampler.run_mcmc(init_pos, self.n_steps, rstate0=np.random.get_state())    
-
+                    print('')
+        finally:
+            if control is not None:
+                control.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+
+        # Estimating the autocorrelation times, and the burn-in in adaptive mode
+        chain = self._get_chain()
+        n_done = chain.shape[1]
+        tau = emcee.autocorr.integrated_time(np.swapaxes(chain, 0, 1), tol=0)
+        if adaptive:
+            burnin = min(int(2.0*np.max(tau)), n_done-1)
+        elif burnin >= n_done:
+            print('Warning : The burn-in ({0}) is longer than the chain ({1} steps)'.format(burnin, n_done))
+        self.autocorrelation_time = tau
+        self.effective_sample_size = self.n_walkers * max(n_done - burnin, 0) / tau
+        self.burnin = burnin
+        if self.verbose:
+            print('Autocorrelation times : {0}'.format(np.array2string(tau, precision=1)))
+            print('Burn-in : {0} steps, effective sample size : {1:.0f}'.format(burnin, np.min(self.effective_sample_size)))
+        if adaptive and not self.converged:
+            warnings.warn('The chain did not converge in {0} steps : the autocorrelation time estimates may be unreliable.\n'.format(n_done) +
+                          'Consider increasing n_steps !')
 
         # Storing the last burnin results
-        samples = sampler.chain[:, burnin:, :].reshape((-1, self.ndim))
-        lnprob = sampler.lnprobability[:, burnin:].reshape((-1))
+        samples = chain[:, burnin:, :].reshape((-1, self.ndim))
+        lnprob = self._get_lnprobability()[:, burnin:].reshape((-1))
 
         if self.verbose:
             print("Done.")
 
         # Checking for positive-definiteness
-        everything_dp = True
-        for sample in samples:
-            tmp_model = MNnModel()
-            for id_disc, axis in enumerate(self.axes):
-                  a, b, M = sample[id_disc*3:(id_disc+1)*3]
-                  tmp_model.add_disc(axis, a, b, M)
-                  
-            if not tmp_model.is_positive_definite:
-                  everything_dp = False
-                  break
-                  
-        if not everything_dp:
+        self.audit_positive_definite(samples)
+        if self.positive_fraction < 1.0:
             warnings.warn('Some sample results are not positive definite ! You can end up with negative densities.\n' +
                           'To ensure a positive definite model, consider setting the parameter "check_positive_definite" to True in the fitter !')
 
@@ -322,6 +1078,303 @@ class MNnFitter(object):
         self.lnprob  = lnprob
         return samples, lnprob
 
+    def _stream_chain(self, init_pos, ndim, chain_file, checkpoint_every, resume, control=None, monitor=None):
+        """ Runs the sampler, writing every step in ``chain_file`` and checkpointing its state, see :func:`~mnn.fitter.MNnFitter.fit_data`
+
+        Raises:
+            MNnError: If the chain file to resume does not match the fit, or has no checkpoint
+        """
+        n_blobs = len(self.axes) if self.solve_masses else 0
+        shape = (self.n_steps, self.n_walkers, ndim + 1 + n_blobs)
+        state_name = chain_file + checkpoint_suffix
+
+        if resume and os.path.exists(chain_file):
+            # Never overwrite a chain the user asked to resume
+            if not os.path.exists(state_name):
+                raise MNnError('The chain file {0} has no checkpoint {1} and cannot be resumed. Remove it, or set resume=False to '
+                               'overwrite it'.format(chain_file, state_name))
+            rows = np.lib.format.open_memmap(chain_file, mode='r+')
+            if rows.shape != shape:
+                raise MNnError('The chain file {0} has shape {1}, expected {2} for this fit'.format(chain_file, rows.shape, shape))
+            step, state = self._load_checkpoint(state_name)
+            if self.verbose:
+                print('Resuming from step {0}/{1}'.format(step, self.n_steps))
+        else:
+            rows = np.lib.format.open_memmap(chain_file, mode='w+', dtype=np.float64, shape=shape)
+            step, state = 0, emcee.State(np.array(init_pos), random_state=np.random.get_state())
+        self._chain_rows = rows
+        self._chain_steps = step
+
+        # The summary of the control plots starts with the steps already in the file
+        if control is not None and step > 0:
+            for i_step, models in enumerate(np.swapaxes(self._get_chain(), 0, 1)):
+                control.summary.update(i_step+1, models)
+
+        if step < self.n_steps:
+            for state in sampler.sample(state, iterations=self.n_steps-step, store=False):
+                rows[step, :, :ndim] = state.coords
+                rows[step, :, ndim] = state.log_prob
+                if n_blobs:
+                    rows[step, :, ndim+1:] = np.reshape(state.blobs, (self.n_walkers, n_blobs))
+                step += 1
+                self._chain_steps = step
+
+                stop = self._after_step(step, state, control, monitor)
+                if stop or step % checkpoint_every == 0 or step == self.n_steps:
+                    rows.flush()
+                    self._save_checkpoint(state_name, step, state)
+                if stop:
+                    break
+            if self.verbose:
+                print('')
+
+    def _after_step(self, step, state, control, monitor):
+        """ Reports the progress of the sampling after ``step`` steps : prints the step, updates the control plots with the
+        walkers of ``state`` and calls ``monitor(step)``, see :func:`~mnn.fitter.MNnFitter.fit_data`
+
+        Returns:
+            True if the sampling should stop
+        """
+        if self.verbose:
+            sys.stdout.write('\r  . Step : {0}/{1}'.format(step, self.n_steps))
+            sys.stdout.flush()
+
+        if control is not None:
+            models = state.coords
+            if self.solve_masses:
+                models = np.empty((self.n_walkers, len(self.axes), 3))
+                models[..., :2] = state.coords.reshape(self.n_walkers, -1, 2)
+                models[..., 2] = np.reshape(state.blobs, (self.n_walkers, -1))
+                models = models.reshape(self.n_walkers, self.ndim)
+            control.update(step, models)
+
+        return monitor is not None and monitor(step)
+
+    def _create_control_plotter(self, plot_ids, plot_freq):
+        """ Creates the :class:`~mnn.fitter.ControlPlotter` drawing the parameters of the discs ``plot_ids`` (every disc if
+        empty) in ``current_state.png`` every ``plot_freq`` steps """
+        if not plot_ids:
+            plot_ids = range(len(self.axes))
+        elif type(plot_ids) == int:
+            plot_ids = [plot_ids]
+
+        labels = []
+        for disc_id in plot_ids:
+            axis_name = {"x": "yz", "y": "xz", "z": "xy"}[self.axes[disc_id]]
+            labels.append([(disc_id*3+i, '$'+param_name+'_{{{0}{1}}}$'.format(axis_name, disc_id))
+                           for i, param_name in enumerate(['a', 'b', 'M'])])
+        return ControlPlotter(ChainSummary(self.n_walkers, self.ndim), labels, plot_freq)
+
+    def _check_convergence(self, step, check_every, n_tau, tau_tolerance):
+        """ Estimates the integrated autocorrelation times of the chain every ``check_every`` steps.
+
+        Args:
+            step (int): The number of steps done
+            check_every (int): Number of steps between two estimations
+            n_tau (float): Minimum length of the chain, in autocorrelation times
+            tau_tolerance (float): Maximum relative change of the autocorrelation times since the previous estimation
+
+        Returns:
+            True if the chain has converged, i.e. is longer than ``n_tau`` autocorrelation times and they are stable
+
+        Note:
+            The estimation works on a view of the steps stored so far, without copying the chain. If the masses are solved
+            for, only the sampled scales and heights are used : the masses are functions of them.
+        """
+        if step % check_every != 0:
+            return False
+
+        if self._chain_rows is not None:
+            n_sampled = 2*len(self.axes) if self.solve_masses else self.ndim
+            chain = self._chain_rows[:self._chain_steps, :, :n_sampled]
+        else:
+            chain = sampler.get_chain()
+        tau = emcee.autocorr.integrated_time(chain, tol=0)
+        previous, self._previous_tau = self._previous_tau, tau
+        if self.verbose:
+            print('\r  . Step : {0}/{1}, autocorrelation time : {2:.1f} ({3:.1f} times sampled)'.format(
+                step, self.n_steps, np.max(tau), step / np.max(tau)))
+
+        self.converged = bool(previous is not None and np.all(step > n_tau*tau) and
+                              np.all(np.abs(previous - tau) < tau_tolerance*tau))
+        return self.converged
+
+    @staticmethod
+    def _save_checkpoint(state_name, step, state):
+        """ Saves the number of steps done and the state of the sampler, and the global random generator, in ``state_name`` """
+        arrays = {'step': step, 'coords': state.coords, 'log_prob': state.log_prob}
+        if state.blobs is not None:
+            arrays['blobs'] = state.blobs
+        for name, random_state in (('sampler', state.random_state), ('global', np.random.get_state())):
+            arrays[name + '_keys'] = random_state[1]
+            arrays[name + '_position'] = random_state[2]
+            arrays[name + '_gauss'] = np.array(random_state[3:], dtype=np.float64)
+        _save_npz(state_name, **arrays)
+
+    @staticmethod
+    def _load_checkpoint(state_name):
+        """ Loads a checkpoint written by :func:`~mnn.fitter.MNnFitter._save_checkpoint` and restores the global random generator
+
+        Returns:
+            A tuple holding the number of steps done and the state of the sampler as an ``emcee.State``
+        """
+        with np.load(state_name) as archive:
+            random_states = {}
+            for name in ('sampler', 'global'):
+                gauss = archive[name + '_gauss']
+                random_states[name] = ('MT19937', archive[name + '_keys'], int(archive[name + '_position']), int(gauss[0]), float(gauss[1]))
+            blobs = archive['blobs'] if 'blobs' in archive.files else None
+            state = emcee.State(archive['coords'], log_prob=archive['log_prob'], blobs=blobs, random_state=random_states['sampler'])
+            step = int(archive['step'])
+        np.random.set_state(random_states['global'])
+        return step, state
+
+    def _create_pool(self):
+        """ Creates the pool evaluating the walkers, or returns None if they are evaluated in the current thread
+
+        With several processes, every worker receives a copy of the fitter once, when it starts. With several threads, a
+        thread pool is only needed if the walkers are evaluated one by one : the vectorized likelihood already uses the
+        threads to evaluate the models.
+        """
+        if self.n_processes > 1:
+            return Pool(self.n_processes, initializer=_initialize_worker, initargs=(self._worker_copy(),))
+        if self.n_threads > 1 and (self.solve_masses or not self._vectorized()):
+            return ThreadPool(self.n_threads)
+        return None
+
+    def _worker_copy(self):
+        """ Returns the copy of the fitter sent to the worker processes : it holds the compiled likelihood plan, which
+        carries its own copy of the data, but not the data table itself nor the results of previous fits, and evaluates the
+        models in a single thread """
+        worker = copy.copy(self)
+        worker.data = None
+        worker.yerr = None
+        worker.samples = None
+        worker.lnprob = None
+        worker.positive_mask = None
+        worker._chain_rows = None
+        worker.n_threads = 1
+        worker.n_processes = 1
+        return worker
+
+    def _vectorized(self):
+        """ Returns True if the walkers are evaluated at once by :func:`~mnn.fitter.MNnFitter.loglikelihood_vec` : the
+        likelihood must be vectorized and :func:`~mnn.fitter.MNnFitter.loglikelihood` must not be overridden by a subclass,
+        since the vectorized likelihood would not call it """
+        return self.vectorize and type(self).loglikelihood == MNnFitter.loglikelihood
+
+    def _create_sampler(self, ndim, pool):
+        """ Creates the ``emcee`` sampler, evaluating the walkers with ``pool`` if it is not None """
+        processes = pool is not None and self.n_processes > 1
+        if self.solve_masses:
+            # The masses are stored by emcee as the blobs of the walkers
+            function = _worker_loglikelihood_masses if processes else self.loglikelihood_masses
+            return emcee.EnsembleSampler(self.n_walkers, ndim, function, pool=pool)
+        elif self._vectorized():
+            if pool is None:
+                return emcee.EnsembleSampler(self.n_walkers, ndim, self.loglikelihood_vec, vectorize=True)
+            # The walkers of a step are split in one chunk per process, each chunk being evaluated at once
+            function = lambda walkers: np.concatenate(pool.map(_worker_loglikelihood_vec, np.array_split(walkers, self.n_processes)))
+            return emcee.EnsembleSampler(self.n_walkers, ndim, function, vectorize=True)
+        else:
+            function = _worker_loglikelihood if processes else self.loglikelihood
+            return emcee.EnsembleSampler(self.n_walkers, ndim, function, pool=pool)
+
+    def audit_positive_definite(self, samples=None, max_range=None, n_probes=32, n_workers=None):
+        """ Checks the positive-definiteness of many models at once
+
+        All the models are evaluated on the same probe points, sampling the symmetry planes of the discs (see
+        :func:`~mnn.model.MNnModel.sample_symmetry_planes`), by blocks of models through :func:`~mnn.model.MNnModel.evaluate_batch`.
+        Repeated samples, frequent in MCMC chains, are only evaluated once. The result is stored in ``MNnFitter.positive_mask``
+        and ``MNnFitter.positive_fraction``.
+
+        Args:
+            samples (numpy array): The (K, 3*n_discs) flattened models to check. If None, the samples of the last fit are used (default=None).
+            max_range (float or None): The extent of the probes. If None, ``cdp_range`` is used, or else ten times the largest ``a+b`` of the samples (default=None).
+            n_probes (int): Number of probes along each direction of a plane (default=32)
+            n_workers (int or None): Number of threads evaluating the models. If None, ``n_threads`` is used (default=None).
+
+        Returns:
+            A boolean numpy array of size K, true for the models with a positive density on every probe. If there are no models, the array is empty and the positive fraction is 1.
+
+        Raises:
+            MNnError: If there are no samples to check
+
+        Note:
+            The probes are not refined around the minimum of every model as in :func:`~mnn.model.MNnModel.find_density_minimum` :
+            a model passing the audit can still be slightly negative between the probes.
+        """
+        if samples is None:
+            samples = self.samples
+        if samples is None:
+            raise MNnError('There are no samples to check : call fit_data first or give the samples')
+        if n_workers is None:
+            n_workers = self.n_threads
+
+        # Nothing to evaluate, for instance if the burn-in covers the whole chain
+        if np.size(samples) == 0:
+            self.positive_mask = np.zeros(0, dtype=bool)
+            self.positive_fraction = 1.0
+            return self.positive_mask
+
+        models, inverse = np.unique(np.asarray(samples, dtype=np.float64).reshape(-1, self.ndim), axis=0, return_inverse=True)
+        params = models.reshape(models.shape[0], len(self.axes), 3)
+        if max_range is None:
+            max_range = self.cdp_range
+        if max_range is None:
+            max_range = 10.0*np.max(np.abs(params[:, :, 0]) + params[:, :, 1])
+
+        layout = self.make_model(np.ones(self.ndim))
+        points = MNnModel.sample_symmetry_planes(params[:, :, 0], params[:, :, 1], layout._axis_codes, max_range, n_probes)[0]
+        x, y, z = [np.ascontiguousarray(points[:, i].reshape(-1)) for i in range(3)]
+
+        # Blocks of models bounding the memory used by the densities
+        positive = np.empty(models.shape[0], dtype=bool)
+        block_size = max(1, likelihood_block_size // x.size)
+        values = None
+        for start in range(0, models.shape[0], block_size):
+            block = params[start:start+block_size]
+            if values is None or values.shape[0] != block.shape[0]:
+                values = np.empty((block.shape[0], x.size))
+            layout.evaluate_batch(block, x, y, z, 'density', n_workers=n_workers, out=values)
+            positive[start:start+block_size] = values.min(axis=1) >= 0.0
+
+        self.positive_mask = positive[inverse.reshape(-1)]
+        self.positive_fraction = self.positive_mask.mean() if self.positive_mask.size else 1.0
+        if self.verbose:
+            print('{0:.2f}% of the models are positive definite'.format(100.0*self.positive_fraction))
+        return self.positive_mask
+
+    def _get_chain(self):
+        """ Returns the chain of the sampler as a (n_walkers, n_steps, 3*n_discs) array of flattened models
+
+        The chain is read from the chain file if it was streamed. If the masses are solved for, they are taken from the
+        blobs of the sampler.
+        """
+        if self._chain_rows is not None:
+            rows = self._chain_rows[:self._chain_steps]
+            n_sampled = 2*len(self.axes) if self.solve_masses else self.ndim
+            chain = np.swapaxes(rows[:, :, :n_sampled], 0, 1)
+            blobs = rows[:, :, n_sampled+1:]
+        else:
+            chain = np.swapaxes(sampler.get_chain(), 0, 1)
+            blobs = sampler.get_blobs() if self.solve_masses else None
+        if not self.solve_masses:
+            return chain
+
+        n_walkers, n_steps = chain.shape[:2]
+        models = np.empty((n_walkers, n_steps, len(self.axes), 3))
+        models[..., :2] = chain.reshape(n_walkers, n_steps, -1, 2)
+        models[..., 2] = np.swapaxes(blobs.reshape(n_steps, n_walkers, -1), 0, 1)
+        return models.reshape(n_walkers, n_steps, self.ndim)
+
+    def _get_lnprobability(self):
+        """ Returns the loglikelihoods of the chain as a (n_walkers, n_steps) array """
+        if self._chain_rows is not None:
+            n_sampled = 2*len(self.axes) if self.solve_masses else self.ndim
+            return np.swapaxes(self._chain_rows[:self._chain_steps, :, n_sampled], 0, 1)
+        return np.swapaxes(sampler.get_log_prob(), 0, 1)
+
     def plot_disc_walkers(self, id_discs=None):
         """ Plotting the walkers on each parameter of a certain disc.
 
@@ -349,12 +1402,13 @@ class MNnFitter(object):
                 ax.ticklabel_format(style='sci', axis='y', scilimits=(0,0)) 
         
                 
+        chain = self._get_chain()
         for disc_id in id_discs:
             axis_name = {"x": "yz", "y": "xz", "z": "xy"}[self.axes[disc_id]]
             param_name = ['a', 'b', 'M']
             for i in range(3):
                 pid = disc_id*3+i
-                samples = sampler.chain[:,:,pid].T
+                samples = chain[:,:,pid].T
                 if nplots > 1:
                     axis = axes[disc_id][i]
                 else:
@@ -1,10 +1,45 @@
 from __future__ import print_function
-import scipy.optimize as op
 import numpy as np
 import warnings
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-# Helper
-is_array = lambda x: isinstance(x, np.ndarray)
+# Axis codes used by the array storage of the models : discs are stored with an integer code
+# instead of the axis name so they can be grouped and evaluated together.
+axis_names = ('x', 'y', 'z')
+axis_codes = {'x': 0, 'y': 1, 'z': 2}
+
+# For each axis code, the cartesian components corresponding to the tangent/normal coordinates (t1, t2, n)
+# as defined in MNnModel.get_tangent_coordinates
+tangent_components = ((1, 2, 0), (0, 2, 1), (0, 1, 2))
+
+# Quantities that can be evaluated on a model
+quantity_names = ('density', 'potential', 'force')
+
+# Minimum number of points evaluated by a thread when the evaluation is split between several workers
+min_block_size = 4096
+
+# Floating point types the models can be evaluated in
+float_dtypes = (np.dtype(np.float32), np.dtype(np.float64))
+
+# Number of (n_discs x n_points) work arrays used by the evaluation kernel (see MNnModel._evaluate_group)
+n_work_arrays = 6
+
+# Number of n_points work vectors used by the evaluation kernel : the squared radius of the points, the sum over the discs
+# and the two force coefficients
+n_work_vectors = 4
+
+cache_block_memory = 2**21
+"""int: Size, in bytes, of the temporaries of a block of points when no memory budget is set. The points are still evaluated by
+blocks, sized so that the temporaries stay in the processor caches, which is several times faster than evaluating all the points at once."""
+
+symmetry_tolerance = 1e-12
+"""float: Relative tolerance under which two coordinates (or two cylindrical radii) are considered equal when the symmetries
+of the model are used to avoid evaluating it several times on equivalent points. The tolerance is relative to the largest
+coordinate (or radius) of the set of points."""
 
 class MNnError(Exception):
     """ 
@@ -27,16 +62,41 @@ class MNnModel(object):
     Miyamoto-Nagai negative model.
     This object is a potential-density pair expansion : it consists of a sum of Miyamoto-Nagai dics allowing 
     """
-    def __init__(self, diz=1.0):
+    def __init__(self, diz=1.0, max_memory=None, n_workers=1, dtype=np.float64):
         """ Constructor for the summed Miyamoto-Nagai-negative model
 
         Args:
             diz (float): Normalization factor applied to all the discs (default = 1.0)
+            max_memory (int or None): Memory budget, in bytes, for the temporaries used when evaluating the model (default = None).
+                Whatever the budget, the points are evaluated by blocks so that the peak memory does not depend on the number of points.
+                If None, the blocks are sized for the processor caches (see :data:`mnn.model.cache_block_memory`) but the other large
+                arrays, such as the full coordinates of a meshgrid, are allocated at once. Can be overriden in every ``evaluate_*`` call.
+            n_workers (int): Number of threads used to evaluate large sets of points (default = 1). The points are split in blocks
+                evaluated in parallel, numpy releasing the GIL in the kernels. Can be overriden in the vectorized evaluation methods.
+            dtype (numpy dtype): Floating point type, ``np.float32`` or ``np.float64``, of the evaluations (default = np.float64).
+                The coordinates, the intermediate terms and the accumulators are all kept in this type. Can be overriden in every ``evaluate_*`` call.
+
+        Raises:
+            :class:`mnn.model.MNnError`: If ``dtype`` is not a supported floating point type
+
+        Note:
+            Evaluating in ``np.float32`` halves the memory traffic and the size of the temporaries. Every disc term is then computed with
+            a relative error of a few ``2**-24`` (about 1e-7) : compared to the ``np.float64`` path, the density, the potential and the force
+            typically have a pointwise relative error of 1e-7, and below 2e-6 for usual models. The error of a sum grows with
+            ``sum(|term_i|) / |sum(term_i)|`` though : when the negative mass discs nearly cancel out the positive ones, for instance in the
+            low density regions of a fitted model, digits are lost accordingly. The ``np.float64`` path should be used for fitting.
         """
-        # The discs and fit description
-        self.discs = []
-        self.axes = []
+        # The discs and fit description. Every parameter is stored in a contiguous array, in the order
+        # the discs were added. The discs are regrouped by axis at evaluation time (see _get_axis_groups)
+        self._a = np.empty(0)
+        self._b = np.empty(0)
+        self._M = np.empty(0)
+        self._axis_codes = np.empty(0, dtype=np.int8)
+        self._axis_groups = None
         self.diz = diz
+        self.max_memory = max_memory
+        self.n_workers = n_workers
+        self.dtype = self._check_dtype(dtype)
 
         # The data the model is fitting
         self.data = None
@@ -50,15 +110,14 @@ class MNnModel(object):
            model (Numpy array): A Nx3 numpy array holding the model.
            axes (tuple): A tuple indicating along which axis each disc is aligned
         """
-        for m, ax in zip(model, axes):
-            a, b, M = m
-            self.add_disc(ax, a, b, M)
+        model = np.asarray(model, dtype=np.float64).reshape(-1, 3)
+        self._append_discs(axes, model[:, 0], model[:, 1], model[:, 2])
 
     def add_disc(self, axis, a, b, M):
         """ Adds a Miyamoto-Nagai negative disc to the model, this disc will be included in the summation process when evaluating quantities with the model.
 
-        A disc is a list of three parameters *a*, *b* and *M*. All the parameters of the discs are stored in a flat list with no real separation. 
-        This is done so that emcee can be fed the array directly without any transformation.
+        A disc is a list of three parameters *a*, *b* and *M*. The parameters of the discs are stored in contiguous numpy arrays, one per parameter,
+        and the discs sharing the same axis are evaluated together. The flat list (a1, b1, M1, a2, ...) is still available through ``discs``.
 
         The model accounts for negative values of ``a``. The constraints on the parameters are the following :
 
@@ -81,15 +140,7 @@ class MNnModel(object):
             >>> m = MNnModel()
             >>> m.add_disc('z', 1.0, 0.1, 10.0)
         """
-        if b<0:
-            raise MNnError('The height of a disc cannot be negative (b={0})'.format(b))
-        #elif M<0:
-        #    raise MNnError('The mass of a disc cannot be negative (M={0})'.format(M))
-        elif a+b<0:
-            print('Warning : The sum of the scale and height of the disc is negative (a={0}, b={1})'.format(a,b)) 
-
-        self.discs += [a, b, M]
-        self.axes.append(axis)
+        self._append_discs([axis], [a], [b], [M])
 
     def add_discs(self, values):
         """ Wrapper for the :func:`~mnn.model.MNnModel.add_disc` method to add multiple MNn discs at the same time.
@@ -107,8 +158,82 @@ class MNnModel(object):
             >>> m = MNnModel()
             >>> m.add_discs([('z', 1.0, 0.1, 50.0), ('x', 1.0, 0.5, 10.0)])
         """
-        for axis, a, b, M in values:
-            self.add_disc(axis, a, b, M)
+        values = list(values)
+        if len(values) == 0:
+            return
+
+        axes, a, b, M = zip(*values)
+        self._append_discs(axes, a, b, M)
+
+    def _append_discs(self, axes, a, b, M):
+        """ Checks the constraints on a set of discs and appends them, in bulk, to the parameter arrays of the model.
+
+        Args:
+            axes (sequence of {'x', 'y', 'z'}): the normal axis of each disc
+            a, b, M (sequences of floats): the scale, height and mass of each disc
+
+        Raises:
+            :class:`mnn.model.MNnError` : if one of the constraints if not satisfied
+        """
+        a = np.asarray(a, dtype=np.float64).reshape(-1)
+        b = np.asarray(b, dtype=np.float64).reshape(-1)
+        M = np.asarray(M, dtype=np.float64).reshape(-1)
+        if not (len(axes) == a.shape[0] == b.shape[0] == M.shape[0]):
+            raise MNnError('Inconsistent number of axes and disc parameters')
+
+        for axis in axes:
+            if axis not in axis_codes:
+                raise MNnError('Unknown axis {0}, possible values are {1}'.format(axis, axis_names))
+
+        for a_d, b_d in zip(a, b):
+            if b_d<0:
+                raise MNnError('The height of a disc cannot be negative (b={0})'.format(b_d))
+            elif a_d+b_d<0:
+                print('Warning : The sum of the scale and height of the disc is negative (a={0}, b={1})'.format(a_d,b_d))
+
+        self._a = np.concatenate((self._a, a))
+        self._b = np.concatenate((self._b, b))
+        self._M = np.concatenate((self._M, M))
+        self._axis_codes = np.concatenate((self._axis_codes, [axis_codes[axis] for axis in axes])).astype(np.int8)
+        self._axis_groups = None
+
+    def _get_axis_groups(self, dtype=np.float64):
+        """ Returns the discs of the model grouped by axis.
+
+        The groups are cached, for every floating point type, until the next disc is added to the model.
+
+        Args:
+            dtype (numpy dtype): The floating point type of the parameters (default = np.float64)
+
+        Returns:
+            A list of 4-tuples ``(axis_code, a, b, M)`` where ``a``, ``b`` and ``M`` are contiguous arrays holding the
+            parameters of all the discs sharing the normal axis ``axis_names[axis_code]``. Empty groups are skipped.
+        """
+        if self._axis_groups is None:
+            self._axis_groups = {}
+
+        dtype = np.dtype(dtype)
+        if dtype not in self._axis_groups:
+            groups = []
+            for code in range(3):
+                mask = (self._axis_codes == code)
+                if mask.any():
+                    groups.append((code,
+                                   np.ascontiguousarray(self._a[mask], dtype=dtype),
+                                   np.ascontiguousarray(self._b[mask], dtype=dtype),
+                                   np.ascontiguousarray(self._M[mask], dtype=dtype)))
+            self._axis_groups[dtype] = groups
+        return self._axis_groups[dtype]
+
+    @property
+    def discs(self):
+        """ list: The parameters of the discs as a flat list (a1, b1, M1, a2, b2, ...) """
+        return np.column_stack((self._a, self._b, self._M)).reshape(-1).tolist()
+
+    @property
+    def axes(self):
+        """ list: The normal axis of every disc of the model """
+        return [axis_names[code] for code in self._axis_codes]
 
     def get_model(self):
         """ Copies the discs currently stored and returns them as a list of 4-tuples [(axis1, a1, b1, M1), (axis2, a2, b2, ...), ... ]
@@ -122,10 +247,7 @@ class MNnModel(object):
             >>> m.get_model()
             [('z', 1.0, 0.1, 50.0), ('x', 1.0, 0.5, 10.0)]
         """
-        res = []
-        for id_axis, axis in enumerate(self.axes):
-            res += [tuple([axis] + self.discs[id_axis*3:(id_axis+1)*3])]
-        return res
+        return list(zip(self.axes, self._a.tolist(), self._b.tolist(), self._M.tolist()))
 
     @staticmethod
     def callback_from_string(quantity):
@@ -197,13 +319,14 @@ class MNnModel(object):
         Note:
             This method does **not** check the validity of the constraints ``b>=0``, ``M>=0``, ``a+b>=0``
         """
-        h = np.sqrt((z**2.0)+(b**2.0))
-        fac = (b**2)*M/(4.0*np.pi)
-        ah2 = (a+h)**2.0
-        ar2 = a*(r**2.0)
+        h = np.sqrt(z*z + b*b)
+        fac = b*b*M/(4.0*np.pi)
+        ah2 = (a+h)*(a+h)
+        r2 = r*r
         a3h = a+3.0*h
-        num = ar2+(a3h*ah2)
-        den = (h**3.0)*((r**2)+ah2)**2.5
+        num = a*r2+(a3h*ah2)
+        d = r2+ah2
+        den = h*h*h*d*d*np.sqrt(d)
         return fac*num/den
 
     @staticmethod
@@ -229,12 +352,75 @@ class MNnModel(object):
         """
         #M1 = np.abs(M)
         M1 = M
-        h = np.sqrt(z**2 + b**2)
-        den = r**2 + (a + h)**2
+        h = np.sqrt(z*z + b*b)
+        den = r*r + (a + h)*(a + h)
         return -G*M1 / np.sqrt(den)
 
     @staticmethod
-    def mn_force(t1, t2, n, a, b, M, axis):
+    def mn_density_jacobian(r, z, a, b, M):
+        """ Evaluates the derivatives of the density of a single Miyamoto-Nagai negative disc (a, b, M) at polar coordinates (r, z)
+        with respect to its parameters.
+
+        Args:
+            r (float): radius of the point where the derivatives are evaluated
+            z (float): height of the point where the derivatives are evaluated
+            a (float): disc scale
+            b (float): disc height
+            M (float): disc mass
+
+        Returns:
+            A tuple of *floats* ``(drho/da, drho/db, drho/dM)`` at (r, z)
+
+        Note:
+            This method does **not** check the validity of the constraints ``b>0``, ``M>=0``, ``a+b>=0``. The derivatives are
+            not defined for ``b=0``.
+        """
+        h = np.sqrt(z*z + b*b)
+        ah = a+h
+        ah2 = ah*ah
+        r2 = r*r
+        a3h = a+3.0*h
+        num = a*r2+(a3h*ah2)
+        d = r2+ah2
+        base = 1.0/(4.0*np.pi*h*h*h*d*d*np.sqrt(d))
+
+        dM = b*b*num*base
+        num_a = r2 + ah2 + 2.0*a3h*ah
+        da = M*b*b*base*(num_a - 5.0*num*ah/d)
+        num_b = (b/h)*(3.0*ah2 + 2.0*ah*a3h)
+        db = M*b*base*(2.0*num + b*num_b - 5.0*b*b*num*ah/(h*d) - 3.0*b*b*num/(h*h))
+        return da, db, dM
+
+    @staticmethod
+    def mn_potential_jacobian(r, z, a, b, M):
+        """ Evaluates the derivatives of the potential of a single Miyamoto-Nagai negative disc (a, b, M) at polar coordinates (r, z)
+        with respect to its parameters.
+
+        Args:
+            r (float): radius of the point where the derivatives are evaluated
+            z (float): height of the point where the derivatives are evaluated
+            a (float): disc scale
+            b (float): disc height
+            M (float): disc mass
+
+        Returns:
+            A tuple of *floats* ``(dphi/da, dphi/db, dphi/dM)`` at (r, z)
+
+        Note:
+            This method does **not** check the validity of the constraints ``b>0``, ``M>=0``, ``a+b>=0``. The derivatives are
+            not defined for ``b=0``.
+        """
+        h = np.sqrt(z*z + b*b)
+        ah = a+h
+        isd = 1.0/np.sqrt(r*r + ah*ah)
+
+        dM = -G*isd
+        da = G*M*ah*isd*isd*isd
+        db = da*b/h
+        return da, db, dM
+
+    @staticmethod
+    def mn_force(t1, t2, n, a, b, M, axis, out=None):
         """ Evaluates the force of a single Miyamoto-Nagai negative disc (a, b, M) at a set of tangent/radial coordinates.
 
         Args:
@@ -245,6 +431,7 @@ class MNnModel(object):
             b (float): disc height
             Mo (float): disc mass
             axis ({'x', 'y', 'z'}): the normal axis of the disc
+            out (numpy array or None): Preallocated array in which the result is written (default = None)
         
         Returns:
            *numpy array* : the force applied at point (r, z) relative to the disc in cartesian coordinates.
@@ -266,52 +453,41 @@ class MNnModel(object):
             
         """
         num = -G * M
-        R2 = t1**2 + t2**2
-        f1 = np.sqrt(b**2 + n**2)
-        f2 = (a + f1)**2
-        den = (R2 + f2)**1.5
-        q1 = num / den
-        f3 = np.sqrt(n**2 + b**2)
-        q2 = (a + f3) / f3
-
-        # Checking dimension consistency between operands
-        at1 = is_array(t1)
-        at2 = is_array(t2)
-        at3 = is_array(n)
-        
-        if any((at1, at2, at3)):
-            if at1:
-                Nv = t1.shape[0]
-            elif at2:
-                Nv = t2.shape[0]
-            else:
-                Nv = n.shape[0]
-            
-            if not at1:
-                t1 = np.asarray([t1]*Nv)
-            if not at2:
-                t2 = np.asarray([t2]*Nv)
-            if not at3:
-                n = np.asarray([n]*Nv)
+        R2 = t1*t1 + t2*t2
+        h = np.sqrt(b*b + n*n)
+        d = R2 + (a + h)*(a + h)
+        q1 = num / (d*np.sqrt(d))
+        q2 = (a + h) / h
 
         # Ordering the result according to the axis so that the coordinates of the disc transforms
-        # correctly into cartesian coordinates.
-        if axis == 'x':
-            res = q1 * np.asarray((n*q2, t1, t2))
-        elif axis == 'y':
-            res = q1 * np.asarray((t1, n*q2, t2))
-        else:
-            res = q1 * np.asarray((t1, t2, n*q2))
-
-        return res.T
+        # correctly into cartesian coordinates. Scalar coordinates are broadcast, not replicated.
+        i1, i2, i_n = tangent_components[axis_codes[axis]]
+        components = [None]*3
+        components[i1] = q1*t1
+        components[i2] = q1*t2
+        components[i_n] = q1*q2*n
+        components = np.broadcast_arrays(*components)
+
+        # The components are on the last dimension of a C-contiguous result, the point dimensions being reversed
+        shape = components[0].shape
+        if out is None:
+            out = np.empty(shape[::-1] + (3,), dtype=components[0].dtype)
+        for i, component in enumerate(components):
+            out[..., i] = component.T
+
+        return out
         
 
     # Point evaluation
-    def evaluate_potential(self, x, y, z):
+    def evaluate_potential(self, x, y, z, max_memory=None, dtype=None, out=None, scratch=None):
         """ Evaluates the summed potential over all discs at specific positions 
         
         Args:
             x, y, z (float or Nx1 numpy array): Cartesian coordinates of the point(s) to evaluate
+            max_memory (int or None): Memory budget in bytes for the evaluation. If None, the budget of the model is used.
+            dtype (numpy dtype or None): Floating point type of the evaluation. If None, the type of ``out`` if it is given, or else the type of the model, is used.
+            out (numpy array or None): Preallocated array, with the shape of the result, in which the result is written (default = None)
+            scratch (numpy array or None): Work array reused by the evaluation kernel (see :func:`~mnn.model.MNnModel.allocate_scratch`) (default = None)
            
         Returns:
             The summed potential over all discs at position ``(x, y, z)``.
@@ -320,14 +496,18 @@ class MNnModel(object):
             If ``x``, ``y`` and ``z`` are numpy arrays, then the return value is a Nx1 value of the potential evaluated 
             at every point ``(x[i], y[i], z[i])``
         """
-        return self._evaluate_scalar_quantity(x, y, z, MNnModel.mn_potential)
+        return self.evaluate_all(x, y, z, ('potential',), max_memory, dtype=dtype, out=None if out is None else (out,), scratch=scratch)[0]
 
     
-    def evaluate_density(self, x, y, z):
+    def evaluate_density(self, x, y, z, max_memory=None, dtype=None, out=None, scratch=None):
         """ Evaluates the summed density over all discs at specific positions 
         
         Args:
             x, y, z (float or Nx1 numpy array): Cartesian coordinates of the point(s) to evaluate
+            max_memory (int or None): Memory budget in bytes for the evaluation. If None, the budget of the model is used.
+            dtype (numpy dtype or None): Floating point type of the evaluation. If None, the type of ``out`` if it is given, or else the type of the model, is used.
+            out (numpy array or None): Preallocated array, with the shape of the result, in which the result is written (default = None)
+            scratch (numpy array or None): Work array reused by the evaluation kernel (see :func:`~mnn.model.MNnModel.allocate_scratch`) (default = None)
            
         Returns:
             The summed density over all discs at position ``(x, y, z)``.
@@ -336,13 +516,17 @@ class MNnModel(object):
             If ``x``, ``y`` and ``z`` are numpy arrays, then the return value is a Nx1 vector of the evaluated potential 
             at every point ``(x[i], y[i], z[i])``
         """
-        return self._evaluate_scalar_quantity(x, y, z, MNnModel.mn_density)
+        return self.evaluate_all(x, y, z, ('density',), max_memory, dtype=dtype, out=None if out is None else (out,), scratch=scratch)[0]
 
-    def evaluate_force(self, x, y, z):
+    def evaluate_force(self, x, y, z, max_memory=None, dtype=None, out=None, scratch=None):
         """ Evaluates the summed force over all discs at specific positions 
         
         Args:
             x, y, z (float or Nx1 numpy array): Cartesian coordinates of the point(s) to evaluate
+            max_memory (int or None): Memory budget in bytes for the evaluation. If None, the budget of the model is used.
+            dtype (numpy dtype or None): Floating point type of the evaluation. If None, the type of ``out`` if it is given, or else the type of the model, is used.
+            out (numpy array or None): Preallocated array, with the shape of the result, in which the result is written (default = None)
+            scratch (numpy array or None): Work array reused by the evaluation kernel (see :func:`~mnn.model.MNnModel.allocate_scratch`) (default = None)
            
         Returns:
             The summed force over all discs at position ``(x, y, z)``.
@@ -351,103 +535,562 @@ class MNnModel(object):
             If ``x``, ``y`` and ``z`` are numpy arrays, then the return value is a Nx3 vector of the evaluated potential 
             at every point ``(x[i], y[i], z[i])``
         """
+        return self.evaluate_all(x, y, z, ('force',), max_memory, dtype=dtype, out=None if out is None else (out,), scratch=scratch)[0]
 
-        # This is not relying on evaluate_scalar_quantity since the result is a vector and the function signature is not
-        # exactly the same. It is therefore better to have a separate definition instead of adding exceptional cases in the
-        # evaluate_scalar_quantity method.
-
-        # Storing the first value directly as the output variable.
-        # This allows us to avoid testing for scalar or vector
-        # while initializing the total_sum variable
-        a, b, M = self.discs[0:3]
-        axis = self.axes[0]
-        t1, t2, n = self.get_tangent_coordinates(x, y, z, axis)
-        total_sum = self.mn_force(t1, t2, n, a, b, M, axis)
-
-        id_mod = 1
-        for axis in self.axes[1:]:
-            a, b, M = self.discs[id_mod*3:(id_mod+1)*3]
-            t1, t2, n = self.get_tangent_coordinates(x, y, z, axis)
-            total_sum += self.mn_force(t1, t2, n, a, b, M, axis)
-            id_mod += 1
-            
-        return total_sum
+    def evaluate_all(self, x, y, z, quantities=quantity_names, max_memory=None, n_workers=None, dtype=None, out=None, scratch=None):
+        """ Evaluates several summed quantities over all discs in a single pass.
+
+        The terms shared by the density, the potential and the force of a disc (height term, cylindrical radius and
+        distance term) are only computed once per disc, whatever the number of quantities requested.
+
+        Args:
+            x, y, z (float or Nx1 numpy array): Cartesian coordinates of the point(s) to evaluate
+            quantities (tuple of {'density', 'potential', 'force'}): The quantities to evaluate (default = all of them)
+            max_memory (int or None): Memory budget in bytes for the evaluation. If None, the budget of the model is used.
+            n_workers (int or None): Number of threads used for the evaluation. If None, the value of the model is used.
+            dtype (numpy dtype or None): Floating point type of the evaluation. If None, the type of ``out`` if it is given, or else the type of the model, is used.
+            out (tuple of numpy arrays or None): Preallocated arrays, one per quantity and with the shape of the results, in which the results are written (default = None)
+            scratch (numpy array or None): Work array reused by the evaluation kernel (see :func:`~mnn.model.MNnModel.allocate_scratch`) (default = None)
+
+        Returns:
+            A tuple holding the summed quantities in the order they were requested. Each value has the same form as 
+            the result of the corresponding ``evaluate_*`` method. If ``out`` is given, the arrays of ``out`` are returned.
+
+        Raises:
+            :class:`mnn.model.MNnError`: If one of the quantities does not correspond to anything known, if ``dtype`` is not supported
+                or if the arrays of ``out`` do not match the results
+
+        Example:
+            Getting the potential and the force of a model on the same particles :
+
+            >>> m = MNnModel()
+            >>> m.add_discs([('z', 1.0, 0.1, 50.0), ('x', 1.0, 0.5, 10.0)])
+            >>> pot, force = m.evaluate_all(x, y, z, ('potential', 'force'))
+        """
+        quantities = self._check_quantities(quantities)
+        x, y, z = np.broadcast_arrays(x, y, z)
+        shape = x.shape
+
+        if out is None:
+            outs = self._allocate_outputs(x.size, quantities, self._get_dtype(dtype))
+            self._evaluate_points(x, y, z, outs, max_memory, n_workers=n_workers, scratch=scratch)
+            return tuple(self._reshape_output(outs[q], shape, q) for q in quantities)
+
+        out = tuple(out)
+        if len(out) != len(quantities):
+            raise MNnError('{0} output arrays given for {1} quantities'.format(len(out), len(quantities)))
+        for o in out:
+            if dtype is not None and o.dtype != self._check_dtype(dtype):
+                raise MNnError('The output array has dtype {0}, expected {1}'.format(o.dtype, np.dtype(dtype)))
+
+        outs = dict((q, self._flat_output(o, shape, q)) for q, o in zip(quantities, out))
+        self._evaluate_points(x, y, z, outs, max_memory, True, n_workers, scratch)
+        return out
 
     # Vector eval
-    def evaluate_density_vec(self, x):
+    def evaluate_density_vec(self, x, out=None, max_memory=None, n_workers=None, mirror=False, dtype=None, scratch=None):
         """ Returns the summed density of all the discs at specific points.
 
         Args:
             x (Nx3 numpy array): Cartesian coordinates of the point(s) to evaluate
+            out (numpy array or None): Preallocated array (or ``np.memmap``) of shape (N,) in which the result is written (default = None)
+            max_memory (int or None): Memory budget in bytes for the evaluation. If None, the budget of the model is used.
+            n_workers (int or None): Number of threads used for the evaluation. If None, the value of the model is used.
+            mirror (bool): If True, the points are folded in the positive octant and points equivalent by reflection are only evaluated once (default = False).
+            dtype (numpy dtype or None): Floating point type of the evaluation. If None, the type of ``out`` if it is given, or else the type of the model, is used.
+            scratch (numpy array or None): Work array reused by the evaluation kernel (see :func:`~mnn.model.MNnModel.allocate_scratch`) (default = None)
            
         Returns:
-            The summed density over all discs at every position in vector ``x``.
+            The summed density over all discs at every position in vector ``x``. If ``out`` is given, ``out`` is returned.
         """
-        return self._evaluate_scalar_quantity(x[:,0], x[:,1], x[:,2], MNnModel.mn_density)
+        return self._evaluate_vec(x, 'density', out, max_memory, n_workers, mirror, dtype, scratch)
     
-    def evaluate_potential_vec(self, x):
+    def evaluate_potential_vec(self, x, out=None, max_memory=None, n_workers=None, mirror=False, dtype=None, scratch=None):
         """ Returns the summed potential of all the discs at specific points.
 
         Args:
             x (Nx3 numpy array): Cartesian coordinates of the point(s) to evaluate
+            out (numpy array or None): Preallocated array (or ``np.memmap``) of shape (N,) in which the result is written (default = None)
+            max_memory (int or None): Memory budget in bytes for the evaluation. If None, the budget of the model is used.
+            n_workers (int or None): Number of threads used for the evaluation. If None, the value of the model is used.
+            mirror (bool): If True, the points are folded in the positive octant and points equivalent by reflection are only evaluated once (default = False).
+            dtype (numpy dtype or None): Floating point type of the evaluation. If None, the type of ``out`` if it is given, or else the type of the model, is used.
+            scratch (numpy array or None): Work array reused by the evaluation kernel (see :func:`~mnn.model.MNnModel.allocate_scratch`) (default = None)
            
         Returns:
-            The summed potential over all discs at every position in vector ``x``.
+            The summed potential over all discs at every position in vector ``x``. If ``out`` is given, ``out`` is returned.
         """
-        return self._evaluate_scalar_quantity(x[:,0], x[:,1], x[:,2], MNnModel.mn_potential)
+        return self._evaluate_vec(x, 'potential', out, max_memory, n_workers, mirror, dtype, scratch)
 
-    def evaluate_force_vec(self, x):
+    def evaluate_force_vec(self, x, out=None, max_memory=None, n_workers=None, mirror=False, dtype=None, scratch=None):
         """ Returns the summed force of all the discs at specific points.
 
         Args:
             x (Nx3 numpy array): Cartesian coordinates of the point(s) to evaluate
+            out (numpy array or None): Preallocated array (or ``np.memmap``) of shape (N, 3) in which the result is written (default = None)
+            max_memory (int or None): Memory budget in bytes for the evaluation. If None, the budget of the model is used.
+            n_workers (int or None): Number of threads used for the evaluation. If None, the value of the model is used.
+            mirror (bool): If True, the points are folded in the positive octant and points equivalent by reflection are only evaluated once (default = False).
+            dtype (numpy dtype or None): Floating point type of the evaluation. If None, the type of ``out`` if it is given, or else the type of the model, is used.
+            scratch (numpy array or None): Work array reused by the evaluation kernel (see :func:`~mnn.model.MNnModel.allocate_scratch`) (default = None)
            
         Returns:
-            The summed force over all discs at every position in vector ``x``.
+            The summed force over all discs at every position in vector ``x``. If ``out`` is given, ``out`` is returned.
         """
-        return self.evaluate_force(x[:,0], x[:,1], x[:,2])
+        return self._evaluate_vec(x, 'force', out, max_memory, n_workers, mirror, dtype, scratch)
     
 
+    def _evaluate_vec(self, x, quantity, out, max_memory, n_workers, mirror=False, dtype=None, scratch=None):
+        """ Evaluates a single quantity on a Nx3 array of points, optionally writing into a preallocated output """
+        if out is not None and dtype is not None and out.dtype != self._check_dtype(dtype):
+            raise MNnError('The output array has dtype {0}, expected {1}'.format(out.dtype, np.dtype(dtype)))
+
+        if mirror:
+            return self._evaluate_vec_mirror(x, quantity, out, max_memory, n_workers, dtype, scratch)
+
+        if out is None:
+            return self.evaluate_all(x[:,0], x[:,1], x[:,2], (quantity,), max_memory, n_workers, dtype, scratch=scratch)[0]
+
+        self._evaluate_points(x[:,0], x[:,1], x[:,2], {quantity: self._flat_output(out, x.shape[:1], quantity)},
+                              max_memory, True, n_workers, scratch)
+        return out
+
+    def _evaluate_vec_mirror(self, x, quantity, out, max_memory, n_workers, dtype=None, scratch=None):
+        """ Evaluates a single quantity on a Nx3 array of points using the mirror symmetries of the model.
+
+        Every MNn disc is symmetric with respect to its own plane and to the planes containing its axis, so a sum of discs aligned on
+        the x, y and z axes is symmetric under x->-x, y->-y and z->-z. The points are folded in the positive octant, the distinct folded
+        points (up to :data:`mnn.model.symmetry_tolerance`) are evaluated once and the result is mapped back to the original points.
+        The components of the force change sign with the corresponding coordinate.
+        """
+        folded = np.abs(x)
+        scale = symmetry_tolerance * max(folded.max() if folded.size else 0.0, np.finfo(np.float64).tiny)
+        _, index, inverse = np.unique(np.round(folded / scale), axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        if dtype is None and out is not None:
+            dtype = out.dtype
+        values = self._evaluate_vec(folded[index], quantity, None, max_memory, n_workers, dtype=self._get_dtype(dtype), scratch=scratch)
+        if out is None:
+            out = values[inverse]
+        else:
+            self._flat_output(out, x.shape[:1], quantity)[...] = values[inverse]
+
+        if quantity == 'force':
+            out *= np.sign(x)
+        return out
+
+    def evaluate_batch(self, params, x, y, z, quantity='density', max_memory=None, n_workers=None, dtype=None, out=None):
+        """ Evaluates a quantity for K sets of parameters sharing the axis layout of the model, on the same points.
+
+        The discs of every parameter set have the axes of the discs of this model, in the same order : only the values of the
+        parameters change. All the parameter sets are evaluated in a single broadcast computation, by blocks of parameter sets
+        and of points sized to fit the memory budget, without building any intermediate model.
+
+        Args:
+            params (numpy array): The parameters, as a (K, n_discs, 3) array of ``(a, b, M)`` or a (K, 3*n_discs) array of flat parameter vectors (a1, b1, M1, a2, ...)
+            x, y, z (float or N numpy arrays): Cartesian coordinates of the points to evaluate
+            quantity ({'density', 'potential', 'force'}): The quantity to evaluate (default = 'density')
+            max_memory (int or None): Memory budget in bytes for the temporaries. If None, the budget of the model is used.
+            n_workers (int or None): Number of threads evaluating the blocks. If None, the value of the model is used.
+            dtype (numpy dtype or None): Floating point type of the evaluation. If None, the type of ``out`` if it is given, or else the type of the model, is used.
+            out (numpy array or None): Preallocated array, with the shape of the result, in which the result is written (default = None)
+
+        Returns:
+            A (K, N) numpy array holding the quantity for every parameter set at every point, or a (K, N, 3) array for the force.
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the parameters do not match the discs of the model, or if the quantity or the output are invalid
+
+        Note:
+            The parameters are not checked : the constraints ``b>=0`` and ``a+b>=0`` are the responsibility of the caller.
+
+        Example:
+            Evaluating the density of the walkers of an ensemble on the points of a dataset :
+
+            >>> layout = MNnModel()
+            >>> layout.add_discs([('z', 1.0, 0.5, 1.0), ('z', 1.0, 0.5, 1.0)])
+            >>> densities = layout.evaluate_batch(walkers, x, y, z, 'density')
+        """
+        quantity = self._check_quantities(quantity)
+        if len(quantity) != 1:
+            raise MNnError('evaluate_batch evaluates a single quantity at a time')
+        quantity = quantity[0]
+
+        n_discs = self._axis_codes.size
+        params = np.asarray(params)
+        if params.ndim == 2 and params.shape[1] == 3*n_discs:
+            params = params.reshape(params.shape[0], n_discs, 3)
+        if params.ndim != 3 or params.shape[1:] != (n_discs, 3):
+            raise MNnError('The parameters have shape {0}, expected (K, {1}, 3) or (K, {2})'.format(params.shape, n_discs, 3*n_discs))
+        n_models = params.shape[0]
+
+        if dtype is None and out is not None:
+            dtype = out.dtype
+        dtype = self._get_dtype(dtype)
+        coords = [np.ascontiguousarray(c, dtype=dtype).reshape(-1) for c in np.broadcast_arrays(x, y, z)]
+        n_points = coords[0].size
+
+        shape = (n_models, n_points, 3) if quantity == 'force' else (n_models, n_points)
+        if out is None:
+            out = np.zeros(shape, dtype=dtype)
+        else:
+            if tuple(out.shape) != shape or out.dtype != dtype:
+                raise MNnError('The output array has shape {0} and dtype {1}, expected {2} and {3}'.format(out.shape, out.dtype, shape, dtype))
+            out[...] = 0.0
+
+        return self._evaluate_batch(params, coords, self._batch_geometry(coords), quantity, out, max_memory, n_workers)
+
+    def _batch_geometry(self, coords):
+        """ Computes the part of a batched evaluation that only depends on the points.
+
+        Args:
+            coords (list of numpy arrays): The flat x, y and z coordinates of the points
+
+        Returns:
+            A list holding, for every axis of the model with discs, a tuple ``(code, ids, R2)`` : the code of the axis, the
+            indices of its discs in the model and the squared distances of the points to the axis.
+        """
+        geometry = []
+        for code in range(3):
+            ids = np.flatnonzero(self._axis_codes == code)
+            if ids.size > 0:
+                i1, i2, i_n = tangent_components[code]
+                geometry.append((code, ids, coords[i1]*coords[i1] + coords[i2]*coords[i2]))
+        return geometry
+
+    def _evaluate_batch(self, params, coords, geometry, quantity, out, max_memory=None, n_workers=None):
+        """ Adds ``quantity`` for every parameter set of ``params`` at the points ``coords`` to ``out``, by tiles.
+
+        Args:
+            params (numpy array): The (K, n_discs, 3) parameters
+            coords (list of numpy arrays): The flat x, y and z coordinates of the points, in the type of ``out``
+            geometry (list): The geometry of the points, given by :func:`~mnn.model.MNnModel._batch_geometry`
+            quantity ({'density', 'potential', 'force'}): The quantity to evaluate
+            out (numpy array): The (K, N) or (K, N, 3) accumulator
+            max_memory (int or None): Memory budget in bytes for the temporaries. If None, the budget of the model is used.
+            n_workers (int or None): Number of threads evaluating the tiles. If None, the value of the model is used.
+
+        Returns:
+            ``out``
+        """
+        dtype = out.dtype
+        n_models, n_points = out.shape[:2]
+
+        # Parameters of every axis group, as (K x n_discs_group) arrays
+        groups = []
+        for code, ids, R2 in geometry:
+            group = params[:, ids, :].astype(dtype)
+            groups.append((code, np.ascontiguousarray(group[:, :, 0]), np.ascontiguousarray(group[:, :, 1]),
+                           np.ascontiguousarray(group[:, :, 2]), R2))
+
+        # Tiles of parameter sets and points fitting in the budget of a worker
+        if n_workers is None:
+            n_workers = self.n_workers
+        n_workers = max(1, int(n_workers))
+        if max_memory is None:
+            max_memory = self.max_memory
+        if max_memory is None:
+            max_memory = cache_block_memory * n_workers
+        n_discs_max = max([g[1].shape[1] for g in groups] + [1])
+        n_pairs = max(1, int(max_memory / n_workers // (dtype.itemsize * (n_work_arrays*n_discs_max + n_work_vectors))))
+        block_points = max(1, min(n_points, n_pairs))
+        block_models = max(1, min(n_models, n_pairs // block_points))
+        tiles = [(k, i) for k in range(0, n_models, block_models) for i in range(0, max(n_points, 1), block_points)]
+
+        def evaluate(start, stop):
+            for k, i in tiles[start:stop]:
+                models, points = slice(k, k + block_models), slice(i, i + block_points)
+                for code, a, b, M, R2 in groups:
+                    i1, i2, i_n = tangent_components[code]
+                    n = coords[i_n][points]
+                    if quantity == 'force':
+                        qt, qn = self._evaluate_group(a[models], b[models], M[models], R2[points], n, force=True)
+                        self._add_force(out[models, points], qt, qn, coords[i1][points], coords[i2][points], n, i1, i2, i_n)
+                    else:
+                        self._evaluate_group(a[models], b[models], M[models], R2[points], n, **{quantity: out[models, points]})
+
+        self._run_blocks(len(tiles), evaluate, n_workers=n_workers, max_block_size=1)
+        return out
+
+    def evaluate_discs(self, x, y, z, quantity='density'):
+        """ Evaluates the density or the potential of every disc of the model separately.
+
+        Args:
+            x, y, z (float or N numpy arrays): Cartesian coordinates of the points to evaluate
+            quantity ({'density', 'potential'}): The quantity to evaluate (default = 'density')
+
+        Returns:
+            A (n_discs, N) numpy array holding the contribution of every disc, in the order of :func:`~mnn.model.MNnModel.get_model`
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the quantity is not the density or the potential
+
+        Note:
+            Both quantities are linear in the masses : evaluating a model with unit masses gives the columns of the linear
+            least-squares problem on the masses for fixed scales and heights.
+        """
+        if quantity not in ('density', 'potential'):
+            raise MNnError('The discs can only be evaluated separately for the density or the potential, not {0}'.format(quantity))
+
+        coords = [np.ascontiguousarray(c, dtype=np.float64).reshape(-1) for c in np.broadcast_arrays(x, y, z)]
+        return self._evaluate_discs(coords, self._batch_geometry(coords), quantity)
+
+    def _evaluate_discs(self, coords, geometry, quantity, params=None, out=None):
+        """ Evaluates ``quantity`` for every disc separately at the points ``coords``.
+
+        Args:
+            coords (list of numpy arrays): The flat x, y and z coordinates of the points
+            geometry (list): The geometry of the points, given by :func:`~mnn.model.MNnModel._batch_geometry`
+            quantity ({'density', 'potential'}): The quantity to evaluate
+            params (numpy array or None): (n_discs, 3) parameters replacing the ones of the model, with the same axes (default = None)
+            out (numpy array or None): A (n_discs, N) array receiving the result (default = None)
+
+        Returns:
+            The (n_discs, N) contributions of the discs
+        """
+        if params is None:
+            params = np.column_stack((self._a, self._b, self._M))
+        if out is None:
+            out = np.empty((params.shape[0], coords[0].size))
+
+        quantity_callback = self.callback_from_string(quantity)
+        for code, ids, R2 in geometry:
+            a, b, M = self._broadcast_parameters(1, params[ids, 0], params[ids, 1], params[ids, 2])
+            out[ids] = quantity_callback(np.sqrt(R2), coords[tangent_components[code][2]], a, b, M)
+        return out
+
+    def evaluate_jacobian(self, x, y, z, quantity='density', weights=None, max_memory=None):
+        """ Evaluates the derivatives of the density or of the potential of the model with respect to the parameters of its discs.
+
+        The parameters are ordered as in :data:`~mnn.model.MNnModel.discs` : (a1, b1, M1, a2, b2, ...).
+
+        Args:
+            x, y, z (float or N numpy arrays): Cartesian coordinates of the points to evaluate
+            quantity ({'density', 'potential'}): The quantity to differentiate (default = 'density')
+            weights (N numpy array or None): If given, the derivatives are summed over the points with these weights, by blocks, instead of being returned point by point (default = None)
+            max_memory (int or None): Memory budget in bytes for the temporaries. If None, the budget of the model is used.
+
+        Returns:
+            A (N, 3*n_discs) numpy array holding the Jacobian of the quantity at every point, or a numpy array of size 3*n_discs holding
+            the weighted sum of its rows if ``weights`` is given.
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the quantity cannot be differentiated or if the weights do not match the points
+
+        Example:
+            The gradient of a chi2 ``sum(w*(rho-p)**2)`` is given by :
+
+            >>> gradient = model.evaluate_jacobian(x, y, z, 'density', weights=2.0*w*(model.evaluate_density(x, y, z)-p))
+        """
+        if quantity not in ('density', 'potential'):
+            raise MNnError('The jacobian can only be computed for the density or the potential, not {0}'.format(quantity))
+
+        coords = [np.ascontiguousarray(c, dtype=np.float64).reshape(-1) for c in np.broadcast_arrays(x, y, z)]
+        if weights is not None:
+            weights = np.ascontiguousarray(weights, dtype=np.float64).reshape(-1)
+            if weights.size != coords[0].size:
+                raise MNnError('{0} weights given for {1} points'.format(weights.size, coords[0].size))
+        return self._evaluate_jacobian(coords, self._batch_geometry(coords), quantity, weights, max_memory)
+
+    def _evaluate_jacobian(self, coords, geometry, quantity, weights=None, max_memory=None):
+        """ Evaluates the Jacobian of ``quantity`` at the points ``coords``, by blocks.
+
+        Args:
+            coords (list of numpy arrays): The flat x, y and z coordinates of the points
+            geometry (list): The geometry of the points, given by :func:`~mnn.model.MNnModel._batch_geometry`
+            quantity ({'density', 'potential'}): The quantity to differentiate
+            weights (numpy array or None): The weights of the points, or None to return the Jacobian itself
+            max_memory (int or None): Memory budget in bytes for the temporaries. If None, the budget of the model is used.
+
+        Returns:
+            The Jacobian as a (N, 3*n_discs) array, or its weighted sum over the points as an array of size 3*n_discs
+        """
+        n_points = coords[0].size
+        n_discs = self._axis_codes.size
+        jacobian_callback = {'density': self.mn_density_jacobian, 'potential': self.mn_potential_jacobian}[quantity]
+        groups = dict((code, (a, b, M)) for code, a, b, M in self._get_axis_groups())
+
+        if weights is None:
+            out = np.zeros((n_points, n_discs, 3))
+        else:
+            out = np.zeros((n_discs, 3))
+
+        def evaluate(start, stop):
+            for code, ids, R2 in geometry:
+                a, b, M = self._broadcast_parameters(1, *groups[code])
+                r = np.sqrt(R2[start:stop])
+                n = coords[tangent_components[code][2]][start:stop]
+                for k, derivative in enumerate(jacobian_callback(r, n, a, b, M)):
+                    if weights is None:
+                        out[start:stop, ids, k] = derivative.T
+                    else:
+                        out[ids, k] += np.dot(derivative, weights[start:stop])
+
+        # The weighted sums are accumulated by every block : the blocks are evaluated one after the other
+        self._run_blocks(n_points, evaluate, max_memory=max_memory, n_workers=1)
+        if weights is None:
+            return out.reshape(n_points, 3*n_discs)
+        return out.reshape(3*n_discs)
+
+    def allocate_scratch(self, n_points, dtype=None):
+        """ Allocates a work array for the evaluation kernel, to be passed as ``scratch`` to the evaluation methods.
+
+        Without a scratch array, the kernel allocates its (n_discs x n_points) and n_points temporaries for every block of points.
+        Reusing the same work array over many calls, for instance at every time step of an integration, avoids these allocations.
+
+        Args:
+            n_points (int): The number of points evaluated at once with the work array. Larger sets of points are evaluated by blocks.
+            dtype (numpy dtype or None): Floating point type of the evaluations. If None, the type of the model is used.
+
+        Returns:
+            A 1D numpy array
+
+        Note:
+            With a work array, the kernel allocates nothing proportional to the number of points : every intermediate term, the
+            squared radius, the sums over the discs and the force coefficients are computed in it. Only the small fixed-size
+            buffers numpy uses internally for broadcasting remain.
+
+        Note:
+            When several workers are used, the work array is split between them. Every call using the array must be over before the
+            next one starts, so the same array must not be shared by concurrent evaluations.
+        """
+        n_discs = max([len(group[1]) for group in self._get_axis_groups()] + [1])
+        return np.empty((n_work_arrays*n_discs + n_work_vectors) * max(1, int(n_points)), dtype=self._get_dtype(dtype))
+
     def is_positive_definite(self, max_range=None):
         """ Returns true if the sum of the discs are positive definite.
         
-        The methods tests along every axis if the minimum of density is positive. If it is not the case then the model should 
-        NOT be used since we cannot ensure positive density everywhere.
+        The methods looks for the minimum of the density over the symmetry planes of the model (see
+        :func:`~mnn.model.MNnModel.find_density_minimum`). If it is negative then the model should NOT be used since we
+        cannot ensure positive density everywhere.
 
         Args:
-            max_range (a float or None): Maximum range to evaluate, if None the maximum scale radius will be taken. (default = None)
+            max_range (a float or None): Maximum range to evaluate, if None ten times the largest ``a+b`` of the discs is taken. (default = None)
 
         Returns:
             A boolean indicating if the model is positive definite.
         """
-        mods = self.get_model()
-        
-        for axis in ['x', 'y', 'z']:
-            if max_range == None:
-                # Determine the interval
-                mr = 0.0
-                for m in mods:
-                    # Relevant value : scale parameter for the parallel axes
-                    if m[0] != axis:
-                        if m[1] > mr:
-                            mr = m[1]
-
-                # If we don't have a max_range then we can skip this root finding : the function cannot go below zero
-                if abs(mr) < 1e-18:
-                    continue
-
-                mr *= 10.0 # Multiply by a factor to be certain "everything is enclosed"
-            else:
-                mr = max_range
+        return self.find_density_minimum(max_range)[0] >= 0.0
 
-            xopt, fval, ierr, nf = op.fminbound(self._evaluate_density_axis, 0.0, max_range, args = [axis], disp=0, full_output=True)
-            if fval < 0.0:
-                #print('Warning : This model has a root along the {0} axis (r={1}) : density can go below zero'.format(axis, x0))
-                return False
+    def find_density_minimum(self, max_range=None, n_samples=64, n_candidates=8, n_refinements=6):
+        """ Finds the lowest density of the model on its symmetry planes.
 
-        return True
+        The symmetry planes are sampled by :func:`~mnn.model.MNnModel.sample_symmetry_planes` : finely near the center, where
+        the discs vary the most, and coarsely far from it. All the samples are evaluated in a single call. The lowest local minima of the sampling are then refined together by
+        zooming repeatedly on the cell around them.
+
+        Args:
+            max_range (a float or None): Maximum range to evaluate, if None ten times the largest ``a+b`` of the discs is taken. (default = None)
+            n_samples (int): Number of samples along each direction of a plane (default = 64)
+            n_candidates (int): Maximum number of local minima refined (default = 8)
+            n_refinements (int): Number of zooms on the local minima. Each zoom divides the size of the cell by four. (default = 6)
 
-    def generate_dataset_meshgrid(self, xmin, xmax, nx, quantity='density'):
+        Returns:
+            A tuple containing
+
+            - **density** (float): The lowest density found
+            - **position** (numpy array): The cartesian coordinates (x, y, z) of the point where it is reached
+
+        Example:
+            >>> density, position = model.find_density_minimum()
+            >>> if density < 0.0:
+            ...     print('Negative density at {0}'.format(position))
+        """
+        if self._axis_codes.size == 0:
+            return 0.0, np.zeros(3)
+
+        if max_range is None:
+            max_range = 10.0*np.max(np.abs(self._a) + self._b)
+        if max_range <= 0.0:
+            return float(self.evaluate_density(0.0, 0.0, 0.0)), np.zeros(3)
+
+        points, nodes, planes = self.sample_symmetry_planes(self._a, self._b, self._axis_codes, max_range, n_samples)
+        density = self.evaluate_density(points[:, 0], points[:, 1], points[:, 2])
+
+        # Local minima of the sampling, the lowest ones first
+        padded = np.pad(density, ((0, 0), (1, 1), (1, 1)), mode='constant', constant_values=np.inf)
+        center = padded[:, 1:-1, 1:-1]
+        is_minimum = ((center <= padded[:, :-2, 1:-1]) & (center <= padded[:, 2:, 1:-1]) &
+                      (center <= padded[:, 1:-1, :-2]) & (center <= padded[:, 1:-1, 2:]))
+        minima = np.flatnonzero(is_minimum)
+        minima = minima[np.argsort(density.reshape(-1)[minima])[:n_candidates]]
+        id_planes, iu, iv = np.unravel_index(minima, density.shape)
+
+        best = density.reshape(-1)[minima[0]]
+        best_position = points[id_planes[0], :, iu[0], iv[0]].copy()
+
+        # Refinement : every candidate is resampled on the cells around it, then the cells around the new minimum, ...
+        n_candidates = minima.size
+        lo_u, hi_u = nodes[np.maximum(iu-1, 0)], nodes[np.minimum(iu+1, n_samples-1)]
+        lo_v, hi_v = nodes[np.maximum(iv-1, 0)], nodes[np.minimum(iv+1, n_samples-1)]
+        t = np.linspace(0.0, 1.0, 9)
+        candidates = np.arange(n_candidates)
+        for level in range(n_refinements):
+            uu = lo_u[:, np.newaxis] + (hi_u - lo_u)[:, np.newaxis]*t
+            vv = lo_v[:, np.newaxis] + (hi_v - lo_v)[:, np.newaxis]*t
+            points = np.zeros((n_candidates, 3, t.size, t.size))
+            points[candidates, planes[id_planes, 0]] = uu[:, :, np.newaxis]
+            points[candidates, planes[id_planes, 1]] = vv[:, np.newaxis, :]
+            density = self.evaluate_density(points[:, 0], points[:, 1], points[:, 2]).reshape(n_candidates, -1)
+
+            k = np.argmin(density, axis=1)
+            ku, kv = np.unravel_index(k, (t.size, t.size))
+            lowest = np.argmin(density[candidates, k])
+            if density[lowest, k[lowest]] < best:
+                best = density[lowest, k[lowest]]
+                best_position = points[lowest, :, ku[lowest], kv[lowest]].copy()
+
+            # Zooming on the minimum of each candidate, within the sampled quadrant
+            du = (hi_u - lo_u)/(t.size - 1)
+            dv = (hi_v - lo_v)/(t.size - 1)
+            lo_u, hi_u = np.maximum(uu[candidates, ku] - du, 0.0), np.minimum(uu[candidates, ku] + du, max_range)
+            lo_v, hi_v = np.maximum(vv[candidates, kv] - dv, 0.0), np.minimum(vv[candidates, kv] + dv, max_range)
+
+        return float(best), best_position
+
+    @staticmethod
+    def sample_symmetry_planes(a, b, axis_codes, max_range, n_samples):
+        """ Samples the quadrants ``[0, max_range]^2`` of the symmetry planes of discs.
+
+        Every disc is symmetric with respect to the three coordinate planes. If all the discs share the same axis, only a
+        (R, z) half-plane is sampled. Along each direction, the samples ``s*sinh(t)`` are linear near the center, with the
+        step set by the smallest scale ``s`` of the discs, and exponential far from it.
+
+        Args:
+            a, b (numpy arrays): The scales and heights of the discs. Only their extreme values matter.
+            axis_codes (numpy array): The codes of the axes of the discs
+            max_range (float): The extent of the sampled quadrants
+            n_samples (int): Number of samples along each direction of a plane
+
+        Returns:
+            A tuple containing
+
+            - **points** (numpy array): The (n_planes, 3, n_samples, n_samples) coordinates of the samples
+            - **nodes** (numpy array): The n_samples coordinates along each direction
+            - **planes** (numpy array): The (n_planes, 2) indices of the coordinates spanning every plane
+        """
+        scales = np.concatenate((np.ravel(b), np.ravel(a) + np.ravel(b)))
+        scales = scales[scales > 0.0]
+        scale = np.clip(scales.min() if scales.size else max_range, max_range*1e-6, max_range)
+        nodes = scale*np.sinh(np.linspace(0.0, np.arcsinh(max_range/scale), n_samples))
+
+        # The planes, given by the indices of the two coordinates spanning them
+        codes = np.unique(axis_codes)
+        if codes.size == 1:
+            i1, i2, i_n = tangent_components[codes[0]]
+            planes = np.array([(i1, i_n)])
+        else:
+            planes = np.array([(0, 1), (0, 2), (1, 2)])
+
+        u, v = np.meshgrid(nodes, nodes, indexing='ij')
+        points = np.zeros((len(planes), 3, n_samples, n_samples))
+        for id_plane, (i, j) in enumerate(planes):
+            points[id_plane, i] = u
+            points[id_plane, j] = v
+        return points, nodes, planes
+
+    def generate_dataset_meshgrid(self, xmin, xmax, nx, quantity='density', max_memory=None, out=None, n_workers=None, mirror=True, dtype=None):
         """ Generates a numpy meshgrid of data from the model
         
         Args:
@@ -455,15 +1098,42 @@ class MNnModel(object):
             xmax (3-tuple of floats): The high bound of the box
             nx (3-tuple of floats): Number of points in every direction
             quantity ({'density', 'potential', 'force'}) : Type of quantity to fill the box with (default='density')
+            max_memory (int or None): Memory budget in bytes for the evaluation. If None, the budget of the model is used.
+            out (numpy array or None): Preallocated array (or ``np.memmap``) with the shape of ``res`` in which the result is written (default = None)
+            n_workers (int or None): Number of threads used for the evaluation. If None, the value of the model is used.
+            mirror (bool): Should the mirror symmetries of the model be used to evaluate only part of the box (default = True).
+            dtype (numpy dtype or None): Floating point type of the evaluation and of ``res``. If None, the type of ``out`` if it is given, or else the type of the model, is used.
 
         Returns:
             A 4-tuple containing
 
             - **vx, vy, vz** (*N vector of floats*): The x, y and z coordinates of each point of the mesh
             - **res** (*N vector of floats*): The values of the summed quantity over all discs at each point of the mesh
+
         Raises:
-            MemoryError: If the array is too big
+            MemoryError: If the array is too big and no memory budget has been set
             :class:`mnn.model.MNnError`: If the quantity parameter does not correspond to anything known
+
+        Note:
+            A sum of discs aligned on the x, y and z axes is symmetric under x->-x, y->-y and z->-z. If ``mirror`` is True, the model is only evaluated
+            on the non-negative half of every axis along which the box is centered on the origin and the rest of the box is filled by reflection,
+            the corresponding component of the force changing sign. For a box centered on the origin, only an octant of the box is evaluated.
+
+        Note:
+            When all the discs of the model share the same axis, the quantity only depends on the cylindrical radius and the height.
+            The model is then evaluated once for every distinct (R, z) pair of the box (radii closer than :data:`mnn.model.symmetry_tolerance`
+            times the largest radius are merged) and the result is mapped back to the 3D grid. The pairs are exact, not the nodes of an
+            interpolated 2D grid, so this only pays off when the plane axes share radii (for instance a box centered on the axis) and the
+            cost stays proportional to the number of points. If the plane axes share no radius, or if a memory budget is set and the
+            (R, z) table does not fit in it, the box is evaluated point by point.
+
+        Note:
+            When a memory budget is set or ``out`` is given, the box is evaluated by blocks and the coordinates ``vx``, ``vy`` and ``vz``
+            are returned as read-only broadcast views of the 1D axes, so the peak memory does not depend on the size of the box.
+            Huge boxes can be written directly to disk by providing a memory mapped output, for instance :
+
+            >>> res = np.lib.format.open_memmap('density.npy', mode='w+', shape=(512, 512, 512))
+            >>> m.generate_dataset_meshgrid((-10.0,)*3, (10.0,)*3, (512,)*3, max_memory=2**28, out=res)
         """
         quantity_vec = ('density', 'potential', 'force')
         if quantity not in quantity_vec:
@@ -478,28 +1148,570 @@ class MNnModel(object):
         for i in range(3):
             Xsp.append(np.linspace(xmin[i], xmax[i], nx[i]))
 
-        gx, gy, gz = np.meshgrid(Xsp[0], Xsp[1], Xsp[2], indexing='ij')
+        if max_memory is None:
+            max_memory = self.max_memory
 
-        if quantity == 'density':
-            res = self.evaluate_density(gx, gy, gz)
-        elif quantity == 'potential':
-            res = self.evaluate_potential(gx, gy, gz)
-        elif quantity == 'force':
-            res = self.evaluate_force(gx, gy, gz)
+        shape = tuple(len(v) for v in Xsp)
+        if max_memory is None and out is None:
+            gx, gy, gz = np.meshgrid(Xsp[0], Xsp[1], Xsp[2], indexing='ij')
         else:
-            raise MNnError('Quantity {0} unknown. Cannot fill grid mesh.'.format(quantity))
-            
+            # Blocked evaluation : the coordinates are never expanded to the full box
+            gx = np.broadcast_to(Xsp[0][:, np.newaxis, np.newaxis], shape)
+            gy = np.broadcast_to(Xsp[1][np.newaxis, :, np.newaxis], shape)
+            gz = np.broadcast_to(Xsp[2][np.newaxis, np.newaxis, :], shape)
+
+        if out is None:
+            res = self._reshape_output(self._allocate_outputs(gx.size, (quantity,), self._get_dtype(dtype))[quantity], shape, quantity)
+        else:
+            if dtype is not None and out.dtype != self._check_dtype(dtype):
+                raise MNnError('The output array has dtype {0}, expected {1}'.format(out.dtype, np.dtype(dtype)))
+            res = out
+
+        self._evaluate_grid(Xsp, quantity, self._grid_output(res, shape, quantity), max_memory, n_workers, mirror)
         return gx, gy, gz, res
 
     
-    # Axis evaluation, non-documented. Should not be used apart from the is_positive_definite method ! 
-    def _evaluate_density_axis(self, r, axis):
-        if axis == 'x':
-            return self._evaluate_scalar_quantity(r, 0, 0, MNnModel.mn_density)
-        if axis == 'y':
-            return self._evaluate_scalar_quantity(0, r, 0, MNnModel.mn_density)
+    @staticmethod
+    def _check_quantities(quantities):
+        """ Makes sure every quantity in ``quantities`` is known and returns them as a tuple.
+
+        Raises:
+            :class:`mnn.model.MNnError`: If one of the quantities does not correspond to anything known
+        """
+        if isinstance(quantities, str):
+            quantities = (quantities,)
+        quantities = tuple(quantities)
+        for quantity in quantities:
+            if quantity not in quantity_names:
+                raise MNnError('Unknown quantity type {0}, possible values are {1}'.format(quantity, quantity_names))
+        return quantities
+
+    @staticmethod
+    def _check_dtype(dtype):
+        """ Makes sure ``dtype`` is a floating point type the models can be evaluated in and returns it as a numpy dtype.
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the type is not supported
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in float_dtypes:
+            raise MNnError('Unsupported dtype {0}, possible values are {1}'.format(dtype, [str(d) for d in float_dtypes]))
+        return dtype
+
+    def _get_dtype(self, dtype=None):
+        """ Returns the floating point type of an evaluation : ``dtype`` if given, the type of the model otherwise """
+        if dtype is None:
+            return self.dtype
+        return self._check_dtype(dtype)
+
+    @staticmethod
+    def _evaluation_dtype(outs):
+        """ Returns the floating point type an evaluation writing in the accumulators ``outs`` is made in : the type of the accumulators,
+        or ``np.float64`` if it is not a supported floating point type. """
+        dtype = next(iter(outs.values())).dtype
+        return dtype if dtype in float_dtypes else np.dtype(np.float64)
+
+    @staticmethod
+    def _allocate_outputs(n_points, quantities, dtype=np.float64):
+        """ Allocates the zeroed accumulators used by :func:`~mnn.model.MNnModel._evaluate_block` for ``n_points`` points.
+
+        Returns:
+            A dictionary associating every quantity to its accumulator : a N vector for the density and the potential, a
+            C-contiguous Nx3 array for the force.
+        """
+        outs = {}
+        for quantity in quantities:
+            if quantity == 'force':
+                outs[quantity] = np.zeros((n_points, 3), dtype=dtype)
+            else:
+                outs[quantity] = np.zeros(n_points, dtype=dtype)
+        return outs
+
+    @staticmethod
+    def _reshape_output(values, shape, quantity):
+        """ Gives back to a flat accumulator the shape of the coordinates the quantity has been evaluated on.
+        Scalar coordinates give a scalar density or potential and a 3-vector for the force.
+        """
+        if quantity != 'force':
+            return values.reshape(shape)[()]
+
+        # Keeping the layout of the single disc force (see mn_force) : the components are on the last dimension
+        # and the point dimensions are reversed.
+        ndim = len(shape)
+        return values.reshape(shape + (3,)).transpose(tuple(range(ndim-1, -1, -1)) + (ndim,))
+
+    @staticmethod
+    def _grid_output(out, shape, quantity):
+        """ Returns a view of an output array with the points ordered as the grid of shape ``shape``.
+        For the force, the components are on the last dimension of the view.
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the array does not have the right shape
+        """
+        ndim = len(shape)
+        expected = tuple(reversed(shape)) + (3,) if quantity == 'force' else tuple(shape)
+        if tuple(out.shape) != expected:
+            raise MNnError('The output array has shape {0}, expected {1}'.format(out.shape, expected))
+
+        if quantity == 'force':
+            return out.transpose(tuple(range(ndim-1, -1, -1)) + (ndim,))
+        return out
+
+    @staticmethod
+    def _flat_output(out, shape, quantity):
+        """ Returns a flat view (N vector or Nx3 array) of a user provided output array, in the order of the points.
+
+        Args:
+            out (numpy array): The output array, with the shape the result of the evaluation would have
+            shape (tuple): The shape of the evaluated coordinates
+            quantity ({'density', 'potential', 'force'}): The quantity written in the array
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the array does not have the right shape or cannot be viewed as a flat array
+        """
+        n_points = int(np.prod(shape))
+        if quantity == 'force':
+            ndim = len(shape)
+            expected = tuple(reversed(shape)) + (3,)
+            flat_shape = (n_points, 3)
+        else:
+            expected = tuple(shape)
+            flat_shape = (n_points,)
+
+        if tuple(out.shape) != expected:
+            raise MNnError('The output array has shape {0}, expected {1}'.format(out.shape, expected))
+
+        if quantity == 'force':
+            out = out.transpose(tuple(range(ndim-1, -1, -1)) + (ndim,))
+
+        flat = out.view()
+        try:
+            flat.shape = flat_shape
+        except AttributeError:
+            raise MNnError('The output array must be contiguous in the order of the evaluated points')
+        return flat
+
+    def _block_size(self, max_memory, dtype=np.float64):
+        """ Returns the number of points that can be evaluated at once, in floating point type ``dtype``, within a memory budget of ``max_memory`` bytes """
+        if max_memory is None:
+            max_memory = self.max_memory
+        if max_memory is None:
+            return None
+
+        # Temporaries of _evaluate_block : about 7 (n_discs x n_points) arrays for the largest axis group
+        # and a dozen of n_points arrays for the coordinates, the radius and the per-group sums.
+        n_discs = max([len(group[1]) for group in self._get_axis_groups()] + [1])
+        bytes_per_point = np.dtype(dtype).itemsize * (7*n_discs + 12)
+        return max(1, int(max_memory // bytes_per_point))
+
+    def _run_blocks(self, n_points, block_function, max_memory=None, n_workers=None, dtype=np.float64, max_block_size=None):
+        """ Splits ``n_points`` points in blocks and calls ``block_function(start, stop)`` on each of them.
+
+        The blocks are sized to fit the memory budget and, if several workers are used, are evaluated on a thread pool.
+
+        Args:
+            n_points (int): The number of points to process
+            block_function (function callback): The function processing the points ``start`` to ``stop``. It must only write in its own slice of the outputs.
+            max_memory (int or None): Memory budget in bytes. If None, the budget of the model is used.
+            n_workers (int or None): Number of threads evaluating the blocks. If None, the value of the model is used.
+            dtype (numpy dtype): The floating point type of the evaluation, setting the size of the temporaries (default = np.float64)
+            max_block_size (int or None): Maximum number of points of a block (default = None)
+        """
+        if n_workers is None:
+            n_workers = self.n_workers
+        n_workers = max(1, int(n_workers))
+
+        if max_memory is None:
+            max_memory = self.max_memory
+        if max_memory is not None:
+            # The budget is shared by the blocks evaluated at the same time
+            max_memory = max_memory / n_workers
+
+        block_size = self._block_size(max_memory, dtype)
+        if block_size is None:
+            block_size = self._block_size(cache_block_memory, dtype)
+        if max_block_size is not None:
+            block_size = max(1, min(block_size, max_block_size))
+        if n_workers > 1:
+            # At least one block per worker, but not so small that the threading overhead dominates
+            block_size = min(block_size, max(min_block_size, -(-n_points // n_workers)))
+
+        starts = range(0, n_points, block_size)
+        evaluate = lambda start: block_function(start, min(start + block_size, n_points))
+        if n_workers == 1 or len(starts) <= 1:
+            for start in starts:
+                evaluate(start)
         else:
-            return self._evaluate_scalar_quantity(0, 0, r, MNnModel.mn_density)
+            pool = ThreadPool(min(n_workers, len(starts)))
+            try:
+                pool.map(evaluate, starts)
+            finally:
+                pool.close()
+                pool.join()
+
+    def _evaluate_points(self, x, y, z, outs, max_memory=None, reset=False, n_workers=None, scratch=None):
+        """ Evaluates the model over a set of points, by blocks.
+
+        Args:
+            x, y, z (numpy arrays): Cartesian coordinates of the points to evaluate. The three arrays must have the same shape.
+            outs (dict): The flat accumulators the quantities are added to (see :func:`~mnn.model.MNnModel._allocate_outputs`)
+            max_memory (int or None): Memory budget in bytes. If None, the budget of the model is used.
+            reset (bool): If True, the accumulators are zeroed, block by block, before the evaluation (default = False)
+            n_workers (int or None): Number of threads evaluating the blocks. If None, the value of the model is used.
+            scratch (numpy array or None): Work array of the kernel, split between the workers. The blocks are sized to fit in it (default = None).
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the scratch array does not have the floating point type of the evaluation
+        """
+        dtype = self._evaluation_dtype(outs)
+        max_block_size = None
+        if scratch is not None:
+            if scratch.dtype != dtype:
+                raise MNnError('The scratch array has dtype {0}, expected {1}'.format(scratch.dtype, dtype))
+            if n_workers is None:
+                n_workers = self.n_workers
+            n_workers = max(1, int(n_workers))
+
+            # Every worker takes a part of the scratch array for the duration of a block
+            part = scratch.size // n_workers
+            scratch_parts = queue.Queue()
+            for i in range(n_workers):
+                scratch_parts.put(scratch[i*part:(i + 1)*part])
+            n_discs = max([len(group[1]) for group in self._get_axis_groups(dtype)] + [1])
+            max_block_size = part // (n_work_arrays*n_discs + n_work_vectors)
+            if max_block_size == 0:
+                raise MNnError('The scratch array is too small to evaluate a single point, see allocate_scratch')
+
+        def evaluate(start, stop):
+            # Every block writes in its own slice of the accumulators
+            block_outs = dict((q, o[start:stop]) for q, o in outs.items())
+            if reset:
+                for o in block_outs.values():
+                    o[...] = 0.0
+
+            block_scratch = None if scratch is None else scratch_parts.get()
+            try:
+                self._evaluate_block(self._coordinates_block(x, start, stop),
+                                     self._coordinates_block(y, start, stop),
+                                     self._coordinates_block(z, start, stop),
+                                     block_outs, block_scratch)
+            finally:
+                if block_scratch is not None:
+                    scratch_parts.put(block_scratch)
+
+        self._run_blocks(x.size, evaluate, max_memory, n_workers, dtype, max_block_size)
+
+    def _evaluate_grid(self, Xsp, quantity, out, max_memory=None, n_workers=None, mirror=True):
+        """ Fills a grid with a quantity of the model.
+
+        Args:
+            Xsp (3-tuple of numpy arrays): The 1D coordinates of the grid along every axis
+            quantity ({'density', 'potential', 'force'}): The quantity to evaluate
+            out (numpy array): The output, with the shape of the grid (and the force components on an additional last dimension)
+            max_memory (int or None): Memory budget in bytes. If None, the budget of the model is used.
+            n_workers (int or None): Number of threads evaluating the blocks. If None, the value of the model is used.
+            mirror (bool): Should the mirror symmetries of the model be used (default = True)
+        """
+        # Axes along which the grid is symmetric with respect to the origin : only the non-negative half is evaluated
+        mirrored = []
+        if mirror:
+            for axis, v in enumerate(Xsp):
+                scale = symmetry_tolerance * max(np.abs(v).max(), np.finfo(np.float64).tiny)
+                if v.size > 1 and np.all(np.abs(v + v[::-1]) <= scale):
+                    mirrored.append(axis)
+
+        sub_Xsp = list(Xsp)
+        sub_slices = [slice(None)]*3
+        for axis in mirrored:
+            sub_slices[axis] = slice(Xsp[axis].size // 2, None)
+            sub_Xsp[axis] = Xsp[axis][sub_slices[axis]]
+        sub_out = out[tuple(sub_slices)]
+
+        dtype = self._evaluation_dtype({quantity: out})
+        if not self._evaluate_grid_axisymmetric(sub_Xsp, quantity, sub_out, max_memory, n_workers):
+            shape = tuple(v.size for v in sub_Xsp)
+            def evaluate(start, stop):
+                ids = np.unravel_index(np.arange(start, stop), shape)
+                block = self._allocate_outputs(stop - start, (quantity,), dtype)
+                self._evaluate_block(sub_Xsp[0][ids[0]], sub_Xsp[1][ids[1]], sub_Xsp[2][ids[2]], block)
+                sub_out[ids] = block[quantity]
+
+            self._run_blocks(int(np.prod(shape)), evaluate, max_memory, n_workers, dtype)
+
+        # Filling the other half of the mirrored axes by reflection. Once an axis is reflected, its full extent is filled.
+        filled = list(sub_slices)
+        for axis in mirrored:
+            self._reflect_grid(out, axis, filled, quantity == 'force', max_memory)
+            filled[axis] = slice(None)
+
+    def _reflect_grid(self, out, axis, filled, is_force, max_memory=None):
+        """ Copies the upper half of a grid along ``axis`` into its lower half, by reflection through the origin.
+
+        The copy is made plane by plane along ``axis``, and the planes are themselves split along another axis to fit
+        the memory budget, so the temporaries numpy may allocate for overlapping copies stay bounded.
+
+        Args:
+            out (numpy array): The grid, with the force components on an additional last dimension if ``is_force`` is True
+            axis (int): The axis along which the grid is reflected
+            filled (list of slices): The part of the grid already filled along every axis
+            is_force (bool): If True, the component of the force along ``axis`` changes sign
+            max_memory (int or None): Memory budget in bytes. If None, the budget of the model is used.
+        """
+        n = out.shape[axis]
+        other = 1 if axis == 0 else 0
+        n_other = len(range(*filled[other].indices(out.shape[other])))
+        plane_points = max(1, int(np.prod([len(range(*filled[k].indices(out.shape[k]))) for k in range(3) if k != axis])))
+
+        block_size = self._block_size(max_memory, out.dtype if out.dtype in float_dtypes else np.float64)
+        rows = n_other if block_size is None else max(1, block_size * n_other // plane_points)
+        start_other = filled[other].indices(out.shape[other])[0]
+
+        for i in range(n // 2):
+            for row in range(0, n_other, rows):
+                dst = list(filled)
+                dst[axis] = i
+                dst[other] = slice(start_other + row, start_other + min(row + rows, n_other))
+                src = list(dst)
+                src[axis] = n - 1 - i
+                dst, src = tuple(dst), tuple(src)
+
+                if is_force:
+                    for component in range(3):
+                        if component == axis:
+                            np.negative(out[src + (component,)], out=out[dst + (component,)])
+                        else:
+                            out[dst + (component,)] = out[src + (component,)]
+                else:
+                    out[dst] = out[src]
+
+    def _evaluate_grid_axisymmetric(self, Xsp, quantity, out, max_memory=None, n_workers=None):
+        """ Fills a grid with a quantity by tabulating a single-axis model in (R, z).
+
+        The quantities of a single-axis model only depend on the cylindrical radius and on the height. The distinct
+        radii of the plane of the discs are first extracted, the model is evaluated once for every (radius, height)
+        pair and the table is then mapped back on the 3D grid. For the force, the table holds the coefficients
+        multiplying the tangent and normal coordinates.
+
+        Args:
+            Xsp (3-tuple of numpy arrays): The 1D coordinates of the grid along every axis
+            quantity ({'density', 'potential', 'force'}): The quantity to evaluate
+            out (numpy array): The output, with the shape of the grid (and the force components on an additional last dimension)
+            max_memory (int or None): Memory budget in bytes. If None, the budget of the model is used.
+            n_workers (int or None): Number of threads evaluating the blocks. If None, the value of the model is used.
+
+        Returns:
+            True if the grid has been filled, False if the model has several axes or if the tabulation would not save anything.
+
+        Note:
+            The table holds the exact distinct radii of the grid, not an interpolated (R, z) grid, so the values are the ones of
+            the direct evaluation. The saving therefore comes from the radii shared by several points : about 2.8 times fewer
+            evaluations on a square grid symmetric about the axis, and nothing when the two plane axes share no radius (for
+            instance different or shifted ranges), in which case False is returned and the grid is evaluated point by point.
+            The work remains proportional to nx*ny*nz and not to the number of (R, z) nodes of a 2D grid.
+        """
+        dtype = self._evaluation_dtype({quantity: out})
+        groups = self._get_axis_groups(dtype)
+        if len(groups) != 1:
+            return False
+
+        code, a, b, M = groups[0]
+        i1, i2, i_n = tangent_components[code]
+        t1, t2, n = Xsp[i1], Xsp[i2], Xsp[i_n]
+
+        # Distinct radii of the plane of the discs
+        R2 = ((t1*t1)[:, np.newaxis] + (t2*t2)[np.newaxis, :]).reshape(-1)
+        R = np.sqrt(R2)
+        tolerance = symmetry_tolerance * max(R.max(), np.finfo(np.float64).tiny)
+        _, index, inverse = np.unique(np.round(R / tolerance), return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        if index.size == R.size:
+            return False
+
+        if max_memory is None:
+            max_memory = self.max_memory
+        n_tables = 2 if quantity == 'force' else 1
+        if max_memory is not None and dtype.itemsize*n_tables*index.size*n.size > max_memory / 2:
+            return False
+
+        # Tabulation of the (R, z) pairs
+        R2 = R2[index].astype(dtype)
+        n_table = n.astype(dtype)
+        n_height = n.size
+        tables = [np.zeros(index.size*n_height, dtype=dtype) for i in range(n_tables)]
+
+        def tabulate(start, stop):
+            i_R, i_h = np.divmod(np.arange(start, stop), n_height)
+            if quantity == 'force':
+                qt, qn = self._evaluate_group(a, b, M, R2[i_R], n_table[i_h], force=True)
+                tables[0][start:stop] = qt
+                tables[1][start:stop] = qn
+            else:
+                self._evaluate_group(a, b, M, R2[i_R], n_table[i_h], **{quantity: tables[0][start:stop]})
+
+        self._run_blocks(index.size*n_height, tabulate, max_memory, n_workers, dtype)
+
+        # Mapping the table back to the grid
+        shape = tuple(v.size for v in Xsp)
+        def gather(start, stop):
+            ids = np.unravel_index(np.arange(start, stop), shape)
+            i_table = inverse[ids[i1]*t2.size + ids[i2]]*n_height + ids[i_n]
+            if quantity == 'force':
+                qt = tables[0][i_table]
+                out[ids + (i1,)] = qt*t1[ids[i1]]
+                out[ids + (i2,)] = qt*t2[ids[i2]]
+                out[ids + (i_n,)] = tables[1][i_table]*n[ids[i_n]]
+            else:
+                out[ids] = tables[0][i_table]
+
+        self._run_blocks(int(np.prod(shape)), gather, max_memory, n_workers, dtype)
+        return True
+
+    @staticmethod
+    def _coordinates_block(x, start, stop):
+        """ Returns the points ``start`` to ``stop`` of a coordinate array, in C order, without expanding the full array """
+        if x.ndim <= 1:
+            return x.reshape(-1)[start:stop]
+        if x.flags.c_contiguous:
+            return x.reshape(-1)[start:stop]
+        return x[np.unravel_index(np.arange(start, stop), x.shape)]
+
+    def _evaluate_block(self, x, y, z, outs, scratch=None):
+        """ Fused evaluation kernel : adds the contribution of every disc of the model to the accumulators in ``outs``.
+
+        For every axis group, the cylindrical radius is computed once and all the discs of the group are evaluated in
+        a single (n_discs x n_points) broadcast. The height term ``h``, ``(a+h)**2`` and the inverse distance term are
+        then shared between the density, the potential and the force.
+
+        Args:
+            x, y, z (N numpy arrays): Cartesian coordinates of the points to evaluate
+            outs (dict): The accumulators, as returned by :func:`~mnn.model.MNnModel._allocate_outputs`. The evaluation is made in their floating point type.
+            scratch (numpy array or None): Work array of the kernel (default = None)
+        """
+        dtype = self._evaluation_dtype(outs)
+        coords = tuple(np.asarray(c, dtype=dtype) for c in (x, y, z))
+        density = outs.get('density')
+        potential = outs.get('potential')
+        force = outs.get('force')
+
+        # The squared radius of the points is computed in the first work vector, the rest of the work array is given to the
+        # groups. t2*t2 goes through the first work array of the groups, before they use it.
+        groups = self._get_axis_groups(dtype)
+        n_points = coords[0].size
+        if scratch is None:
+            n_discs = max([len(group[1]) for group in groups] + [1])
+            scratch = np.empty((n_work_arrays*n_discs + n_work_vectors)*n_points, dtype=dtype)
+        R2 = scratch[:n_points]
+        group_scratch = scratch[n_points:]
+
+        for code, a, b, M in groups:
+            i1, i2, i_n = tangent_components[code]
+            t1, t2, n = coords[i1], coords[i2], coords[i_n]
+
+            np.multiply(t1, t1, out=R2)
+            R2 += np.multiply(t2, t2, out=group_scratch[:n_points])
+            qt, qn = self._evaluate_group(a, b, M, R2, n, density, potential, force is not None, group_scratch)
+            if force is not None:
+                self._add_force(force, qt, qn, t1, t2, n, i1, i2, i_n)
+
+    @staticmethod
+    def _add_force(force, qt, qn, t1, t2, n, i1, i2, i_n):
+        """ Adds the force of an axis group, given by the coefficients returned by :func:`~mnn.model.MNnModel._evaluate_group`, to
+        the components of ``force``. The products are computed in place in ``qt`` and ``qn``, which are overwritten. """
+        qn *= n
+        force[..., i_n] += qn
+        np.multiply(qt, t1, out=qn)
+        force[..., i1] += qn
+        qt *= t2
+        force[..., i2] += qt
+
+    @staticmethod
+    def _evaluate_group(a, b, M, R2, n, density=None, potential=None, force=False, scratch=None):
+        """ Evaluates the discs of an axis group at points given in the cylindrical coordinates of the group.
+
+        The parameters can also be given for K models at once, as (K x n_discs) arrays : every model is then evaluated on all the
+        points, and the accumulators and force coefficients are (K x N) arrays.
+
+        Args:
+            a, b, M (numpy arrays): The parameters of the discs of the group, n_discs vectors or (K x n_discs) arrays
+            R2 (N numpy array): The squared cylindrical radius of the points
+            n (N numpy array): The height of the points (coordinate along the axis of the group)
+            density, potential (N or KxN numpy arrays or None): Accumulators the density and the potential are added to
+            force (bool): Should the force coefficients be computed (default = False)
+            scratch (numpy array or None): Flat work array holding at least ``n_work_arrays`` (n_discs x N) arrays and ``n_work_vectors - 1`` N arrays, or (K x n_discs x N) and (K x N) arrays. If None, it is allocated.
+
+        Returns:
+            A 2-tuple ``(qt, qn)`` such that the force of the group is ``qt*t1``, ``qt*t2`` and ``qn*n`` along the tangent and
+            normal coordinates, or ``(None, None)`` if ``force`` is False. They are views of the work array.
+        """
+        # Work arrays of the kernel : every intermediate (n_discs x N) term is computed in place, and every sum over the discs
+        # is written in a work vector
+        shape = a.shape + (np.size(R2),)
+        size = int(np.prod(shape))
+        vector_shape = a.shape[:-1] + (np.size(R2),)
+        vector_size = int(np.prod(vector_shape))
+        if scratch is None:
+            scratch = np.empty(n_work_arrays*size + (n_work_vectors - 1)*vector_size, dtype=np.result_type(a, R2))
+        h, ah, ah2, isd, isd3, tmp = [scratch[i*size:(i + 1)*size].reshape(shape) for i in range(n_work_arrays)]
+        total, qt, qn = [scratch[n_work_arrays*size + i*vector_size:n_work_arrays*size + (i + 1)*vector_size].reshape(vector_shape)
+                         for i in range(n_work_vectors - 1)]
+
+        # Sum over the discs of a term weighted by a per-disc factor (a batched product for K models), written in ``out``
+        if a.ndim == 1:
+            sum_discs = lambda weights, term, out: np.dot(weights, term, out=out)
+        else:
+            sum_discs = lambda weights, term, out: np.matmul(weights[:, np.newaxis, :], term, out=out[:, np.newaxis, :])
+
+        # Terms shared by every quantity. Parameters are along the last but one dimension, points along the last one.
+        ac = a[..., np.newaxis]
+        h[...] = n
+        h *= h
+        h += (b*b)[..., np.newaxis]
+        np.sqrt(h, out=h)
+        np.add(ac, h, out=ah)
+        np.multiply(ah, ah, out=ah2)
+        np.add(R2, ah2, out=isd)
+        np.sqrt(isd, out=isd)
+        np.divide(1.0, isd, out=isd)
+
+        if potential is not None:
+            sum_discs(M, isd, total)
+            total *= G
+            potential -= total
+
+        if not force and density is None:
+            return None, None
+
+        np.multiply(isd, isd, out=isd3)
+        isd3 *= isd
+
+        if force:
+            sum_discs(M, isd3, qt)
+            qt *= -G
+            np.multiply(isd3, ah, out=tmp)
+            tmp /= h
+            sum_discs(M, tmp, qn)
+            qn *= -G
+        else:
+            qt = qn = None
+
+        if density is not None:
+            fac = b*b*M/(4.0*np.pi)
+            # num = a*R2 + (a + 3h)*(a + h)**2, the work array of a + h being reused
+            np.multiply(h, 3.0, out=tmp)
+            tmp += ac
+            tmp *= ah2
+            np.multiply(ac, R2, out=ah)
+            tmp += ah
+            tmp *= isd3
+            tmp *= isd
+            tmp *= isd
+            np.multiply(h, h, out=ah)
+            ah *= h
+            tmp /= ah
+            sum_discs(fac, tmp, total)
+            density += total
+
+        return qt, qn
 
     def _evaluate_scalar_quantity(self, x, y, z, quantity_callback):
         """ Generic private function to evaluate a quantity on the summed discs at a specific point of space.
@@ -517,39 +1729,26 @@ class MNnModel(object):
         Note:
             If ``x``, ``y`` and ``z`` are numpy arrays, then the method evaluates the quantity over every point (x[i], y[i], z[i])
         """
-        # Radius on each plane
-        rxy = np.sqrt(x**2+y**2)
-        rxz = np.sqrt(x**2+z**2)
-        ryz = np.sqrt(y**2+z**2)
-
-        # Storing the first value directly as the output variable.
-        # This allows us to avoid testing for scalar or vector
-        # while initializing the total_sum variable
-        a, b, M = self.discs[0:3]
-        axis = self.axes[0] 
-        if axis == "x":
-            total_sum = quantity_callback(ryz, x, a, b, M)
-        elif axis == "y":
-            total_sum = quantity_callback(rxz, y, a, b, M)
-        else:
-            total_sum = quantity_callback(rxy, z, a, b, M)
-
-        id_mod = 1
-        for axis in self.axes[1:]:
-            a, b, M = self.discs[id_mod*3:(id_mod+1)*3]
-            if axis == "x":
-                total_sum += quantity_callback(ryz, x, a, b, M)
-            elif axis == "y":
-                total_sum += quantity_callback(rxz, y, a, b, M)
-            else:
-                total_sum += quantity_callback(rxy, z, a, b, M)
-            id_mod += 1
-            
-        return total_sum
-        
-    
-    
+        coords = (x, y, z)
+        ndim = max(np.ndim(x), np.ndim(y), np.ndim(z))
+        total_sum = 0.0
 
-    
+        for code, a, b, M in self._get_axis_groups():
+            i1, i2, i_n = tangent_components[code]
+            t1, t2, n = coords[i1], coords[i2], coords[i_n]
 
-    
+            # Radius on the plane of the discs, shared by every disc of the group.
+            # All the discs of the group are then evaluated in a single broadcast operation.
+            r = np.sqrt(t1**2+t2**2)
+            a, b, M = self._broadcast_parameters(ndim, a, b, M)
+            total_sum = total_sum + quantity_callback(r, n, a, b, M).sum(axis=0)
+
+        return total_sum
+
+    @staticmethod
+    def _broadcast_parameters(ndim, *params):
+        """ Reshapes the parameter arrays of an axis group so that they broadcast against ``ndim``-dimensional coordinates.
+        The discs end up along the first dimension of the result.
+        """
+        shape = (-1,) + (1,)*ndim
+        return tuple(p.reshape(shape) for p in params)
@@ -0,0 +1,161 @@
+from __future__ import print_function
+import numpy as np
+
+from .model import MNnError
+
+# Sub-steps of the integration schemes, as fractions of the time step. Every sub-step is a kick-drift-kick leapfrog.
+# The fourth order scheme is the symmetric composition of Yoshida (1990).
+_yoshida_w1 = 1.0 / (2.0 - 2.0**(1.0/3.0))
+integration_schemes = {'leapfrog': (1.0,),
+                       'yoshida4': (_yoshida_w1, 1.0 - 2.0*_yoshida_w1, _yoshida_w1)}
+
+# Number of particles updated at once by the kicks and the drifts, bounding the size of the scratch buffer
+update_block_size = 65536
+
+
+class OrbitIntegrator(object):
+    """
+    Batched orbit integrator for test particles in a Miyamoto-Nagai negative potential.
+
+    All the particles are advanced together, in place, with a kick-drift-kick leapfrog (second order) or its fourth order
+    composition by Yoshida. The accelerations are given by the ``evaluate_force_vec`` method of the model, which writes into
+    a buffer allocated once, and its evaluation kernel works in a scratch array allocated once as well : no array proportional
+    to the number of particles is allocated during the integration.
+
+    Example:
+        >>> model = mnn.model.MNnModel()
+        >>> model.add_disc('z', 1.0, 0.5, 10.0)
+        >>> integrator = mnn.orbits.OrbitIntegrator(model, dt=1e-3)
+        >>> integrator.integrate(positions, velocities, 1000, output='orbits.npy', output_every=10)
+
+    Note:
+        The model only needs an ``evaluate_force_vec(x, out=None)`` method : a :class:`~mnn.model.MNnModel` or a
+        :class:`~mnn.tabulated.TabulatedMNnModel` can be integrated. If the model also has an ``allocate_scratch`` method,
+        its work array is passed as ``scratch`` to every force evaluation. The memory budget and the number of threads of
+        a :class:`~mnn.model.MNnModel` apply to the force evaluations. Time is in units of length over velocity of the
+        model (kpc / (km/s) with the default value of :data:`mnn.model.G`).
+    """
+    def __init__(self, model, dt, scheme='leapfrog'):
+        """ Constructor for the integrator.
+
+        Args:
+            model (:class:`~mnn.model.MNnModel`): The model giving the force
+            dt (float): The time step
+            scheme ({'leapfrog', 'yoshida4'}): The integration scheme. ``yoshida4`` is fourth order and needs three force evaluations per step (default = 'leapfrog').
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the scheme is unknown
+        """
+        if scheme not in integration_schemes:
+            raise MNnError('Unknown integration scheme {0}. Available schemes are {1}'.format(scheme, sorted(integration_schemes.keys())))
+
+        self.model = model
+        self.dt = dt
+        self.scheme = scheme
+        self.time = 0.0
+
+        # Preallocated buffers, reused as long as the number of particles does not change
+        self._acceleration = None
+        self._scratch = None
+        self._kernel_scratch = None
+
+    def _allocate_buffers(self, n_particles):
+        """ Allocates the acceleration, scratch and kernel scratch buffers for ``n_particles`` particles, if needed """
+        if self._acceleration is None or self._acceleration.shape[0] != n_particles:
+            self._acceleration = np.empty((n_particles, 3))
+            self._scratch = np.empty((min(n_particles, update_block_size), 3))
+            if hasattr(self.model, 'allocate_scratch'):
+                self._kernel_scratch = self.model.allocate_scratch(n_particles)
+
+    def _update(self, target, source, factor):
+        """ Computes ``target += factor*source`` block by block, using the scratch buffer for the product """
+        for start in range(0, target.shape[0], update_block_size):
+            stop = min(start + update_block_size, target.shape[0])
+            scratch = self._scratch[:stop-start]
+            np.multiply(source[start:stop], factor, out=scratch)
+            target[start:stop] += scratch
+
+    def _compute_acceleration(self, positions):
+        """ Evaluates the force of the model at ``positions`` in the acceleration buffer """
+        if self._kernel_scratch is None:
+            self.model.evaluate_force_vec(positions, out=self._acceleration)
+        else:
+            self.model.evaluate_force_vec(positions, out=self._acceleration, scratch=self._kernel_scratch)
+
+    def step(self, positions, velocities):
+        """ Advances the particles by one time step, in place.
+
+        The accelerations at ``positions`` must already be in the acceleration buffer : this method is meant to be called
+        through :func:`~mnn.orbits.OrbitIntegrator.integrate`.
+
+        Args:
+            positions, velocities (Nx3 numpy arrays): The phase-space coordinates of the particles
+        """
+        for weight in integration_schemes[self.scheme]:
+            h = weight * self.dt
+            self._update(velocities, self._acceleration, 0.5*h)
+            self._update(positions, velocities, h)
+            self._compute_acceleration(positions)
+            self._update(velocities, self._acceleration, 0.5*h)
+        self.time += self.dt
+
+    def integrate(self, positions, velocities, n_steps, output=None, output_every=1, flush_every=16):
+        """ Integrates the orbits of the particles for ``n_steps`` time steps. The arrays are updated in place.
+
+        The trajectories can be written to disk : every ``output_every`` steps, a snapshot of the positions and velocities is
+        stored in an array of shape (n_snapshots, N, 6), the first snapshot being the initial conditions. Snapshots are written
+        one at a time in a ``.npy`` file mapped in memory, and the file is flushed every ``flush_every`` snapshots, so the
+        trajectories never need to fit in memory.
+
+        Args:
+            positions (Nx3 numpy array): The positions of the particles, updated in place
+            velocities (Nx3 numpy array): The velocities of the particles, updated in place
+            n_steps (int): The number of time steps
+            output (string, numpy array or None): The name of the ``.npy`` file the trajectories are written to, or a preallocated array of shape (n_steps//output_every+1, N, 6). If None, only the final state is kept (default = None).
+            output_every (int): Number of steps between two snapshots (default = 1)
+            flush_every (int): Number of snapshots between two flushes of the output file to the disk (default = 16)
+
+        Returns:
+            The trajectories (a ``np.memmap`` if ``output`` is a file name), or None if ``output`` is None
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the arrays cannot be updated in place or do not have the same shape, or if the output array has the wrong shape
+        """
+        for name, array in (('positions', positions), ('velocities', velocities)):
+            if not isinstance(array, np.ndarray) or array.ndim != 2 or array.shape[1] != 3:
+                raise MNnError('The {0} must be given as a Nx3 numpy array'.format(name))
+            if array.dtype != np.float64 or not array.flags.c_contiguous or not array.flags.writeable:
+                raise MNnError('The {0} must be a writeable C-contiguous float64 array to be updated in place'.format(name))
+        if positions.shape != velocities.shape:
+            raise MNnError('The positions and velocities do not have the same shape : {0} and {1}'.format(positions.shape, velocities.shape))
+
+        n_particles = positions.shape[0]
+        trajectories = None
+        if output is not None:
+            shape = (n_steps // output_every + 1, n_particles, 6)
+            if isinstance(output, np.ndarray):
+                trajectories = output
+                if trajectories.shape != shape:
+                    raise MNnError('The output array has shape {0}, expected {1}'.format(trajectories.shape, shape))
+            else:
+                trajectories = np.lib.format.open_memmap(output, mode='w+', dtype=np.float64, shape=shape)
+
+        self._allocate_buffers(n_particles)
+        self._compute_acceleration(positions)
+
+        i_snapshot = 0
+        for i_step in range(n_steps + 1):
+            if i_step > 0:
+                self.step(positions, velocities)
+
+            if trajectories is not None and i_step % output_every == 0:
+                trajectories[i_snapshot, :, :3] = positions
+                trajectories[i_snapshot, :, 3:] = velocities
+                i_snapshot += 1
+                if isinstance(trajectories, np.memmap) and i_snapshot % flush_every == 0:
+                    trajectories.flush()
+
+        if isinstance(trajectories, np.memmap):
+            trajectories.flush()
+
+        return trajectories
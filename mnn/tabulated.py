@@ -0,0 +1,410 @@
+from __future__ import print_function
+import numpy as np
+
+from .model import MNnModel, MNnError, G, axis_names, tangent_components
+
+# Matrix giving the coefficients of a cubic Hermite polynomial from the values and derivatives at both ends of a cell
+hermite_matrix = np.array(((1.0, 0.0, 0.0, 0.0),
+                           (0.0, 0.0, 1.0, 0.0),
+                           (-3.0, 3.0, -2.0, -1.0),
+                           (2.0, -2.0, 1.0, 1.0)))
+
+# Number of points interpolated at once. The gathered coefficients and the temporaries of a block stay in the cache
+lookup_block_size = 8192
+
+
+class TabulatedMNnModel(object):
+    """
+    Tabulated Miyamoto-Nagai negative model.
+
+    This object approximates the potential and the force of a :class:`~mnn.model.MNnModel` by interpolation. The potential
+    of every axis group of the model (all the discs sharing the same axis) only depends on the cylindrical radius and on the
+    height. It is thus tabulated, with its derivatives, on a (R, z) grid and interpolated by bicubic Hermite patches. The force
+    is the gradient of the interpolated potential, so both quantities are consistent. The cost of an evaluation does not depend
+    on the number of discs.
+
+    The grid is regular in ``asinh(R**2/s**2)`` and ``asinh(z**2/h**2)``, ``s`` and ``h`` being the smallest ``a+b`` and ``b`` of
+    the group : it is refined where the potential varies quickly, still covers a large range, and the potential is a smooth
+    function of these variables up to the axis and the plane of the discs. Points lying outside of the tables are evaluated with
+    the analytic model, and so are razor-thin discs (``b = 0``), whose potential is not smooth across their plane.
+
+    Note:
+        A lookup gathers the 16 coefficients of the cell of every point and costs about as much as the analytic evaluation of
+        8 to 16 discs, for every axis group. The tables only pay off for groups with more discs than that : the
+        ``tabulated_*_vec`` benchmarks of ``benchmarks/run_benchmarks.py`` give the crossover on a given machine.
+    """
+    def __init__(self, model=None, r_max=None, z_max=None, n_nodes=64, tolerance=1e-5, max_nodes=1024, verbose=False):
+        """ Constructor for the tabulated model.
+
+        The tables are refined, by doubling the number of nodes along each direction, until the relative error of the interpolated
+        potential and force, sampled inside the cells of the grid, goes below ``tolerance`` or the number of nodes reaches
+        ``max_nodes``.
+
+        Args:
+            model (:class:`~mnn.model.MNnModel` or None): The model to tabulate. If None, an empty object is created, to be filled by :func:`~mnn.tabulated.TabulatedMNnModel.load`.
+            r_max (float or None): Maximum cylindrical radius of the tables. If None, 100 times the largest ``|a|+b`` of the model is taken (default = None).
+            z_max (float or None): Maximum height of the tables. If None, ``r_max`` is taken (default = None).
+            n_nodes (int): Initial number of nodes of the tables along each direction (default = 64).
+            tolerance (float): Maximum relative error allowed on the interpolated potential and force (default = 1e-5).
+            max_nodes (int): Maximum number of nodes along each direction (default = 1024).
+            verbose (bool): Should the program output additional information (default = False).
+
+        Raises:
+            :class:`mnn.model.MNnError`: If the model has no disc
+
+        Note:
+            The error bound is measured on the tables only, points outside of ``r_max`` and ``z_max`` being evaluated exactly.
+            The potential is tabulated with the value of :data:`mnn.model.G` at construction time.
+        """
+        self.model = model
+        self.tolerance = tolerance
+        self.error = None
+        self.r_max = r_max
+        self.z_max = z_max
+
+        # One entry per axis group : (axis_code, (radial scale, vertical scale), (u step, v step), node tables), the cell patches and the analytic model
+        self._groups = []
+        self._patches = []
+        self._models = []
+        self._thin_model = None
+
+        if model is None:
+            return
+
+        groups = model._get_axis_groups()
+        if len(groups) == 0:
+            raise MNnError('Cannot tabulate a model without any disc')
+        self._split_thin_discs()
+
+        if self.r_max is None:
+            self.r_max = 100.0 * max(np.max(np.abs(a) + b) for code, a, b, M in groups)
+        if self.z_max is None:
+            self.z_max = self.r_max
+
+        n = n_nodes
+        while True:
+            self._tabulate(n)
+            self.error = self._measure_error()
+            if verbose:
+                print('Tabulated model : {0} nodes per direction, relative error = {1}'.format(n, self.error))
+            if self.error <= tolerance or 2*n > max_nodes:
+                break
+            n *= 2
+
+        if self.error > tolerance:
+            print('Warning : The tabulated model only reaches a relative error of {0} (tolerance = {1}). '.format(self.error, tolerance) +
+                  'Consider increasing max_nodes.')
+
+    @staticmethod
+    def _nodes(scales, u, v):
+        """ Returns the squared cylindrical radius and the height, broadcast against each other, of the nodes ``(u, v)`` of a table """
+        R2 = (scales[0]**2*np.sinh(u))[:, np.newaxis]
+        n = (scales[1]*np.sqrt(np.sinh(v)))[np.newaxis, :]
+        R2, n = np.broadcast_arrays(R2, n)
+        return R2.reshape(-1), n.reshape(-1)
+
+    @staticmethod
+    def _group_model(code, a, b, M):
+        """ Returns a :class:`~mnn.model.MNnModel` holding the discs of an axis group """
+        model = MNnModel()
+        model.load_from_array(np.column_stack((a, b, M)), [axis_names[code]]*len(a))
+        return model
+
+    def _split_thin_discs(self):
+        """ Gathers the razor-thin discs of the model, which are evaluated analytically, in a separate model """
+        thin = (self.model._b <= 0.0)
+        self._thin_model = None
+        if thin.any():
+            self._thin_model = MNnModel()
+            self._thin_model.load_from_array(np.column_stack((self.model._a[thin], self.model._b[thin], self.model._M[thin])),
+                                             [axis_names[c] for c in self.model._axis_codes[thin]])
+
+    def _tabulated_groups(self):
+        """ Returns the axis groups of the model, as given by :func:`~mnn.model.MNnModel._get_axis_groups`, without the razor-thin discs """
+        groups = []
+        for code, a, b, M in self.model._get_axis_groups():
+            thick = (b > 0.0)
+            if thick.any():
+                groups.append((code, a[thick], b[thick], M[thick]))
+        return groups
+
+    def _tabulate(self, n_nodes):
+        """ Builds the node tables of every axis group with ``n_nodes`` nodes along each direction.
+
+        The tables hold the potential and its analytic derivatives with respect to ``u = asinh(R**2/s**2)`` and ``v = asinh(z**2/h**2)``.
+        The nodes are evaluated by blocks, so the temporaries do not grow with the number of discs times the number of nodes.
+        """
+        self._groups = []
+        self._models = []
+        for code, a, b, M in self._tabulated_groups():
+            scales = (max(np.min(a + b), np.min(b)), np.min(b))
+            model = self._group_model(code, a, b, M)
+
+            u = np.linspace(0.0, np.arcsinh((self.r_max / scales[0])**2), n_nodes)
+            v = np.linspace(0.0, np.arcsinh((self.z_max / scales[1])**2), n_nodes)
+            R2, n = self._nodes(scales, u, v)
+
+            # dR/du = s**2*cosh(u)/(2R) and the radial force is qt*R, so that dphi/du = -qt*s**2*cosh(u)/2, the same goes for v
+            tables = np.zeros((4, n_nodes, n_nodes))
+            flat = tables.reshape(4, -1)
+            def tabulate(start, stop):
+                block = slice(start, stop)
+                flat[1, block], flat[2, block] = MNnModel._evaluate_group(a, b, M, R2[block], n[block], potential=flat[0, block], force=True)
+                flat[3, block] = self._cross_coefficient(a, b, M, R2[block], n[block])
+            model._run_blocks(R2.size, tabulate)
+
+            du = 0.5*scales[0]**2*np.cosh(u)[:, np.newaxis]
+            dv = 0.5*scales[1]**2*np.cosh(v)[np.newaxis, :]
+            tables[1] *= -du
+            tables[2] *= -dv
+            tables[3] *= du*dv
+
+            self._groups.append((code, scales, (u[1], v[1]), tables))
+            self._models.append(model)
+
+        self._build_patches()
+
+    @staticmethod
+    def _cross_coefficient(a, b, M, R2, n):
+        """ Returns the second derivative of the potential of an axis group with respect to ``R**2/2`` and ``n**2/2`` """
+        res = np.zeros(R2.shape)
+        for a_i, b_i, M_i in zip(a, b, M):
+            h = np.sqrt(n*n + b_i*b_i)
+            ah = a_i + h
+            isd = 1.0/np.sqrt(R2 + ah*ah)
+            res -= 3.0 * G * M_i * ah / h * isd**5
+        return res
+
+    def _build_patches(self):
+        """ Computes the 4x4 polynomial coefficients of the bicubic Hermite patch of every cell from the node tables.
+
+        The 16 coefficients of a cell are stored contiguously, the coefficient of ``pu**i * pv**j`` at index ``4*i + j``, so
+        that a lookup gathers a single record per point.
+        """
+        self._patches = []
+        for code, scales, (hu, hv), tables in self._groups:
+            # Derivatives are rescaled to a unit cell
+            f, fu, fv, fuv = tables[0], tables[1]*hu, tables[2]*hv, tables[3]*hu*hv
+            n_u, n_v = f.shape[0]-1, f.shape[1]-1
+
+            corners = np.empty((n_u, n_v, 4, 4))
+            for du in (0, 1):
+                for dv in (0, 1):
+                    cell = (slice(du, du + n_u), slice(dv, dv + n_v))
+                    corners[:, :, du, dv] = f[cell]
+                    corners[:, :, du, 2+dv] = fv[cell]
+                    corners[:, :, 2+du, dv] = fu[cell]
+                    corners[:, :, 2+du, 2+dv] = fuv[cell]
+
+            coefs = np.einsum('ik,abkl,jl->abij', hermite_matrix, corners, hermite_matrix)
+            self._patches.append(np.ascontiguousarray(coefs.reshape(n_u*n_v, 16)))
+
+    def _interpolate(self, id_group, R2, n2, force):
+        """ Interpolates the potential of an axis group, or its force coefficients, at squared cylindrical coordinates (R2, n2).
+
+        Returns:
+            The potential if ``force`` is False. Otherwise a 2-tuple ``(qt, qn)`` such that the force is ``qt*t1``, ``qt*t2`` and
+            ``qn*n`` along the tangent and normal coordinates.
+        """
+        code, scales, (hu, hv), tables = self._groups[id_group]
+        n_u, n_v = tables.shape[1]-1, tables.shape[2]-1
+
+        sR2, sn2 = scales[0]**2, scales[1]**2
+        pu = np.arcsinh(R2/sR2)/hu
+        pv = np.arcsinh(n2/sn2)/hv
+        iu = np.minimum(pu.astype(np.intp), n_u-1)
+        iv = np.minimum(pv.astype(np.intp), n_v-1)
+        pu -= iu
+        pv -= iv
+
+        # One record of 16 coefficients per point, c[4*i + j] multiplying pu**i * pv**j
+        c = np.take(self._patches[id_group], iu*n_v + iv, axis=0).T
+        # Horner scheme along v gives the coefficients of the polynomial in u
+        cu = [((c[4*i + 3]*pv + c[4*i + 2])*pv + c[4*i + 1])*pv + c[4*i] for i in range(4)]
+        if not force:
+            return ((cu[3]*pu + cu[2])*pu + cu[1])*pu + cu[0]
+
+        dphi_du = ((3.0*cu[3]*pu + 2.0*cu[2])*pu + cu[1]) / hu
+        cv = [((c[12 + j]*pu + c[8 + j])*pu + c[4 + j])*pu + c[j] for j in range(4)]
+        dphi_dv = ((3.0*cv[3]*pv + 2.0*cv[2])*pv + cv[1]) / hv
+
+        # Chain rule back to the coordinates : qt = -dphi/du * du/dR / R = -2*dphi/du / (s**2*cosh(u)), and the same goes for qn
+        qt = -2.0*dphi_du/np.sqrt(sR2*sR2 + R2*R2)
+        qn = -2.0*dphi_dv/np.sqrt(sn2*sn2 + n2*n2)
+        return qt, qn
+
+    def _measure_error(self):
+        """ Returns the maximum relative error of the interpolated potential and force inside the cells of the tables.
+
+        The error is sampled in the middle of the cells, where the interpolation error of the potential peaks, and at a fraction
+        ``0.5 - 1/(2*sqrt(3))`` of the cells, where the error of its derivatives does.
+        """
+        fractions = np.array((0.5 - 0.5/np.sqrt(3.0), 0.5))
+        error = 0.0
+        for id_group, ((code, scales, (hu, hv), tables), model) in enumerate(zip(self._groups, self._models)):
+            u = ((np.arange(tables.shape[1]-1)[:, np.newaxis] + fractions)*hu).reshape(-1)
+            v = ((np.arange(tables.shape[2]-1)[:, np.newaxis] + fractions)*hv).reshape(-1)
+            R2, n = self._nodes(scales, u, v)
+            a, b, M = model._a, model._b, model._M
+
+            pot_error, f_norm, f_error = np.empty(R2.size), np.empty(R2.size), np.empty(R2.size)
+            def measure(start, stop):
+                block = slice(start, stop)
+                R2_b, n_b = R2[block], n[block]
+                pot = np.zeros(R2_b.size)
+                qt, qn = MNnModel._evaluate_group(a, b, M, R2_b, n_b, potential=pot, force=True)
+                pot_i = self._interpolate(id_group, R2_b, n_b*n_b, False)
+                qt_i, qn_i = self._interpolate(id_group, R2_b, n_b*n_b, True)
+
+                R = np.sqrt(R2_b)
+                pot_error[block] = np.abs(pot_i - pot) / np.abs(pot)
+                f_norm[block] = np.sqrt((qt*R)**2 + (qn*n_b)**2)
+                f_error[block] = np.sqrt(((qt_i - qt)*R)**2 + ((qn_i - qn)*n_b)**2)
+            model._run_blocks(R2.size, measure, max_block_size=lookup_block_size)
+
+            error = max(error, np.max(pot_error), np.max(f_error / np.maximum(f_norm, 1e-6*f_norm.max())))
+
+        return error
+
+    def _evaluate(self, x, y, z, quantity, out=None):
+        """ Evaluates the potential or the force of the tabulated model at cartesian coordinates (x, y, z), optionally writing into ``out`` """
+        x, y, z = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), np.asarray(z, dtype=np.float64))
+        shape = x.shape
+        coords = (x.reshape(-1), y.reshape(-1), z.reshape(-1))
+        if out is None:
+            res = MNnModel._allocate_outputs(x.size, (quantity,))[quantity]
+        else:
+            res = MNnModel._flat_output(out, shape, quantity)
+            res[...] = 0.0
+
+        for start in range(0, x.size, lookup_block_size):
+            block = slice(start, min(start + lookup_block_size, x.size))
+            self._evaluate_block([c[block] for c in coords], quantity, res[block])
+
+        if self._thin_model is not None:
+            res += self._thin_model.evaluate_all(coords[0], coords[1], coords[2], (quantity,))[0]
+
+        if out is not None:
+            return out
+        return MNnModel._reshape_output(res, shape, quantity)
+
+    def _evaluate_block(self, coords, quantity, res):
+        """ Adds the interpolated quantity of every axis group to ``res`` for a block of points """
+        for id_group, (code, scales, steps, tables) in enumerate(self._groups):
+            i1, i2, i_n = tangent_components[code]
+            t1, t2, n = coords[i1], coords[i2], coords[i_n]
+            R2 = t1*t1 + t2*t2
+            n2 = n*n
+
+            inside = (R2 <= self.r_max**2) & (n2 <= self.z_max**2)
+            all_inside = inside.all()
+            if all_inside:
+                target = res
+            else:
+                # Points out of the tables are evaluated with the analytic model
+                outside = ~inside
+                res[outside] += self._models[id_group].evaluate_all(coords[0][outside], coords[1][outside],
+                                                                    coords[2][outside], (quantity,))[0]
+                t1, t2, n, R2, n2 = t1[inside], t2[inside], n[inside], R2[inside], n2[inside]
+                target = res[inside]
+
+            if quantity == 'potential':
+                target += self._interpolate(id_group, R2, n2, False)
+            else:
+                qt, qn = self._interpolate(id_group, R2, n2, True)
+                target[:, i1] += qt*t1
+                target[:, i2] += qt*t2
+                target[:, i_n] += qn*n
+
+            if not all_inside:
+                res[inside] = target
+
+    def evaluate_potential(self, x, y, z):
+        """ Evaluates the interpolated potential at specific positions
+
+        Args:
+            x, y, z (float or Nx1 numpy array): Cartesian coordinates of the point(s) to evaluate
+
+        Returns:
+            The interpolated potential at position ``(x, y, z)``, with the same form as :func:`~mnn.model.MNnModel.evaluate_potential`
+        """
+        return self._evaluate(x, y, z, 'potential')
+
+    def evaluate_force(self, x, y, z):
+        """ Evaluates the interpolated force at specific positions
+
+        Args:
+            x, y, z (float or Nx1 numpy array): Cartesian coordinates of the point(s) to evaluate
+
+        Returns:
+            The interpolated force at position ``(x, y, z)``, with the same form as :func:`~mnn.model.MNnModel.evaluate_force`
+        """
+        return self._evaluate(x, y, z, 'force')
+
+    def evaluate_potential_vec(self, x, out=None):
+        """ Returns the interpolated potential at specific points.
+
+        Args:
+            x (Nx3 numpy array): Cartesian coordinates of the point(s) to evaluate
+            out (numpy array or None): Preallocated array of shape (N,) in which the result is written (default = None)
+
+        Returns:
+            The interpolated potential at every position in vector ``x``. If ``out`` is given, ``out`` is returned.
+        """
+        return self._evaluate(x[:,0], x[:,1], x[:,2], 'potential', out)
+
+    def evaluate_force_vec(self, x, out=None):
+        """ Returns the interpolated force at specific points.
+
+        Args:
+            x (Nx3 numpy array): Cartesian coordinates of the point(s) to evaluate
+            out (numpy array or None): Preallocated array of shape (N, 3) in which the result is written (default = None)
+
+        Returns:
+            The interpolated force at every position in vector ``x``. If ``out`` is given, ``out`` is returned.
+        """
+        return self._evaluate(x[:,0], x[:,1], x[:,2], 'force', out)
+
+    def save(self, filename):
+        """ Saves the tables, and the model they were built from, to a ``.npz`` file
+
+        Args:
+            filename (string): The name of the file
+        """
+        values = {'r_max': self.r_max, 'z_max': self.z_max, 'tolerance': self.tolerance, 'error': self.error,
+                  'a': self.model._a, 'b': self.model._b, 'M': self.model._M, 'axis_codes': self.model._axis_codes,
+                  'group_scales': np.array([g[1] for g in self._groups]),
+                  'group_steps': np.array([g[2] for g in self._groups])}
+        for id_group, group in enumerate(self._groups):
+            values['tables{0}'.format(id_group)] = group[3]
+
+        np.savez(filename, **values)
+
+    @classmethod
+    def load(cls, filename):
+        """ Loads a tabulated model saved with :func:`~mnn.tabulated.TabulatedMNnModel.save`
+
+        Args:
+            filename (string): The name of the file
+
+        Returns:
+            A :class:`~mnn.tabulated.TabulatedMNnModel` instance
+        """
+        with np.load(filename) as data:
+            res = cls()
+            res.r_max = float(data['r_max'])
+            res.z_max = float(data['z_max'])
+            res.tolerance = float(data['tolerance'])
+            res.error = float(data['error'])
+
+            res.model = MNnModel()
+            res.model.load_from_array(np.column_stack((data['a'], data['b'], data['M'])), [axis_names[c] for c in data['axis_codes']])
+
+            res._split_thin_discs()
+            for id_group, (code, a, b, M) in enumerate(res._tabulated_groups()):
+                res._groups.append((code, tuple(data['group_scales'][id_group]), tuple(data['group_steps'][id_group]),
+                                    data['tables{0}'.format(id_group)]))
+                res._models.append(cls._group_model(code, a, b, M))
+
+        res._build_patches()
+        return res
@@ -20,7 +20,7 @@ setup(
     url="http://www.github.com/mdelorme/MNn",
 
     # Requirements
-    install_requires=['numpy', 'emcee', 'corner'],
+    install_requires=['numpy', 'scipy', 'emcee>=3', 'corner'],
 
     # Misc
     license="BSD",
@@ -0,0 +1,229 @@
+from __future__ import print_function
+import numpy as np
+import pytest
+
+from mnn.model import MNnModel, MNnError
+
+# The fitter needs emcee, corner and matplotlib
+fitter_module = pytest.importorskip('mnn.fitter')
+MNnFitter = fitter_module.MNnFitter
+
+# The discs the data is drawn from, in the order of the fitter (sorted by axis)
+discs = [('x', 2.0, 0.3, 0.5), ('z', 1.0, 0.5, 1.0)]
+params = np.array([disc[1:] for disc in discs]).reshape(-1)
+
+
+@pytest.fixture(scope='module')
+def data_file(tmp_path_factory):
+    """ Noisy density of the model at random points, in an ascii file """
+    random_state = np.random.RandomState(0)
+    points = random_state.uniform(-3.0, 3.0, (500, 3))
+    model = MNnModel()
+    model.add_discs(discs)
+    density = model.evaluate_density_vec(points) * (1.0 + 0.01*random_state.randn(points.shape[0]))
+    filename = str(tmp_path_factory.mktemp('data') / 'density.dat')
+    np.savetxt(filename, np.column_stack((points, density)))
+    return filename
+
+def make_fitter(filename, **kwargs):
+    fitter = MNnFitter(**kwargs)
+    fitter.set_model_type(1, 0, 1)
+    fitter.load_data(filename)
+    return fitter
+
+
+def test_loglikelihood_gradient_matches_finite_differences(data_file):
+    fitter = make_fitter(data_file)
+    point = params * 1.05
+    loglikelihood, gradient = fitter.loglikelihood_gradient(point)
+    assert loglikelihood == pytest.approx(fitter.loglikelihood(point), rel=1e-12)
+
+    expected = np.empty(point.size)
+    for i in range(point.size):
+        eps = 1e-6 * abs(point[i])
+        step = np.zeros(point.size)
+        step[i] = eps
+        expected[i] = (fitter.loglikelihood(point + step) - fitter.loglikelihood(point - step)) / (2.0*eps)
+    np.testing.assert_allclose(gradient, expected, rtol=1e-5, atol=1e-6*np.max(np.abs(expected)))
+
+def test_gradient_based_maximum_likelihood(data_file):
+    fitter = make_fitter(data_file)
+    best, loglikelihood = fitter.maximum_likelihood('L-BFGS-B', x0=params * 1.1)
+    assert loglikelihood >= fitter.loglikelihood(params)
+    np.testing.assert_allclose(best, params, rtol=0.05)
+
+
+@pytest.mark.parametrize('allow_negative_mass', [False, True])
+def test_solved_masses_maximize_the_likelihood(data_file, allow_negative_mass):
+    fitter = make_fitter(data_file, solve_masses=True, allow_negative_mass=allow_negative_mass)
+    scales = np.array([2.2, 0.35, 0.9, 0.55])
+    loglikelihood, masses = fitter.loglikelihood_masses(scales)
+
+    full = np.column_stack((scales.reshape(-1, 2), masses)).reshape(-1)
+    assert loglikelihood == pytest.approx(fitter.loglikelihood(full), rel=1e-10)
+    if not allow_negative_mass:
+        assert np.all(masses >= 0.0)
+    for i in range(masses.size):
+        for factor in (0.99, 1.01):
+            shifted = full.copy()
+            shifted[3*i + 2] *= factor
+            assert fitter.loglikelihood(shifted) < loglikelihood
+
+def test_solved_masses_recover_the_data(data_file):
+    fitter = make_fitter(data_file, solve_masses=True)
+    masses = fitter.loglikelihood_masses(params.reshape(-1, 3)[:, :2].reshape(-1))[1]
+    np.testing.assert_allclose(masses, params.reshape(-1, 3)[:, 2], rtol=0.01)
+
+def test_solved_masses_out_of_the_priors(data_file):
+    fitter = make_fitter(data_file, solve_masses=True)
+    loglikelihood, masses = fitter.loglikelihood_masses([2.0, -0.3, 1.0, 0.5])
+    assert loglikelihood == -np.inf
+    assert np.all(np.isnan(masses))
+
+def test_fit_with_solved_masses_returns_full_models(data_file):
+    fitter = make_fitter(data_file, solve_masses=True, n_walkers=8, n_steps=20)
+    samples, lnprob = fitter.fit_data(burnin=5, x0=params * 1.05)
+    assert samples.shape == (8*15, 6)
+    for i in (0, samples.shape[0] // 2, -1):
+        assert lnprob[i] == pytest.approx(fitter.loglikelihood(samples[i]), rel=1e-8)
+
+
+@pytest.fixture(scope='module')
+def symmetric_data_file(tmp_path_factory):
+    """ Data holding mirror images of its points, and points at the same distance of the z axis, with independent noise """
+    random_state = np.random.RandomState(1)
+    points = random_state.uniform(-3.0, 3.0, (200, 3))
+    points = np.vstack((points, points*(-1.0, 1.0, -1.0), points*(1.0, -1.0, 1.0), points[:, (1, 0, 2)]))
+    model = MNnModel()
+    model.add_discs(discs)
+    density = model.evaluate_density_vec(points) * (1.0 + 0.01*random_state.randn(points.shape[0]))
+    filename = str(tmp_path_factory.mktemp('data') / 'symmetric.dat')
+    np.savetxt(filename, np.column_stack((points, density)))
+    return filename
+
+@pytest.mark.parametrize('model_type', [(1, 0, 1), (0, 0, 2)])
+def test_symmetry_reduction_keeps_the_chi2(symmetric_data_file, model_type):
+    fitters = []
+    for reduction in (False, True):
+        fitter = MNnFitter(symmetry_reduction=reduction, solve_masses=True)
+        fitter.set_model_type(*model_type)
+        fitter.load_data(symmetric_data_file)
+        fitters.append(fitter)
+    full, reduced = fitters
+    assert reduced._get_plan()['n_points'] < full._get_plan()['n_points']
+
+    walkers = params * np.random.RandomState(2).uniform(0.8, 1.2, (10, params.size))
+    np.testing.assert_allclose(reduced.loglikelihood_vec(walkers), full.loglikelihood_vec(walkers), rtol=1e-10)
+    assert reduced.loglikelihood(walkers[0]) == pytest.approx(full.loglikelihood(walkers[0]), rel=1e-10)
+
+    loglikelihood, gradient = reduced.loglikelihood_gradient(walkers[0])
+    assert loglikelihood == pytest.approx(full.loglikelihood_gradient(walkers[0])[0], rel=1e-10)
+    np.testing.assert_allclose(gradient, full.loglikelihood_gradient(walkers[0])[1], rtol=1e-8, atol=1e-10*np.max(np.abs(gradient)))
+
+    scales = walkers[0].reshape(-1, 3)[:, :2].reshape(-1)
+    loglikelihood, masses = reduced.loglikelihood_masses(scales)
+    assert loglikelihood == pytest.approx(full.loglikelihood_masses(scales)[0], rel=1e-10)
+    np.testing.assert_allclose(masses, full.loglikelihood_masses(scales)[1], rtol=1e-8)
+
+
+class Crash(Exception):
+    pass
+
+def sampled_function(fitter):
+    """ Returns the name of the method the sampler of ``fitter`` evaluates the walkers with """
+    if fitter.solve_masses:
+        return 'loglikelihood_masses'
+    return 'loglikelihood_vec' if fitter.vectorize else 'loglikelihood'
+
+def count_calls(fitter, crash_after=None):
+    """ Counts the calls of the sampled method of ``fitter``, raising :class:`Crash` after ``crash_after`` calls """
+    name = sampled_function(fitter)
+    function = getattr(fitter, name)
+    calls = [0]
+    def counted(*args):
+        calls[0] += 1
+        if crash_after is not None and calls[0] > crash_after:
+            raise Crash()
+        return function(*args)
+    setattr(fitter, name, counted)
+    return calls
+
+chain_options = [{}, {'vectorize': False}, {'solve_masses': True}]
+
+@pytest.mark.parametrize('options', chain_options)
+def test_streamed_chain_matches_the_chain_in_memory(data_file, tmp_path, options):
+    x0 = params * 1.05
+    samples, lnprob = make_fitter(data_file, n_walkers=12, n_steps=30, **options).fit_data(burnin=5, x0=x0)
+    chain_file = str(tmp_path / 'chain.npy')
+    streamed = make_fitter(data_file, n_walkers=12, n_steps=30, **options).fit_data(burnin=5, x0=x0, chain_file=chain_file,
+                                                                                    checkpoint_every=7)
+    np.testing.assert_array_equal(streamed[0], samples)
+    np.testing.assert_array_equal(streamed[1], lnprob)
+    assert np.load(chain_file).shape[:2] == (30, 12)
+
+@pytest.mark.parametrize('options', chain_options)
+def test_resumed_chain_matches_the_uninterrupted_chain(data_file, tmp_path, options):
+    x0 = params * 1.05
+    fitter = make_fitter(data_file, n_walkers=12, n_steps=30, **options)
+    calls = count_calls(fitter)
+    samples, lnprob = fitter.fit_data(burnin=5, x0=x0)
+
+    # The run crashes between two checkpoints, at about two thirds of the chain
+    chain_file = str(tmp_path / 'chain.npy')
+    fitter = make_fitter(data_file, n_walkers=12, n_steps=30, **options)
+    count_calls(fitter, crash_after=2*calls[0]//3)
+    with pytest.raises(Crash):
+        fitter.fit_data(burnin=5, x0=x0, chain_file=chain_file, checkpoint_every=7)
+    with np.load(chain_file + fitter_module.checkpoint_suffix) as checkpoint:
+        step = int(checkpoint['step'])
+    assert step in (14, 21)
+
+    # The random generators are restored from the checkpoint, whatever their state
+    fitter = make_fitter(data_file, n_walkers=12, n_steps=30, **options)
+    np.random.seed(999)
+    resumed_calls = count_calls(fitter)
+    resumed = fitter.fit_data(burnin=5, x0=x0, chain_file=chain_file, checkpoint_every=7, resume=True)
+    np.testing.assert_array_equal(resumed[0], samples)
+    np.testing.assert_array_equal(resumed[1], lnprob)
+    # The steps before the checkpoint, and the initial walkers, are not evaluated again
+    assert resumed_calls[0] <= calls[0] * (30 - step) / 30.0
+
+def test_chain_without_checkpoint_is_not_resumed(data_file, tmp_path):
+    chain_file = str(tmp_path / 'chain.npy')
+    np.save(chain_file, np.arange(10.0))
+    fitter = make_fitter(data_file, n_walkers=12, n_steps=10)
+    with pytest.raises(MNnError):
+        fitter.fit_data(x0=params, chain_file=chain_file, resume=True)
+    np.testing.assert_array_equal(np.load(chain_file), np.arange(10.0))
+
+def test_chain_of_another_fit_is_not_resumed(data_file, tmp_path):
+    chain_file = str(tmp_path / 'chain.npy')
+    make_fitter(data_file, n_walkers=12, n_steps=10).fit_data(burnin=2, x0=params, chain_file=chain_file)
+    with pytest.raises(MNnError):
+        make_fitter(data_file, n_walkers=14, n_steps=10).fit_data(burnin=2, x0=params, chain_file=chain_file, resume=True)
+
+
+def test_vectorized_loglikelihood_matches_the_walkers_one_by_one(data_file):
+    fitter = make_fitter(data_file, allow_negative_mass=False)
+    walkers = params * np.random.RandomState(3).uniform(0.8, 1.2, (20, params.size))
+    # Walkers out of the priors : negative height, a+b < 0 and negative mass
+    walkers[1, 1] = -0.1
+    walkers[2, 3] = -1.0
+    walkers[3, 5] = -0.2
+
+    expected = np.array([fitter.loglikelihood(walker) for walker in walkers])
+    assert np.all(np.isinf(expected[1:4]))
+    np.testing.assert_allclose(fitter.loglikelihood_vec(walkers), expected, rtol=1e-12)
+
+def test_overridden_loglikelihood_is_sampled(data_file):
+    class Fitter(MNnFitter):
+        calls = 0
+        def loglikelihood(self, discs):
+            Fitter.calls += 1
+            return MNnFitter.loglikelihood(self, discs)
+
+    fitter = Fitter(n_walkers=12, n_steps=20)
+    fitter.set_model_type(1, 0, 1)
+    fitter.load_data(data_file)
+    fitter.fit_data(burnin=1, x0=params)
+    assert Fitter.calls >= 12*20
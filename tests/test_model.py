@@ -0,0 +1,133 @@
+from __future__ import print_function
+import numpy as np
+import pytest
+
+from mnn.model import MNnModel, MNnError
+
+# Discs along every axis, with a negative mass and a negative scale
+discs = [('x', 2.0, 0.3, 1.5), ('y', 0.5, 1.0, 2.0), ('z', 1.0, 0.5, 10.0), ('z', -0.2, 0.7, -1.0), ('z', 3.0, 0.2, 4.0)]
+
+
+def make_model(values=discs):
+    model = MNnModel()
+    model.add_discs(values)
+    return model
+
+def random_points(n_points, seed=0):
+    points = np.random.RandomState(seed).normal(0.0, 3.0, (n_points, 3))
+    # Points on the axes and in the planes of the discs
+    points[:3] = 0.0
+    points[3:6, 0] = 0.0
+    points[6:9, 2] = 0.0
+    return points
+
+def reference(values, points, quantity):
+    """ Sums the single disc functions of MNnModel over the discs """
+    res = np.zeros((points.shape[0], 3) if quantity == 'force' else points.shape[0])
+    for axis, a, b, M in values:
+        t1, t2, n = MNnModel.get_tangent_coordinates(points[:, 0], points[:, 1], points[:, 2], axis)
+        if quantity == 'density':
+            res += MNnModel.mn_density(np.sqrt(t1*t1 + t2*t2), n, a, b, M)
+        elif quantity == 'potential':
+            res += MNnModel.mn_potential(np.sqrt(t1*t1 + t2*t2), n, a, b, M)
+        else:
+            res += MNnModel.mn_force(t1, t2, n, a, b, M, axis)
+    return res
+
+
+@pytest.mark.parametrize('quantity', ['density', 'potential', 'force'])
+def test_fused_kernel_matches_single_discs(quantity):
+    model = make_model()
+    points = random_points(2000)
+    expected = reference(discs, points, quantity)
+
+    np.testing.assert_allclose(getattr(model, 'evaluate_{0}_vec'.format(quantity))(points), expected, rtol=1e-12, atol=1e-15)
+    res = getattr(model, 'evaluate_{0}'.format(quantity))(points[:, 0], points[:, 1], points[:, 2])
+    np.testing.assert_allclose(res, expected, rtol=1e-12, atol=1e-15)
+
+def test_evaluate_all_matches_single_quantities():
+    model = make_model()
+    points = random_points(500)
+    density, potential, force = model.evaluate_all(points[:, 0], points[:, 1], points[:, 2])
+    np.testing.assert_array_equal(density, model.evaluate_density_vec(points))
+    np.testing.assert_array_equal(potential, model.evaluate_potential_vec(points))
+    np.testing.assert_array_equal(force, model.evaluate_force_vec(points))
+
+@pytest.mark.parametrize('quantity', ['density', 'potential', 'force'])
+def test_blocks_workers_and_buffers_do_not_change_the_result(quantity):
+    model = make_model()
+    points = random_points(10000)
+    evaluate = getattr(model, 'evaluate_{0}_vec'.format(quantity))
+    expected = evaluate(points)
+
+    np.testing.assert_allclose(evaluate(points, max_memory=50000), expected, rtol=1e-14, atol=1e-300)
+    np.testing.assert_allclose(evaluate(points, max_memory=50000, n_workers=3), expected, rtol=1e-14, atol=1e-300)
+
+    out = np.empty_like(expected)
+    scratch = model.allocate_scratch(1000)
+    assert evaluate(points, out=out, scratch=scratch) is out
+    np.testing.assert_allclose(out, expected, rtol=1e-14, atol=1e-300)
+
+def test_scratch_of_wrong_type_is_rejected():
+    model = make_model()
+    with pytest.raises(MNnError):
+        model.evaluate_density_vec(random_points(10), scratch=np.empty(1000, dtype=np.float32))
+
+def test_float32_evaluation():
+    model = make_model()
+    points = random_points(1000)
+    res = model.evaluate_potential_vec(points, dtype=np.float32)
+    assert res.dtype == np.float32
+    np.testing.assert_allclose(res, reference(discs, points, 'potential'), rtol=1e-4)
+
+
+@pytest.mark.parametrize('quantity', ['density', 'potential', 'force'])
+@pytest.mark.parametrize('box', [((-5.0, -5.0, -2.0), (5.0, 5.0, 2.0), (21, 21, 9)),
+                                 ((0.1, 0.37, -2.0), (5.3, 7.1, 2.0), (21, 16, 9))])
+def test_single_axis_grid_matches_point_evaluation(quantity, box):
+    # The (R, z) tabulation of a single-axis model is used on the first box, the second one has no shared radius
+    model = make_model(discs[2:])
+    vx, vy, vz, res = model.generate_dataset_meshgrid(*box, quantity=quantity, mirror=False)
+    if quantity == 'force':
+        # The force keeps the layout of mn_force : the point dimensions are reversed
+        res = res.transpose(2, 1, 0, 3)
+    points = np.column_stack([np.broadcast_to(v, box[2]).reshape(-1) for v in (vx, vy, vz)])
+    expected = getattr(model, 'evaluate_{0}_vec'.format(quantity))(points)
+    np.testing.assert_allclose(res.reshape(expected.shape), expected, rtol=1e-12, atol=1e-15)
+
+@pytest.mark.parametrize('quantity', ['density', 'force'])
+def test_mirrored_grid_matches_full_grid(quantity):
+    model = make_model()
+    box = ((-4.0, -4.0, -3.0), (4.0, 4.0, 3.0), (17, 16, 13))
+    res = model.generate_dataset_meshgrid(*box, quantity=quantity, mirror=True)[3]
+    expected = model.generate_dataset_meshgrid(*box, quantity=quantity, mirror=False)[3]
+    np.testing.assert_allclose(res, expected, rtol=1e-12, atol=1e-15)
+
+
+@pytest.mark.parametrize('quantity', ['density', 'potential'])
+def test_jacobian_matches_finite_differences(quantity):
+    model = make_model()
+    points = random_points(300)[9:]
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+    jacobian = model.evaluate_jacobian(x, y, z, quantity)
+
+    params = np.array([disc[1:] for disc in discs]).reshape(-1)
+    expected = np.empty_like(jacobian)
+    eps = 1e-6
+    for i in range(params.size):
+        values = []
+        for sign in (1.0, -1.0):
+            shifted = params.copy()
+            shifted[i] += sign*eps
+            discs_shifted = [(disc[0],) + tuple(shifted[3*j:3*j+3]) for j, disc in enumerate(discs)]
+            values.append(getattr(make_model(discs_shifted), 'evaluate_{0}'.format(quantity))(x, y, z))
+        expected[:, i] = (values[0] - values[1]) / (2.0*eps)
+    np.testing.assert_allclose(jacobian, expected, rtol=1e-6, atol=1e-7*np.max(np.abs(expected)))
+
+    weights = np.random.RandomState(1).normal(size=x.size)
+    np.testing.assert_allclose(model.evaluate_jacobian(x, y, z, quantity, weights=weights, max_memory=20000),
+                               np.dot(weights, jacobian), rtol=1e-10, atol=1e-12*np.max(np.abs(jacobian)))
+
+def test_jacobian_of_the_force_is_rejected():
+    with pytest.raises(MNnError):
+        make_model().evaluate_jacobian(1.0, 2.0, 3.0, 'force')
@@ -0,0 +1,96 @@
+from __future__ import print_function
+import numpy as np
+import pytest
+
+from mnn.model import MNnModel, MNnError
+from mnn.orbits import OrbitIntegrator
+from mnn.tabulated import TabulatedMNnModel
+
+
+def make_model():
+    model = MNnModel()
+    model.add_discs([('z', 1.0, 0.5, 10.0), ('z', 3.0, 1.0, 5.0), ('x', 2.0, 0.3, 1.0)])
+    return model
+
+def initial_conditions(model, n_particles=200, seed=0):
+    """ Particles on nearly circular orbits around the z axis """
+    positions = np.random.RandomState(seed).normal(0.0, 3.0, (n_particles, 3))
+    positions[:, 2] *= 0.2
+    radius = np.sqrt(positions[:, 0]**2 + positions[:, 1]**2)
+    radial_force = -np.sum(model.evaluate_force_vec(positions)[:, :2]*positions[:, :2], axis=1) / radius
+    speed = np.sqrt(np.maximum(radial_force, 0.0)*radius)
+    velocities = np.column_stack((-positions[:, 1]/radius*speed, positions[:, 0]/radius*speed, np.zeros(n_particles)))
+    return positions, velocities
+
+def energy(model, positions, velocities):
+    return 0.5*np.sum(velocities**2, axis=1) + model.evaluate_potential_vec(positions)
+
+
+# The time steps of the fourth order scheme are larger, to keep its error well above the round-off
+@pytest.mark.parametrize('scheme, order, largest_dt', [('leapfrog', 2, 0.02), ('yoshida4', 4, 0.1)])
+def test_energy_error_converges_at_the_order_of_the_scheme(scheme, order, largest_dt):
+    model = make_model()
+    positions, velocities = initial_conditions(model)
+    e0 = energy(model, positions, velocities)
+
+    errors = []
+    for dt in (largest_dt, 0.5*largest_dt):
+        p, v = positions.copy(), velocities.copy()
+        OrbitIntegrator(model, dt, scheme).integrate(p, v, int(round(2.0/dt)))
+        errors.append(np.max(np.abs(energy(model, p, v) - e0) / np.abs(e0)))
+
+    assert errors[1] < 1e-4
+    assert errors[0] / errors[1] > 0.8 * 2**order
+
+def test_leapfrog_is_time_reversible():
+    model = make_model()
+    positions, velocities = initial_conditions(model)
+    p, v = positions.copy(), velocities.copy()
+    OrbitIntegrator(model, 0.01).integrate(p, v, 100)
+    OrbitIntegrator(model, -0.01).integrate(p, v, 100)
+    np.testing.assert_allclose(p, positions, atol=1e-10)
+    np.testing.assert_allclose(v, velocities, atol=1e-10)
+
+def test_trajectories_are_written_to_disk(tmp_path):
+    model = make_model()
+    positions, velocities = initial_conditions(model, 50)
+    p, v = positions.copy(), velocities.copy()
+    filename = str(tmp_path / 'orbits.npy')
+    OrbitIntegrator(model, 0.01).integrate(p, v, 20, output=filename, output_every=5, flush_every=2)
+
+    trajectories = np.load(filename)
+    assert trajectories.shape == (5, 50, 6)
+    np.testing.assert_array_equal(trajectories[0], np.column_stack((positions, velocities)))
+    np.testing.assert_array_equal(trajectories[-1], np.column_stack((p, v)))
+
+    # The same integration without output, and with the scratch array of the kernel replaced by temporaries
+    q, w = positions.copy(), velocities.copy()
+    integrator = OrbitIntegrator(model, 0.01)
+    integrator._allocate_buffers(50)
+    integrator._kernel_scratch = None
+    integrator.integrate(q, w, 20)
+    np.testing.assert_array_equal(q, p)
+    np.testing.assert_array_equal(w, v)
+
+def test_tabulated_model_can_be_integrated():
+    model = make_model()
+    positions, velocities = initial_conditions(model, 50)
+    p, v = positions.copy(), velocities.copy()
+    q, w = positions.copy(), velocities.copy()
+    OrbitIntegrator(model, 0.01).integrate(p, v, 50)
+    OrbitIntegrator(TabulatedMNnModel(model), 0.01).integrate(q, w, 50)
+    np.testing.assert_allclose(q, p, rtol=1e-4, atol=1e-6)
+
+def test_invalid_arguments():
+    model = make_model()
+    with pytest.raises(MNnError):
+        OrbitIntegrator(model, 0.01, scheme='euler')
+
+    positions, velocities = initial_conditions(model, 10)
+    integrator = OrbitIntegrator(model, 0.01)
+    with pytest.raises(MNnError):
+        integrator.integrate(positions.T.copy().T, velocities, 1)
+    with pytest.raises(MNnError):
+        integrator.integrate(positions, velocities[:5], 1)
+    with pytest.raises(MNnError):
+        integrator.integrate(positions, velocities, 4, output=np.empty((2, 10, 6)))
@@ -0,0 +1,70 @@
+from __future__ import print_function
+import numpy as np
+import pytest
+
+from mnn.model import MNnModel, MNnError
+from mnn.tabulated import TabulatedMNnModel
+
+# Two axis groups and a razor-thin disc, evaluated analytically
+discs = [('x', 2.0, 0.3, 1.5), ('z', 1.0, 0.5, 10.0), ('z', 3.0, 1.0, 5.0), ('z', 2.0, 0.0, 1.0)]
+
+
+@pytest.fixture(scope='module')
+def models():
+    model = MNnModel()
+    model.add_discs(discs)
+    return model, TabulatedMNnModel(model, tolerance=1e-5)
+
+def random_points(n_points, seed=0):
+    points = np.random.RandomState(seed).normal(0.0, 5.0, (n_points, 3))
+    # A few points out of the tables
+    points[:10] *= 1000.0
+    return points
+
+
+def test_tabulated_model_reaches_the_tolerance(models):
+    model, tabulated = models
+    points = random_points(20000)
+    assert tabulated.error <= 1e-5
+
+    potential = model.evaluate_potential_vec(points)
+    np.testing.assert_allclose(tabulated.evaluate_potential_vec(points), potential, rtol=1e-5)
+
+    force = model.evaluate_force_vec(points)
+    error = np.linalg.norm(tabulated.evaluate_force_vec(points) - force, axis=1) / np.linalg.norm(force, axis=1)
+    assert np.max(error) <= 1e-5
+
+def test_tabulated_force_is_the_gradient_of_the_potential(models):
+    tabulated = models[1]
+    points = random_points(200, seed=1)[10:]
+    force = tabulated.evaluate_force_vec(points)
+    eps = 1e-6
+    for axis in range(3):
+        step = np.zeros(3)
+        step[axis] = eps
+        derivative = (tabulated.evaluate_potential_vec(points + step) - tabulated.evaluate_potential_vec(points - step)) / (2.0*eps)
+        np.testing.assert_allclose(-derivative, force[:, axis], rtol=1e-5, atol=1e-6*np.max(np.abs(force)))
+
+def test_tabulated_model_output_buffers(models):
+    tabulated = models[1]
+    points = random_points(1000)
+    out = np.empty((1000, 3))
+    assert tabulated.evaluate_force_vec(points, out=out) is out
+    np.testing.assert_array_equal(out, tabulated.evaluate_force_vec(points))
+    np.testing.assert_array_equal(tabulated.evaluate_potential(points[:, 0], points[:, 1], points[:, 2]),
+                                  tabulated.evaluate_potential_vec(points))
+
+def test_tabulated_model_save_and_load(models, tmp_path):
+    tabulated = models[1]
+    filename = str(tmp_path / 'tables.npz')
+    tabulated.save(filename)
+    loaded = TabulatedMNnModel.load(filename)
+
+    points = random_points(1000)
+    assert loaded.error == tabulated.error
+    np.testing.assert_array_equal(loaded.evaluate_force_vec(points), tabulated.evaluate_force_vec(points))
+    np.testing.assert_array_equal(loaded.evaluate_potential_vec(points), tabulated.evaluate_potential_vec(points))
+
+def test_empty_model_cannot_be_tabulated():
+    with pytest.raises(MNnError):
+        TabulatedMNnModel(MNnModel())